@@ -1,14 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, make_response, session, abort, flash, jsonify
+from flask import Flask, Response, before_render_template, template_rendered, render_template, request, redirect, url_for, send_file, make_response, session, abort, flash, jsonify, g, has_app_context, stream_with_context
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
-from io import BytesIO
-from openpyxl import Workbook
+import bisect
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import queue
+import re
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import unicodedata
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO, StringIO
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
 from barcode import Code39
-from barcode.writer import ImageWriter
+from barcode.writer import ImageWriter, SVGWriter
 import barcode
-from functools import wraps
+from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache, wraps
+from urllib.parse import quote
 import secrets
+import click
 
 app = Flask(__name__)
 
@@ -43,157 +68,2095 @@ def login_required_for(methods=("POST",)):
         return wrapped
     return deco
 
-BARCODE_DIR = os.path.join("static", "barcodes")
-os.makedirs(BARCODE_DIR, exist_ok=True)
+def api_login_required(view):
+    """Como login_required, mas para rotas JSON: responde 401 em vez de redirecionar."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not session.get("user"):
+            return jsonify({"ok": False, "erro": "Login necessário."}), 401
+        return view(*args, **kwargs)
+    return wrapped
+
+# ----------------- Métricas (formato texto do Prometheus, em /metrics) -----------------
+METRICAS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICAS_QUANTIDADE = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# >0 liga o log de requests lentos (com as consultas mais demoradas); 0 = desligado
+SLOW_MS = float(os.environ.get("EPI_SLOW_MS", "0"))
+SLOW_CONSULTAS = 5
+
+class Metricas:
+    """
+    Contadores e histogramas em memória, por processo (com --workers cada
+    worker tem os seus: o Prometheus soma as instâncias).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tipos = {}        # nome -> (tipo, ajuda, buckets)
+        self._series = {}       # (nome, rótulos) -> valor | [contagens, soma, total]
+
+    def declarar(self, nome, tipo, ajuda, buckets=METRICAS_SEGUNDOS):
+        self._tipos[nome] = (tipo, ajuda, buckets)
+
+    def somar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self._series[chave] = self._series.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        buckets = self._tipos[nome][2]
+        chave = (nome, tuple(sorted(rotulos.items())))
+        i = bisect.bisect_left(buckets, valor)
+        with self._lock:
+            h = self._series.get(chave)
+            if h is None:
+                h = self._series[chave] = [[0] * len(buckets), 0.0, 0]
+            if i < len(buckets):
+                h[0][i] += 1
+            h[1] += valor
+            h[2] += 1
+
+    @staticmethod
+    def _rotulos(pares) -> str:
+        if not pares:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pares) + "}"
+
+    def texto(self, medidores=()) -> str:
+        """medidores: [(nome, ajuda, [(dict_rotulos, valor), ...])] lidos na hora (gauges)."""
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) if isinstance(v, list) else v for k, v in self._series.items()}
+        saida = []
+        for nome in sorted(self._tipos):
+            tipo, ajuda, buckets = self._tipos[nome]
+            saida += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+            for (n, pares), v in sorted(series.items()):
+                if n != nome:
+                    continue
+                if tipo != "histogram":
+                    saida.append(f"{nome}{self._rotulos(pares)} {v}")
+                    continue
+                contagens, soma, total = v
+                acumulado = 0
+                for limite, c in zip(buckets, contagens):
+                    acumulado += c
+                    saida.append(f"{nome}_bucket{self._rotulos(pares + (('le', limite),))} {acumulado}")
+                saida.append(f"{nome}_bucket{self._rotulos(pares + (('le', '+Inf'),))} {total}")
+                saida.append(f"{nome}_sum{self._rotulos(pares)} {soma:.6f}")
+                saida.append(f"{nome}_count{self._rotulos(pares)} {total}")
+        for nome, ajuda, valores in medidores:
+            saida += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} gauge"]
+            saida += [f"{nome}{self._rotulos(tuple(sorted(r.items())))} {v}" for r, v in valores]
+        return "\n".join(saida) + "\n"
+
+metricas = Metricas()
+metricas.declarar("epi_http_requisicao_seconds", "histogram", "Duração dos requests (inclui o streaming das exportações).")
+metricas.declarar("epi_http_requisicoes_total", "counter", "Requests por endpoint, método e status.")
+metricas.declarar("epi_sql_consultas_por_requisicao", "histogram", "Comandos SQL executados por request.", METRICAS_QUANTIDADE)
+metricas.declarar("epi_sql_requisicao_seconds", "histogram", "Tempo somado em SQL por request.")
+metricas.declarar("epi_sql_consultas_total", "counter", "Comandos SQL executados em requests.")
+metricas.declarar("epi_sql_seconds_total", "counter", "Tempo total em SQL em requests.")
+metricas.declarar("epi_template_render_seconds", "histogram", "Tempo de renderização dos templates Jinja.")
+metricas.declarar("epi_barcode_render_seconds", "histogram", "Tempo renderizando código de barras (python-barcode/Pillow).")
+metricas.declarar("epi_export_seconds", "histogram", "Tempo gerando e enviando exportações (CSV/XLSX).")
+metricas.declarar("epi_export_bytes_total", "counter", "Bytes enviados em exportações.")
+metricas.declarar("epi_baixas_grupo_bips", "histogram", "Bips gravados por transação no group commit.", METRICAS_QUANTIDADE)
+metricas.declarar("epi_relatorio_copia_seconds", "histogram", "Tempo fazendo a cópia de relatórios (backup do SQLite).")
+
+def _anotar_sql(m, sql, duracao):
+    m["sql_n"] += 1
+    m["sql_s"] += duracao
+    if m["consultas"] is not None:
+        m["consultas"].append((duracao, sql))
+
+class CursorCronometrado(sqlite3.Cursor):
+    """Cursor que mede cada execute/executemany feito dentro de um request (ver _iniciar_metricas)."""
+
+    def execute(self, sql, parametros=()):
+        m = g.get("_metricas") if has_app_context() else None
+        if m is None:
+            return super().execute(sql, parametros)
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            _anotar_sql(m, sql, time.perf_counter() - t0)
+
+    def executemany(self, sql, sequencia):
+        m = g.get("_metricas") if has_app_context() else None
+        if m is None:
+            return super().executemany(sql, sequencia)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, sequencia)
+        finally:
+            _anotar_sql(m, sql, time.perf_counter() - t0)
+
+# ----------------- Conexões com o banco (pool + WAL) -----------------
+DB_PATH = os.environ.get("EPI_DB", "estoque.db")
+# conexões abertas no máximo; padrão: uma por thread do servidor (EPI_THREADS / --threads)
+DB_POOL_MAX = int(os.environ.get("EPI_DB_POOL", "0")) or int(os.environ.get("EPI_THREADS", "16"))
+DB_POOL_ESPERA = float(os.environ.get("EPI_DB_ESPERA", "10"))  # segundos esperando conexão livre
+
+# Aplicados uma única vez, quando a conexão é criada (e não a cada request)
+PRAGMAS_CONEXAO = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA synchronous = NORMAL",   # seguro com WAL, evita fsync a cada commit
+    "PRAGMA busy_timeout = 5000",    # espera o lock em vez de falhar com 'database is locked'
+    "PRAGMA cache_size = -16000",    # ~16 MB de cache de páginas por conexão
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+class ConexaoPool(sqlite3.Connection):
+    """
+    Conexão que volta para o pool no close() em vez de fechar de verdade.
+    Dentro de um request ela fica presa em `g` e o close() só descarta
+    o que não foi commitado (mesmo efeito do close() antigo).
+    """
+    _pool = None
+    _no_request = False
+    somente_leitura = False   # conexão da cópia de relatórios (ver CopiaRelatorios)
+
+    def cursor(self, factory=CursorCronometrado):
+        return super().cursor(factory)
+
+    # os atalhos do sqlite3 criam o cursor em C, sem passar por cursor(): refeitos aqui
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, sequencia):
+        return self.cursor().executemany(sql, sequencia)
+
+    def close(self):
+        if self._pool is None:
+            return super().close()
+        if self.in_transaction:
+            self.rollback()
+        if not self._no_request:
+            self._pool.devolver(self)
+
+
+class PoolConexoes:
+    """Pool simples de conexões SQLite, seguro entre threads."""
+
+    def __init__(self, caminho, maximo=DB_POOL_MAX, espera=DB_POOL_ESPERA):
+        self.caminho = caminho
+        self.maximo = maximo
+        self.espera = espera
+        self._livres = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._abertas = 0
+        self._stats = {"criadas": 0, "reutilizadas": 0, "esperas": 0, "descartadas": 0}
+        self._preparar_banco()
+
+    def _preparar_banco(self):
+        # journal_mode=WAL é persistente no arquivo: basta ligar uma vez
+        conn = sqlite3.connect(self.caminho)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+        finally:
+            conn.close()
+
+    def _nova(self):
+        conn = sqlite3.connect(self.caminho, factory=ConexaoPool, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS_CONEXAO:
+            conn.execute(pragma)
+        conn.create_function("normalizar_nome", 1, normalizar_nome, deterministic=True)
+        conn._pool = self
+        return conn
+
+    def obter(self):
+        try:
+            conn = self._livres.get_nowait()
+            with self._lock:
+                self._stats["reutilizadas"] += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            pode_criar = self._abertas < self.maximo
+            if pode_criar:
+                self._abertas += 1
+                self._stats["criadas"] += 1
+            else:
+                self._stats["esperas"] += 1
+
+        if pode_criar:
+            try:
+                return self._nova()
+            except Exception:
+                with self._lock:
+                    self._abertas -= 1
+                raise
+
+        try:
+            return self._livres.get(timeout=self.espera)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Pool de conexões esgotado (tempo de espera excedido).")
+
+    def devolver(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            self._descartar(conn)
+            return
+        self._livres.put(conn)
+
+    def _descartar(self, conn):
+        with self._lock:
+            self._abertas -= 1
+            self._stats["descartadas"] += 1
+        try:
+            sqlite3.Connection.close(conn)
+        except sqlite3.Error:
+            pass
+
+    def fechar(self):
+        """Fecha as conexões ociosas (as emprestadas fecham ao voltar)."""
+        while True:
+            try:
+                conn = self._livres.get_nowait()
+            except queue.Empty:
+                break
+            self._descartar(conn)
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+            dados["abertas"] = self._abertas
+        dados["ociosas"] = self._livres.qsize()
+        dados["em_uso"] = dados["abertas"] - dados["ociosas"]
+        dados["maximo"] = self.maximo
+        return dados
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> PoolConexoes:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PoolConexoes(DB_PATH, DB_POOL_MAX)
+    return _pool
+
+def reiniciar_pool(db_path=None):
+    """Fecha o pool atual (ex.: trocar de banco em scripts/benchmarks)."""
+    global _pool, DB_PATH
+    with _pool_lock:
+        if _pool is not None:
+            _pool.fechar()
+        _pool = None
+        if db_path:
+            DB_PATH = db_path
+
+def get_db_connection():
+    """
+    Dentro de um request devolve sempre a mesma conexão (guardada em `g`),
+    devolvida ao pool no teardown. Fora de request, empresta uma do pool:
+    o close() devolve.
+    """
+    if has_app_context():
+        conn = g.get("_db")
+        if conn is None:
+            conn = get_pool().obter()
+            conn._no_request = True
+            g._db = conn
+        return conn
+    return get_pool().obter()
+
+@app.before_request
+def _iniciar_metricas():
+    g._metricas = {"t0": time.perf_counter(), "sql_n": 0, "sql_s": 0.0, "status": 500,
+                   "consultas": [] if SLOW_MS > 0 else None}
+
+@app.after_request
+def _status_metricas(resp):
+    m = g.get("_metricas")
+    if m is not None:
+        m["status"] = resp.status_code
+    return resp
+
+@app.teardown_request
+def _registrar_metricas(exc):
+    # Em respostas com stream_with_context roda só quando o stream termina
+    m = g.pop("_metricas", None)
+    if m is None:
+        return
+    duracao = time.perf_counter() - m["t0"]
+    endpoint = request.url_rule.rule if request.url_rule else "(sem rota)"
+    metricas.somar("epi_http_requisicoes_total", endpoint=endpoint, metodo=request.method, status=m["status"])
+    if endpoint == "/api/stream":
+        return  # conexão longa: a duração não diz nada
+    metricas.observar("epi_http_requisicao_seconds", duracao, endpoint=endpoint, metodo=request.method)
+    metricas.observar("epi_sql_consultas_por_requisicao", m["sql_n"], endpoint=endpoint)
+    metricas.observar("epi_sql_requisicao_seconds", m["sql_s"], endpoint=endpoint)
+    metricas.somar("epi_sql_consultas_total", m["sql_n"], endpoint=endpoint)
+    metricas.somar("epi_sql_seconds_total", m["sql_s"], endpoint=endpoint)
+    if m["consultas"] is not None and duracao * 1000 >= SLOW_MS:
+        piores = sorted(m["consultas"], key=lambda c: c[0], reverse=True)[:SLOW_CONSULTAS]
+        app.logger.warning(
+            "request lento: %s %s -> %s em %.1f ms; SQL: %d comando(s), %.1f ms%s",
+            request.method, request.full_path.rstrip("?"), m["status"], duracao * 1000,
+            m["sql_n"], m["sql_s"] * 1000,
+            "".join(f"\n  {d * 1000:8.2f} ms  {' '.join(sql.split())[:300]}" for d, sql in piores))
+
+@before_render_template.connect_via(app)
+def _inicio_template(sender, template, context, **extra):
+    if has_app_context():
+        g.setdefault("_templates", {})[template.name] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _fim_template(sender, template, context, **extra):
+    t0 = g.get("_templates", {}).pop(template.name, None) if has_app_context() else None
+    if t0 is not None:
+        metricas.observar("epi_template_render_seconds", time.perf_counter() - t0, template=template.name)
+
+@app.teardown_appcontext
+def _devolver_conexao(exc):
+    for chave in ("_db", "_db_relatorio"):
+        conn = g.pop(chave, None)
+        if conn is not None:
+            conn._no_request = False
+            conn.close()
+
+# ----------------- Cópia para relatórios (backup periódico, somente leitura) -----------------
+RELATORIO_COPIA = os.environ.get("EPI_RELATORIO_COPIA", "0") == "1"
+RELATORIO_DB = os.environ.get("EPI_RELATORIO_DB", "")                          # padrão: <banco>.relatorio.db ao lado
+RELATORIO_INTERVALO = float(os.environ.get("EPI_RELATORIO_INTERVALO", "300"))  # idade máxima da cópia (s)...
+RELATORIO_ESCRITAS = int(os.environ.get("EPI_RELATORIO_ESCRITAS", "1000"))     # ...ou renova antes, após N escritas
+RELATORIO_VERIFICA = 5.0                                                       # s entre conferências da thread
+
+def versao_dados(conn) -> int:
+    """
+    Cresce a cada escrita que aparece num relatório: soma dos contadores
+    'inventario' (itens: saldo e catálogo) e 'movimentacoes', os dois mantidos
+    por triggers. Nunca se repete, então serve de chave de cache; a diferença
+    entre duas leituras é quantas linhas foram escritas entre elas.
+    """
+    return conn.execute("""
+        SELECT SUM(valor) FROM contadores WHERE nome IN ('inventario', 'movimentacoes')
+    """).fetchone()[0]
+
+class CopiaRelatorios:
+    """
+    Cópia do banco só para as telas e exportações de relatório, feita com a API
+    de backup do SQLite por uma thread em segundo plano: a cada
+    RELATORIO_INTERVALO segundos, ou antes se já houve RELATORIO_ESCRITAS
+    escritas. As consultas longas e o openpyxl leem a cópia e não seguram
+    leitura nenhuma no banco em que os leitores de código gravam.
+
+    A cópia nova é montada num arquivo temporário e publicada com os.replace:
+    quem está lendo a anterior continua nela até devolver a conexão. Publicado,
+    o arquivo nunca mais muda, então as conexões abrem com immutable=1 (sem
+    lock). Com --workers cada processo tem a sua thread; se outro worker já
+    renovou a cópia, a conferência seguinte vê isso e não refaz.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._copiando = threading.Lock()   # uma cópia por vez no processo
+        self._livres = queue.LifoQueue()
+        self._pid = None
+        self._meta = None               # (identidade do arquivo, feita_em, versao) da cópia publicada
+        self._conferida = (None, 0.0)   # (versao, quando): o banco ainda estava igual à cópia
+        self._stats = {"copias": 0, "falhas": 0, "ultima_s": 0.0}
+
+    def caminho(self) -> str:
+        if RELATORIO_DB:
+            return RELATORIO_DB
+        base, ext = os.path.splitext(os.path.abspath(DB_PATH))
+        return f"{base}.relatorio{ext or '.db'}"
+
+    def _uri(self) -> str:
+        return "file:" + quote(self.caminho()) + "?mode=ro&immutable=1"
+
+    def iniciar(self):
+        """Sobe a thread de renovação neste processo (uma vez; workers nascem por fork)."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._rodar, name="copia-relatorios", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _rodar(self):
+        while True:
+            try:
+                self.renovar()
+            except Exception:
+                with self._lock:
+                    self._stats["falhas"] += 1
+                app.logger.exception("Cópia de relatórios: falha ao renovar")
+            time.sleep(RELATORIO_VERIFICA)
+
+    def _ler_meta(self):
+        """(identidade, feita_em, versao) da cópia publicada, ou None. Só relê quando o arquivo muda."""
+        try:
+            st = os.stat(self.caminho())
+        except FileNotFoundError:
+            return None
+        ident = (st.st_ino, st.st_mtime_ns, st.st_size)
+        meta = self._meta
+        if meta is None or meta[0] != ident:
+            conn = sqlite3.connect(self._uri(), uri=True)
+            try:
+                feita_em, versao = conn.execute("SELECT feita_em, versao FROM copia_relatorio").fetchone()
+            except sqlite3.Error:
+                return None
+            finally:
+                conn.close()
+            meta = self._meta = (ident, feita_em, versao)
+        return meta
+
+    def renovar(self, forcar=False) -> bool:
+        """Refaz a cópia se ela não existe ou ficou velha demais. True se fez uma nova."""
+        with self._copiando:
+            return self._renovar(forcar)
+
+    def _renovar(self, forcar):
+        conn = get_pool().obter()
+        try:
+            versao = versao_dados(conn)
+        finally:
+            conn.close()
+        meta = self._ler_meta()
+        if meta and not forcar:
+            if versao == meta[2]:
+                with self._lock:
+                    self._conferida = (versao, time.time())
+                return False
+            if abs(versao - meta[2]) < RELATORIO_ESCRITAS and time.time() - meta[1] < RELATORIO_INTERVALO:
+                return False
+        self._copiar()
+        return True
+
+    def _copiar(self):
+        final = self.caminho()
+        tmp = f"{final}.{os.getpid()}.tmp"
+        t0 = time.perf_counter()
+        feita_em = time.time()
+        origem = sqlite3.connect(get_pool().caminho)
+        try:
+            origem.execute("PRAGMA busy_timeout = 5000")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            destino = sqlite3.connect(tmp)
+            try:
+                # um passo só: lê um snapshot consistente do banco inteiro; no WAL não trava quem grava
+                origem.backup(destino)
+                destino.execute("PRAGMA journal_mode = DELETE")   # a cópia herdaria o WAL do original
+                destino.execute("CREATE TABLE copia_relatorio (feita_em REAL NOT NULL, versao INTEGER NOT NULL)")
+                destino.execute("INSERT INTO copia_relatorio VALUES (?, ?)", (feita_em, versao_dados(destino)))
+                destino.commit()
+            finally:
+                destino.close()
+            os.replace(tmp, final)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            origem.close()
+        duracao = time.perf_counter() - t0
+        with self._lock:
+            self._stats["copias"] += 1
+            self._stats["ultima_s"] = round(duracao, 3)
+        metricas.observar("epi_relatorio_copia_seconds", duracao)
+
+    def obter(self):
+        """Conexão somente leitura na cópia mais recente, ou None se ainda não existe cópia."""
+        self.iniciar()
+        meta = self._ler_meta()
+        if meta is None:
+            return None
+        while True:
+            try:
+                conn = self._livres.get_nowait()
+            except queue.Empty:
+                break
+            if conn.meta == meta:
+                return conn
+            sqlite3.Connection.close(conn)   # de uma cópia anterior
+        conn = sqlite3.connect(self._uri(), uri=True, factory=ConexaoPool, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS_CONEXAO:
+            conn.execute(pragma)
+        conn.create_function("normalizar_nome", 1, normalizar_nome, deterministic=True)
+        conn._pool = self
+        conn.somente_leitura = True
+        conn.meta = meta
+        return conn
+
+    def devolver(self, conn):
+        conn.row_factory = sqlite3.Row
+        if conn.meta == self._meta and self._livres.qsize() < DB_POOL_MAX:
+            self._livres.put(conn)
+        else:
+            sqlite3.Connection.close(conn)
+
+    def dados_em(self, conn) -> float:
+        """
+        Até quando os dados da conexão valem: a hora da cópia, ou a da última
+        conferência em que o banco ainda estava igual a ela. Banco -> agora.
+        """
+        if conn is None or not conn.somente_leitura:
+            return time.time()
+        versao, quando = self._conferida
+        feita_em = conn.meta[1]
+        return max(feita_em, quando) if versao == conn.meta[2] else feita_em
+
+    def stats(self):
+        meta = self._meta
+        with self._lock:
+            dados = dict(self._stats)
+        dados["ativo"] = RELATORIO_COPIA
+        dados["caminho"] = self.caminho()
+        dados["idade_s"] = round(time.time() - meta[1], 1) if meta else None
+        dados["versao"] = meta[2] if meta else None
+        dados["conexoes_ociosas"] = self._livres.qsize()
+        return dados
+
+copia_relatorios = CopiaRelatorios()
+
+def usa_copia_relatorio(view):
+    """
+    Rota de relatório: com EPI_RELATORIO_COPIA=1 as consultas feitas por
+    conexao_relatorio() vão para a cópia, e a resposta diz de quando são os
+    dados (X-Dados-Em / X-Dados-Atraso). Sem cópia ainda, usa o banco.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        prender_copia_relatorio()
+        return view(*args, **kwargs)
+    return wrapper
+
+def prender_copia_relatorio():
+    """Prende a conexão da cópia ao contexto atual (`g`); devolvida no teardown. Desligada -> nada."""
+    if RELATORIO_COPIA:
+        conn = copia_relatorios.obter()
+        if conn is not None:
+            conn._no_request = True
+            g._db_relatorio = conn
+        g._dados_em = copia_relatorios.dados_em(conn)
+
+def conexao_relatorio():
+    """Conexão das consultas de relatório: a cópia presa ao request (usa_copia_relatorio) ou o banco."""
+    conn = g.get("_db_relatorio") if has_app_context() else None
+    return conn if conn is not None else get_db_connection()
+
+@app.after_request
+def _cabecalhos_copia(resp):
+    quando = g.get("_dados_em")
+    if quando is not None:
+        resp.headers["X-Dados-Em"] = datetime.fromtimestamp(quando).isoformat(timespec="seconds")
+        resp.headers["X-Dados-Atraso"] = str(max(0, int(time.time() - quando)))
+    return resp
+
+# ----------------- Migrações de schema -----------------
+# Cada migração roda UMA vez, em ordem, dentro de uma transação própria.
+# A versão aplicada fica em schema_version. Para evoluir o banco, acrescente
+# uma função _mig_NNN_* no fim de MIGRACOES (nunca altere uma já publicada).
+
+def _mig_001_tabelas_base(cur):
+    # Itens de EPI
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS itens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            codigo TEXT UNIQUE NOT NULL,
+            saldo INTEGER NOT NULL
+        )
+    ''')
+
+    # Histórico de saídas
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS movimentacoes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id INTEGER NOT NULL,
+            quantidade INTEGER NOT NULL,
+            destinatario TEXT NOT NULL,
+            data TEXT NOT NULL,
+            FOREIGN KEY (item_id) REFERENCES itens (id)
+        )
+    ''')
+
+    # Fila de etiquetas a imprimir depois
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS etiquetas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id INTEGER NOT NULL,
+            codigo TEXT NOT NULL,
+            nome TEXT NOT NULL,
+            numero_etiqueta INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendente',  -- 'pendente' | 'impresso'
+            criado_em TEXT DEFAULT (datetime('now','localtime')),
+            impresso_em TEXT,
+            FOREIGN KEY (item_id) REFERENCES itens (id) ON DELETE CASCADE
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_etq_status ON etiquetas(status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_etq_item   ON etiquetas(item_id)")
+
+def _mig_002_coluna_ca(cur):
+    # Antes feito por ensure_ca_column(), que apontava para o arquivo errado (epi.db)
+    colunas = {r["name"] for r in cur.execute("PRAGMA table_info(itens)")}
+    if "ca" not in colunas:
+        cur.execute("ALTER TABLE itens ADD COLUMN ca TEXT")
+
+def _mig_003_versao_catalogo(cur):
+    # Contadores/versões. 'catalogo' sobe a cada mudança de nome/código/CA,
+    # inclusão ou exclusão de item (vale para qualquer processo que grave no banco).
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS contadores (
+            nome  TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO contadores (nome, valor) VALUES ('catalogo', 0)")
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_catalogo_ins AFTER INSERT ON itens
+        BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE nome = 'catalogo';
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_catalogo_upd AFTER UPDATE OF nome, codigo, ca ON itens
+        WHEN NEW.nome IS NOT OLD.nome OR NEW.codigo IS NOT OLD.codigo OR NEW.ca IS NOT OLD.ca
+        BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE nome = 'catalogo';
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_catalogo_del AFTER DELETE ON itens
+        BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE nome = 'catalogo';
+        END
+    """)
+
+def _mig_004_indices_movimentacoes(cur):
+    # Relatórios: ordem (data, id) e filtros por período / destinatário / item
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_mov_data      ON movimentacoes(data, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_mov_item_data ON movimentacoes(item_id, data)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_mov_dest_data ON movimentacoes(destinatario COLLATE NOCASE, data, id)")
+    cur.execute("ANALYZE movimentacoes")
+
+def _mig_005_consumo_diario(cur):
+    # Rollup de consumo por item/destinatário/dia, mantido por trigger na MESMA
+    # transação de cada INSERT em movimentacoes. Não há trigger de DELETE de
+    # propósito: o rollup é o histórico resumido e sobrevive ao arquivamento;
+    # ao excluir o item, o ON DELETE CASCADE limpa as linhas dele.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS consumo_diario (
+            item_id      INTEGER NOT NULL REFERENCES itens (id) ON DELETE CASCADE,
+            destinatario TEXT    NOT NULL COLLATE NOCASE,
+            dia          TEXT    NOT NULL,              -- 'AAAA-MM-DD'
+            quantidade   INTEGER NOT NULL DEFAULT 0,
+            movimentos   INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (item_id, destinatario, dia)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_consumo_dia  ON consumo_diario(dia)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_consumo_dest ON consumo_diario(destinatario, dia)")
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_mov_consumo_ins AFTER INSERT ON movimentacoes
+        BEGIN
+            INSERT INTO consumo_diario (item_id, destinatario, dia, quantidade, movimentos)
+            VALUES (NEW.item_id, NEW.destinatario, substr(NEW.data, 1, 10), NEW.quantidade, 1)
+            ON CONFLICT (item_id, destinatario, dia) DO UPDATE
+               SET quantidade = quantidade + excluded.quantidade,
+                   movimentos = movimentos + 1;
+        END
+    """)
+    reconstruir_consumo(cur)
+
+def _mig_006_contador_etiquetas(cur):
+    # Numeração das etiquetas passa a vir de contadores['etiqueta'] (ver alocar_numeros),
+    # começando do maior número já usado.
+    cur.execute("""
+        INSERT OR IGNORE INTO contadores (nome, valor)
+        SELECT 'etiqueta', COALESCE(MAX(numero_etiqueta), 0) FROM etiquetas
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_etq_numero ON etiquetas(numero_etiqueta)")
+
+def _mig_007_busca_itens(cur):
+    # Índice de texto (FTS5) sobre nome/código/CA, sem acento e sem caixa,
+    # espelhando `itens` (content=) e mantido pelos triggers abaixo.
+    # 'º'/'°' separam palavras: "BOTA Nº39" casa com "bota 39".
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS itens_fts USING fts5(
+            nome, codigo, ca,
+            content='itens', content_rowid='id',
+            tokenize="unicode61 remove_diacritics 2 separators 'º°'"
+        )
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_fts_ins AFTER INSERT ON itens
+        BEGIN
+            INSERT INTO itens_fts (rowid, nome, codigo, ca) VALUES (NEW.id, NEW.nome, NEW.codigo, NEW.ca);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_fts_del AFTER DELETE ON itens
+        BEGIN
+            INSERT INTO itens_fts (itens_fts, rowid, nome, codigo, ca) VALUES ('delete', OLD.id, OLD.nome, OLD.codigo, OLD.ca);
+        END
+    """)
+    # Baixa/reposição só mexem em saldo: o índice não é tocado
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_fts_upd AFTER UPDATE OF nome, codigo, ca ON itens
+        WHEN NEW.nome IS NOT OLD.nome OR NEW.codigo IS NOT OLD.codigo OR NEW.ca IS NOT OLD.ca
+        BEGIN
+            INSERT INTO itens_fts (itens_fts, rowid, nome, codigo, ca) VALUES ('delete', OLD.id, OLD.nome, OLD.codigo, OLD.ca);
+            INSERT INTO itens_fts (rowid, nome, codigo, ca) VALUES (NEW.id, NEW.nome, NEW.codigo, NEW.ca);
+        END
+    """)
+    cur.execute("INSERT INTO itens_fts (itens_fts) VALUES ('rebuild')")
+
+def _mig_008_versao_inventario(cur):
+    # contadores['inventario'] sobe a cada escrita em itens (saldo ou catálogo);
+    # itens.versao guarda a versão da última mudança de cada linha e
+    # itens_removidos os itens excluídos, para o modo delta de /api/itens.
+    cur.execute("INSERT OR IGNORE INTO contadores (nome, valor) VALUES ('inventario', 0)")
+    cols = [r[1] for r in cur.execute("PRAGMA table_info(itens)").fetchall()]
+    if "versao" not in cols:
+        cur.execute("ALTER TABLE itens ADD COLUMN versao INTEGER NOT NULL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_itens_versao ON itens(versao)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS itens_removidos (
+            item_id INTEGER PRIMARY KEY,
+            versao INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_inv_ins AFTER INSERT ON itens
+        BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE nome = 'inventario';
+            UPDATE itens SET versao = (SELECT valor FROM contadores WHERE nome = 'inventario') WHERE id = NEW.id;
+            DELETE FROM itens_removidos WHERE item_id = NEW.id;
+        END
+    """)
+    # "OF ..." sem a coluna versao: o UPDATE do próprio trigger não dispara de novo
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_inv_upd AFTER UPDATE OF nome, codigo, ca, saldo ON itens
+        WHEN NEW.nome IS NOT OLD.nome OR NEW.codigo IS NOT OLD.codigo
+          OR NEW.ca IS NOT OLD.ca OR NEW.saldo IS NOT OLD.saldo
+        BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE nome = 'inventario';
+            UPDATE itens SET versao = (SELECT valor FROM contadores WHERE nome = 'inventario') WHERE id = NEW.id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_itens_inv_del AFTER DELETE ON itens
+        BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE nome = 'inventario';
+            INSERT OR REPLACE INTO itens_removidos (item_id, versao)
+            SELECT OLD.id, valor FROM contadores WHERE nome = 'inventario';
+        END
+    """)
+
+def _mig_009_arquivo_movimentacoes(cur):
+    # Catálogo das partições do arquivo morto (ver arquivar_movimentacoes):
+    # um arquivo movimentacoes_<ano>.db por ano, com a faixa de datas que
+    # ele contém, para as consultas anexarem só os anos do período pedido.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS arquivo_movimentacoes (
+            ano          INTEGER PRIMARY KEY,
+            data_min     TEXT    NOT NULL,
+            data_max     TEXT    NOT NULL,
+            registros    INTEGER NOT NULL DEFAULT 0,
+            arquivado_em TEXT    NOT NULL DEFAULT (datetime('now','localtime'))
+        )
+    """)
+
+def _mig_010_destinatarios(cur):
+    # Destinatários em tabela própria: nome como foi digitado na 1ª vez e
+    # nome_norm (sem acento, caixa e espaços extras) único. movimentacoes
+    # aponta por id (filtros dos relatórios); o texto fica como histórico.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS destinatarios (
+            id        INTEGER PRIMARY KEY,
+            nome      TEXT NOT NULL,
+            nome_norm TEXT NOT NULL UNIQUE
+        )
+    """)
+    cols = [r[1] for r in cur.execute("PRAGMA table_info(movimentacoes)").fetchall()]
+    if "destinatario_id" not in cols:
+        cur.execute("ALTER TABLE movimentacoes ADD COLUMN destinatario_id INTEGER REFERENCES destinatarios (id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_mov_destid_data ON movimentacoes(destinatario_id, data, id)")
+    cur.execute("DROP INDEX IF EXISTS idx_mov_dest_data")   # filtro por texto não é mais usado
+    vincular_destinatarios(cur)
+
+def _mig_011_lancamentos_estoque(cur):
+    # Livro-razão do estoque: toda mudança de itens.saldo vira um lançamento
+    # com sinal (entrada, saida, ajuste), gravado na mesma transação pelo
+    # caminho que mexeu no saldo (ver lancar_estoque). `data` é a hora em que
+    # foi gravado (não a do bip), então cresce junto com o id e as fotos
+    # (estoque_fotos) nunca ficam desatualizadas por um lançamento atrasado.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS estoque_lancamentos (
+            id         INTEGER PRIMARY KEY,
+            item_id    INTEGER NOT NULL REFERENCES itens (id) ON DELETE CASCADE,
+            tipo       TEXT    NOT NULL CHECK (tipo IN ('entrada', 'saida', 'ajuste')),
+            quantidade INTEGER NOT NULL,              -- com sinal: saída é negativa
+            origem     TEXT    NOT NULL,              -- baixa, reposicao, importacao, cadastro, edicao, abertura
+            data       TEXT    NOT NULL DEFAULT (datetime('now','localtime'))
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_lanc_item_data ON estoque_lancamentos(item_id, data, id)")
+    # Foto do saldo de um item até o lançamento ate_id (inclusive)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS estoque_fotos (
+            item_id INTEGER NOT NULL REFERENCES itens (id) ON DELETE CASCADE,
+            ate_id  INTEGER NOT NULL,
+            data    TEXT    NOT NULL,
+            saldo   INTEGER NOT NULL,
+            PRIMARY KEY (item_id, ate_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fotos_item_data ON estoque_fotos(item_id, data)")
+    abrir_lancamentos(cur)
+
+def _mig_012_versao_movimentacoes(cur):
+    # contadores['movimentacoes'] sobe a cada linha gravada/alterada/apagada em
+    # movimentacoes (inclusive as que saem junto com o item). Somado ao de
+    # inventario forma versao_dados, que só cresce.
+    cur.execute("""
+        INSERT OR IGNORE INTO contadores (nome, valor)
+        SELECT 'movimentacoes', COALESCE(MAX(id), 0) FROM movimentacoes
+    """)
+    for evento in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_mov_versao_{evento.lower()} AFTER {evento} ON movimentacoes
+            BEGIN
+                UPDATE contadores SET valor = valor + 1 WHERE nome = 'movimentacoes';
+            END
+        """)
+
+def _mig_013_bips_recebidos(cur):
+    # Ids que o celular gera para cada bip da fila offline: o reenvio de um
+    # lote que o servidor já aplicou (resposta perdida) não baixa de novo.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bips_recebidos (
+            id          TEXT PRIMARY KEY,
+            recebido_em TEXT NOT NULL DEFAULT (datetime('now','localtime'))
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bips_recebido_em ON bips_recebidos(recebido_em)")
+
+MIGRACOES = [
+    (1, "tabelas base (itens, movimentacoes, etiquetas)", _mig_001_tabelas_base),
+    (2, "coluna itens.ca", _mig_002_coluna_ca),
+    (3, "contadores + versão do catálogo", _mig_003_versao_catalogo),
+    (4, "índices de movimentacoes para relatórios", _mig_004_indices_movimentacoes),
+    (5, "rollup consumo_diario", _mig_005_consumo_diario),
+    (6, "contador de número de etiqueta", _mig_006_contador_etiquetas),
+    (7, "busca de itens (FTS5)", _mig_007_busca_itens),
+    (8, "versão do inventário (itens.versao, itens_removidos)", _mig_008_versao_inventario),
+    (9, "catálogo do arquivo de movimentações", _mig_009_arquivo_movimentacoes),
+    (10, "tabela destinatarios + movimentacoes.destinatario_id", _mig_010_destinatarios),
+    (11, "livro-razão do estoque (lançamentos + fotos)", _mig_011_lancamentos_estoque),
+    (12, "contador de escritas em movimentacoes", _mig_012_versao_movimentacoes),
+    (13, "ids dos bips já recebidos (reenvio da fila offline)", _mig_013_bips_recebidos),
+]
+
+def versao_schema(conn) -> int:
+    return conn.execute("SELECT COALESCE(MAX(versao), 0) FROM schema_version").fetchone()[0]
+
+def aplicar_migracoes(conn) -> list:
+    """
+    Aplica as migrações pendentes, em ordem. Seguro com vários workers subindo
+    ao mesmo tempo: cada passo pega o lock de escrita (BEGIN IMMEDIATE) e
+    confere de novo a versão antes de rodar. Retorna as versões aplicadas.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versao      INTEGER PRIMARY KEY,
+            descricao   TEXT NOT NULL,
+            aplicada_em TEXT NOT NULL DEFAULT (datetime('now','localtime'))
+        )
+    """)
+    conn.commit()
+
+    aplicadas = []
+    for versao, descricao, migrar in MIGRACOES:
+        if versao <= versao_schema(conn):
+            continue
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if versao <= versao_schema(conn):   # outro processo aplicou antes
+                conn.rollback()
+                continue
+            migrar(cur)
+            cur.execute("INSERT INTO schema_version (versao, descricao) VALUES (?, ?)", (versao, descricao))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(versao)
+        app.logger.info("Migração %s aplicada: %s", versao, descricao)
+    return aplicadas
+
+def init_db():
+    conn = get_db_connection()
+    try:
+        aplicar_migracoes(conn)
+    finally:
+        conn.close()
+
+# ----------------- Índice do catálogo em memória -----------------
+class IndiceItens:
+    """
+    Catálogo de itens (id, nome, codigo, ca) em memória, por código e por id.
+    O saldo NÃO fica aqui: muda a cada bip e é sempre lido/gravado no SQL.
+
+    Coerência entre processos: contadores['catalogo'] é incrementado por trigger
+    em qualquer inclusão/exclusão ou mudança de nome/código/CA. Cada consulta
+    compara essa versão com a carregada e recarrega tudo se alguém mudou o catálogo.
+    As rotas que alteram itens chamam aplicar()/remover() logo após o commit,
+    o que atualiza só aquele item quando a mudança foi a única desde a última carga.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_codigo = {}
+        self._por_id = {}
+        self.versao = None
+        self._stats = {"hits": 0, "misses": 0, "recargas": 0, "atualizacoes": 0, "invalidacoes": 0}
+
+    @staticmethod
+    def _versao_banco(conn) -> int:
+        return conn.execute("SELECT valor FROM contadores WHERE nome = 'catalogo'").fetchone()[0]
+
+    def _sincronizar(self, conn) -> bool:
+        """Garante o índice na versão do banco. Retorna True se precisou recarregar."""
+        versao = self._versao_banco(conn)
+        if versao == self.versao:
+            return False
+        rows = conn.execute("SELECT id, nome, codigo, COALESCE(ca, '') AS ca FROM itens").fetchall()
+        with self._lock:
+            self._por_id = {r["id"]: dict(r) for r in rows}
+            self._por_codigo = {it["codigo"]: it for it in self._por_id.values()}
+            self.versao = versao
+            self._stats["recargas"] += 1
+        return True
+
+    def _consultar(self, conn, tabela, chave):
+        recarregou = self._sincronizar(conn)
+        with self._lock:
+            self._stats["misses" if recarregou else "hits"] += 1
+            return tabela().get(chave)
+
+    def por_codigo(self, conn, codigo):
+        return self._consultar(conn, lambda: self._por_codigo, codigo)
+
+    def por_id(self, conn, item_id):
+        return self._consultar(conn, lambda: self._por_id, item_id)
+
+    def _aplicar_delta(self, conn, alterar):
+        versao = self._versao_banco(conn)
+        with self._lock:
+            if self.versao is not None and versao == self.versao + 1:
+                alterar()
+                self.versao = versao
+                self._stats["atualizacoes"] += 1
+            else:
+                # outras mudanças no meio do caminho: recarrega na próxima consulta
+                self.versao = None
+                self._stats["invalidacoes"] += 1
+
+    def _tirar(self, item_id):
+        antigo = self._por_id.pop(item_id, None)
+        if antigo is not None:
+            self._por_codigo.pop(antigo["codigo"], None)
+
+    def aplicar(self, conn, item):
+        """Write-through após INSERT/UPDATE de UM item (já commitado)."""
+        novo = {"id": item["id"], "nome": item["nome"], "codigo": item["codigo"], "ca": item["ca"] or ""}
+
+        def alterar():
+            self._tirar(novo["id"])
+            self._por_id[novo["id"]] = novo
+            self._por_codigo[novo["codigo"]] = novo
+        self._aplicar_delta(conn, alterar)
+
+    def remover(self, conn, item_id):
+        """Write-through após DELETE de UM item (já commitado)."""
+        self._aplicar_delta(conn, lambda: self._tirar(item_id))
+
+    def invalidar(self):
+        with self._lock:
+            self.versao = None
+            self._stats["invalidacoes"] += 1
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+            dados["itens"] = len(self._por_id)
+            dados["versao"] = self.versao
+        return dados
+
+
+indice_itens = IndiceItens()
+
+def alocar_numeros(conn, nome: str, quantidade: int = 1) -> range:
+    """
+    Reserva `quantidade` números consecutivos do contador `nome` com um único
+    UPDATE ... RETURNING: atômico, dois requests/processos nunca recebem o mesmo número.
+    Roda dentro da transação que vai gravar os números (se ela falhar, nada é consumido).
+    """
+    fim = conn.execute(
+        "UPDATE contadores SET valor = valor + ? WHERE nome = ? RETURNING valor",
+        (quantidade, nome)
+    ).fetchone()[0]
+    return range(fim - quantidade + 1, fim + 1)
+
+def proximo_numero_etiqueta(conn) -> int:
+    return alocar_numeros(conn, "etiqueta")[0]
+
+def gerar_codigo_se_vazio(conn, codigo_informado: str) -> str:
+    """Se vazio, cria código interno sequencial EPI000001, EPI000002..."""
+    cod = (codigo_informado or "").strip()
+    if cod:
+        return cod
+    cur = conn.cursor()
+    cur.execute("SELECT IFNULL(MAX(id), 0) + 1 AS prox FROM itens")
+    prox = cur.fetchone()["prox"]
+    return f"EPI{prox:06d}"
+
+# ----------------- Destinatários (cadastro normalizado + índice de prefixo) -----------------
+DESTINATARIOS_LIMITE_MAX = 100
+
+def normalizar_nome(nome) -> str:
+    """Chave de destinatarios.nome_norm: '  José  da SILVA ' -> 'jose da silva'."""
+    txt = unicodedata.normalize("NFKD", str(nome or ""))
+    txt = "".join(ch for ch in txt if not unicodedata.combining(ch))
+    return " ".join(txt.casefold().split())
+
+def limpar_nome(nome) -> str:
+    """Nome para exibição: sem espaços nas pontas nem repetidos."""
+    return " ".join(str(nome or "").split())
+
+def vincular_destinatarios(cur, origem="main.movimentacoes"):
+    """
+    Preenche destinatario_id onde ainda é NULL em `origem` (migração, banco
+    gerado em massa, arquivo antigo), cadastrando os destinatários que faltam.
+    Grafias diferentes do mesmo nome ('Fabio'/'Fábio ') viram um destinatário
+    só, e o consumo_diario delas é somado na grafia do cadastro.
+    """
+    cur.connection.create_function("normalizar_nome", 1, normalizar_nome, deterministic=True)
+    cur.execute("DROP TABLE IF EXISTS temp._dest_mapa")
+    cur.execute(f"""
+        CREATE TEMP TABLE _dest_mapa AS
+        SELECT destinatario AS grafia, normalizar_nome(destinatario) AS norm, MIN(id) AS primeiro
+        FROM {origem}
+        WHERE destinatario_id IS NULL
+        GROUP BY destinatario
+    """)
+    cur.execute("CREATE INDEX temp._dest_mapa_grafia ON _dest_mapa(grafia)")
+    novos = cur.execute("""
+        SELECT grafia, norm FROM _dest_mapa
+        WHERE norm <> '' AND norm NOT IN (SELECT nome_norm FROM main.destinatarios)
+        ORDER BY primeiro
+    """).fetchall()
+    cur.executemany("INSERT OR IGNORE INTO main.destinatarios (nome, nome_norm) VALUES (?, ?)",
+                    [(limpar_nome(g), n) for g, n in novos])
+    cur.execute(f"""
+        UPDATE {origem} SET destinatario_id = (
+            SELECT d.id FROM _dest_mapa x JOIN main.destinatarios d ON d.nome_norm = x.norm
+            WHERE x.grafia = movimentacoes.destinatario
+        )
+        WHERE destinatario_id IS NULL
+    """)
+
+    # consumo_diario é por texto (NOCASE): as outras grafias passam para a do cadastro
+    cur.execute("DROP TABLE IF EXISTS temp._dest_troca")
+    cur.execute("""
+        CREATE TEMP TABLE _dest_troca AS
+        SELECT x.grafia, d.nome FROM _dest_mapa x JOIN main.destinatarios d ON d.nome_norm = x.norm
+        WHERE x.grafia <> d.nome COLLATE NOCASE
+        GROUP BY x.grafia COLLATE NOCASE
+    """)
+    cur.execute("""
+        INSERT INTO main.consumo_diario (item_id, destinatario, dia, quantidade, movimentos)
+        SELECT c.item_id, t.nome, c.dia, c.quantidade, c.movimentos
+        FROM main.consumo_diario c JOIN _dest_troca t ON c.destinatario = t.grafia
+        WHERE 1
+        ON CONFLICT (item_id, destinatario, dia) DO UPDATE
+           SET quantidade = quantidade + excluded.quantidade,
+               movimentos = movimentos + excluded.movimentos
+    """)
+    cur.execute("DELETE FROM main.consumo_diario WHERE destinatario IN (SELECT grafia FROM _dest_troca)")
+    cur.execute("DROP TABLE temp._dest_troca")
+    cur.execute("DROP TABLE temp._dest_mapa")
+
+class IndiceDestinatarios:
+    """
+    Destinatários em memória, ordenados por nome_norm: autocomplete por prefixo
+    com bisect (O(log n) + resultados) e nome -> id para os filtros.
+
+    Destinatários nunca são apagados nem renomeados, então o maior id basta
+    como versão: cada consulta compara com o banco e só lê os novos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chaves = []       # nome_norm, ordenado
+        self._linhas = []       # (id, nome), na mesma ordem de _chaves
+        self._por_norm = {}     # nome_norm -> (id, nome)
+        self._max_id = None
+        self._stats = {"consultas": 0, "recargas": 0, "novos": 0}
+
+    def sincronizar(self, conn):
+        """Traz os destinatários criados desde a última leitura (fora de transação de escrita)."""
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM destinatarios").fetchone()[0]
+        if max_id == self._max_id:
+            return
+        if getattr(conn, "somente_leitura", False) and self._max_id is not None and max_id < self._max_id:
+            return   # cópia de relatórios é mais velha: o índice já tem tudo o que ela tem
+        with self._lock:
+            if self._max_id is None or max_id < self._max_id:   # 1ª carga ou banco trocado
+                rows = conn.execute("SELECT id, nome, nome_norm FROM destinatarios ORDER BY nome_norm").fetchall()
+                self._chaves = [r[2] for r in rows]
+                self._linhas = [(r[0], r[1]) for r in rows]
+                self._por_norm = {r[2]: (r[0], r[1]) for r in rows}
+                self._stats["recargas"] += 1
+            else:
+                rows = conn.execute("SELECT id, nome, nome_norm FROM destinatarios WHERE id > ?",
+                                    (self._max_id,)).fetchall()
+                for r in rows:
+                    if r[2] in self._por_norm:
+                        continue
+                    i = bisect.bisect_left(self._chaves, r[2])
+                    self._chaves.insert(i, r[2])
+                    self._linhas.insert(i, (r[0], r[1]))
+                    self._por_norm[r[2]] = (r[0], r[1])
+                self._stats["novos"] += len(rows)
+            self._max_id = max_id
+
+    def prefixo(self, conn, texto, limite=20) -> list:
+        """Destinatários cujo nome (normalizado) começa com `texto`, em ordem alfabética."""
+        self.sincronizar(conn)
+        p = normalizar_nome(texto)
+        with self._lock:
+            self._stats["consultas"] += 1
+            i = bisect.bisect_left(self._chaves, p)
+            saida = []
+            while i < len(self._chaves) and len(saida) < limite and self._chaves[i].startswith(p):
+                saida.append({"id": self._linhas[i][0], "nome": self._linhas[i][1]})
+                i += 1
+        return saida
+
+    def buscar(self, conn, nome):
+        """(id, nome do cadastro) do destinatário digitado, ou None."""
+        self.sincronizar(conn)
+        with self._lock:
+            return self._por_norm.get(normalizar_nome(nome))
+
+    def garantir(self, conn, nome):
+        """
+        (id, nome do cadastro), cadastrando se for novo; nome vazio -> (None, '').
+        Roda dentro da transação da baixa: NÃO mexe na memória (se ela for
+        desfeita, o id não existe); o próximo sincronizar() traz o novo.
+        """
+        norm = normalizar_nome(nome)
+        if not norm:
+            return None, ""
+        with self._lock:
+            achado = self._por_norm.get(norm)
+        if achado:
+            return achado
+        row = conn.execute("""
+            INSERT INTO destinatarios (nome, nome_norm) VALUES (?, ?)
+            ON CONFLICT (nome_norm) DO UPDATE SET nome = nome
+            RETURNING id, nome
+        """, (limpar_nome(nome), norm)).fetchone()
+        return row[0], row[1]
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+            dados["destinatarios"] = len(self._chaves)
+        return dados
+
+indice_destinatarios = IndiceDestinatarios()
+
+# ----------------- Livro-razão do estoque (lançamentos + fotos) -----------------
+ESTOQUE_FOTO_LANCAMENTOS = int(os.environ.get("EPI_FOTO_LANCAMENTOS", "200"))  # lançamentos por item entre fotos
+
+def lancar_estoque(conn, lancamentos):
+    """
+    Grava lançamentos [(item_id, tipo, quantidade com sinal, origem)] na
+    transação de quem chama (junto com o UPDATE do saldo). Quantidade 0 é ignorada.
+    """
+    linhas = [l for l in lancamentos if l[2]]
+    if linhas:
+        conn.executemany(
+            "INSERT INTO estoque_lancamentos (item_id, tipo, quantidade, origem) VALUES (?, ?, ?, ?)", linhas)
+        fotografo_estoque.contar(l[0] for l in linhas)
+
+def abrir_lancamentos(cur):
+    """Lançamento de abertura (ajuste = saldo atual) para itens que ainda não têm nenhum."""
+    cur.execute("""
+        INSERT INTO estoque_lancamentos (item_id, tipo, quantidade, origem)
+        SELECT id, 'ajuste', saldo, 'abertura' FROM itens
+        WHERE saldo <> 0 AND id NOT IN (SELECT item_id FROM estoque_lancamentos)
+    """)
+
+def saldo_em(conn, item_id: int, quando: str) -> int:
+    """
+    Saldo do item no instante `quando` ('AAAA-MM-DD' = fim do dia, ou
+    'AAAA-MM-DD HH:MM:SS'): a foto mais recente até lá + os lançamentos
+    entre ela e `quando` (no máximo ~ESTOQUE_FOTO_LANCAMENTOS, se as fotos
+    estão em dia). Antes do primeiro lançamento, 0.
+    """
+    if len(quando) == 10:
+        quando += " 23:59:59"
+    foto = conn.execute("""
+        SELECT ate_id, data, saldo FROM estoque_fotos
+        WHERE item_id = ? AND data <= ?
+        ORDER BY data DESC, ate_id DESC LIMIT 1
+    """, (item_id, quando)).fetchone()
+    ate_id, desde, saldo = foto if foto else (0, "", 0)
+    resto = conn.execute("""
+        SELECT COALESCE(SUM(quantidade), 0) FROM estoque_lancamentos
+        WHERE item_id = ? AND data >= ? AND data <= ? AND id > ?
+    """, (item_id, desde, quando, ate_id)).fetchone()[0]
+    return saldo + resto
+
+def fotografar_estoque(conn, minimo=ESTOQUE_FOTO_LANCAMENTOS, itens=None) -> int:
+    """
+    Grava uma foto para cada item com `minimo` lançamentos ou mais desde a
+    última (uma passada pelos lançamentos novos). `itens`: só esses ids.
+    Devolve quantas gravou.
+    """
+    filtro_fotos, filtro_lanc, params = "", "", []
+    if itens is not None:
+        itens = list(itens)
+        marcas = ",".join("?" * len(itens))
+        filtro_fotos = f"WHERE item_id IN ({marcas})"
+        filtro_lanc = f"AND l.item_id IN ({marcas})"
+        params = itens * 2
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute(f"""
+            INSERT INTO estoque_fotos (item_id, ate_id, data, saldo)
+            SELECT l.item_id, MAX(l.id), MAX(l.data), COALESCE(f.saldo, 0) + SUM(l.quantidade)
+            FROM estoque_lancamentos l
+            LEFT JOIN (
+                SELECT item_id, MAX(ate_id) AS ate_id FROM estoque_fotos {filtro_fotos} GROUP BY item_id
+            ) u ON u.item_id = l.item_id
+            LEFT JOIN estoque_fotos f ON f.item_id = u.item_id AND f.ate_id = u.ate_id
+            WHERE l.id > COALESCE(u.ate_id, 0) {filtro_lanc}
+            GROUP BY l.item_id
+            HAVING COUNT(*) >= ?
+        """, (*params, minimo))
+        gravadas = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return gravadas
+
+class FotografoEstoque:
+    """
+    Fotos automáticas, sem depender do cron: lancar_estoque conta os
+    lançamentos de cada item gravados por este processo e, a cada `a_cada`,
+    põe o item numa fila. Uma thread por processo (criada no primeiro uso,
+    como o escritor de baixas) grava as fotos fora do request, numa transação
+    curta própria. A contagem é por processo: com vários workers a foto pode
+    sair um pouco depois; `flask fotografar-estoque` continua cobrindo o resto.
+    """
+
+    def __init__(self, a_cada=ESTOQUE_FOTO_LANCAMENTOS):
+        self.a_cada = a_cada
+        self._lock = threading.Lock()
+        self._contagem = {}
+        self._fila = None
+        self._pid = None
+        self._stats = {"fotos": 0, "falhas": 0}
+
+    def contar(self, item_ids):
+        prontos = []
+        with self._lock:
+            for item_id in item_ids:
+                n = self._contagem.get(item_id, 0) + 1
+                if n >= self.a_cada:
+                    prontos.append(item_id)
+                    n = 0
+                self._contagem[item_id] = n
+            if prontos and self._pid != os.getpid():   # workers nascem por fork
+                self._fila = queue.Queue()
+                threading.Thread(target=self._rodar, name="fotografo-estoque", daemon=True).start()
+                self._pid = os.getpid()
+        for item_id in prontos:
+            self._fila.put(item_id)
+
+    def _rodar(self):
+        fila = self._fila
+        while True:
+            itens = {fila.get()}
+            while True:
+                try:
+                    itens.add(fila.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                conn = get_db_connection()
+                try:
+                    gravadas = fotografar_estoque(conn, 1, itens=sorted(itens))
+                finally:
+                    conn.close()
+            except Exception:   # a thread não pode morrer; o cron ainda cobre esses itens
+                app.logger.exception("Fotos automáticas do estoque: falha")
+                with self._lock:
+                    self._stats["falhas"] += 1
+                continue
+            with self._lock:
+                self._stats["fotos"] += gravadas
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+        dados["a_cada"] = self.a_cada
+        dados["na_fila"] = self._fila.qsize() if self._fila is not None else 0
+        return dados
+
+fotografo_estoque = FotografoEstoque()
+
+def verificar_estoque(conn) -> list:
+    """
+    Recalcula o saldo de todos os itens pelo livro-razão (uma passada pelos
+    lançamentos, na ordem do índice) e devolve os que não batem com itens.saldo.
+    """
+    return [dict(r) for r in conn.execute("""
+        SELECT i.id, i.codigo, i.nome, i.saldo, COALESCE(l.soma, 0) AS razao, COALESCE(l.lancamentos, 0) AS lancamentos
+        FROM itens i
+        LEFT JOIN (
+            SELECT item_id, SUM(quantidade) AS soma, COUNT(*) AS lancamentos
+            FROM estoque_lancamentos GROUP BY item_id
+        ) l ON l.item_id = i.id
+        WHERE i.saldo <> COALESCE(l.soma, 0)
+        ORDER BY i.id
+    """)]
+
+@app.cli.command("verificar-estoque")
+def cli_verificar_estoque():
+    """Confere itens.saldo contra a soma dos lançamentos (sai com código 1 se algo não bate)."""
+    init_db()
+    conn = get_db_connection()
+    try:
+        divergentes = verificar_estoque(conn)
+        total = conn.execute("SELECT COUNT(*) FROM itens").fetchone()[0]
+    finally:
+        conn.close()
+    for d in divergentes:
+        print(f"{d['codigo']} ({d['nome']}): saldo {d['saldo']}, livro-razão {d['razao']} "
+              f"(diferença {d['saldo'] - d['razao']:+d}, {d['lancamentos']} lançamento(s))")
+    print(f"{total} item(ns) conferido(s), {len(divergentes)} divergente(s).")
+    if divergentes:
+        sys.exit(1)
+
+@app.cli.command("fotografar-estoque")
+@click.option("--minimo", type=int, default=ESTOQUE_FOTO_LANCAMENTOS, show_default=True,
+              help="Lançamentos desde a última foto para fotografar o item.")
+def cli_fotografar_estoque(minimo):
+    """Grava fotos de saldo por item (as automáticas seguem as baixas; isto pega o resto, ex.: cron diário)."""
+    init_db()
+    conn = get_db_connection()
+    try:
+        gravadas = fotografar_estoque(conn, minimo)
+    finally:
+        conn.close()
+    print(f"{gravadas} foto(s) gravada(s).")
+
+# ----------------- Busca de itens (FTS5) -----------------
+LISTA_ITENS_MAX = 200   # linhas renderizadas de cara nas telas de baixa/reposição
+BUSCA_LIMITE_MAX = 200
+
+def consulta_fts(q: str) -> str:
+    """
+    Texto digitado -> expressão MATCH: cada palavra vira prefixo ("lu"* "nitr"*),
+    todas obrigatórias. Só letras/dígitos entram, então aspas/operadores do usuário não quebram o FTS.
+    """
+    return " ".join(f'"{t}"*' for t in re.findall(r"\w+", q or ""))
+
+def buscar_itens(conn, q: str, limite=LISTA_ITENS_MAX) -> list:
+    """
+    Itens por nome/código/CA (prefixo, sem acento), mais relevantes primeiro;
+    código idêntico ao digitado vem no topo. Sem termo -> ordem alfabética.
+    limite=None -> sem limite.
+    """
+    lim = -1 if limite is None else int(limite)
+    consulta = consulta_fts(q)
+    if not consulta:
+        return conn.execute("""
+            SELECT id, nome, codigo, COALESCE(ca, '') AS ca, COALESCE(saldo, 0) AS saldo
+            FROM itens ORDER BY nome COLLATE NOCASE LIMIT ?
+        """, (lim,)).fetchall()
+    return conn.execute("""
+        SELECT i.id, i.nome, i.codigo, COALESCE(i.ca, '') AS ca, COALESCE(i.saldo, 0) AS saldo
+        FROM itens_fts f JOIN itens i ON i.id = f.rowid
+        WHERE itens_fts MATCH ?
+        ORDER BY i.codigo = ? COLLATE NOCASE DESC, bm25(itens_fts, 1.0, 4.0, 2.0), i.nome COLLATE NOCASE
+        LIMIT ?
+    """, (consulta, (q or "").strip(), lim)).fetchall()
+
+# ----------------- Versão do inventário -----------------
+def versao_inventario(conn) -> int:
+    return conn.execute("SELECT valor FROM contadores WHERE nome = 'inventario'").fetchone()[0]
+
+class CacheInventario:
+    """
+    Listas de itens das telas (baixa, itens, reposição) guardadas junto com a
+    versão do inventário em que foram lidas. Enquanto contadores['inventario']
+    não muda, um GET custa só a leitura do contador.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listas = {}
+        self._stats = {"hits": 0, "misses": 0}
+
+    def listar(self, conn, nome: str, carregar):
+        return self.listar_com_versao(conn, nome, carregar)[1]
+
+    def listar_com_versao(self, conn, nome: str, carregar):
+        """(versão, linhas) — a versão é exatamente a das linhas devolvidas."""
+        versao = versao_inventario(conn)
+        with self._lock:
+            guardada = self._listas.get(nome)
+            if guardada and guardada[0] == versao:
+                self._stats["hits"] += 1
+                return guardada
+            self._stats["misses"] += 1
+        # versão e linhas lidas no mesmo snapshot
+        proprio = not conn.in_transaction
+        if proprio:
+            conn.execute("BEGIN")
+        try:
+            versao = versao_inventario(conn)
+            rows = carregar(conn)
+        finally:
+            if proprio:
+                conn.commit()
+        with self._lock:
+            self._listas[nome] = (versao, rows)
+        return versao, rows
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, listas={k: v[0] for k, v in self._listas.items()})
+
+cache_inventario = CacheInventario()
 
-def get_db_connection():
-    conn = sqlite3.connect('estoque.db')
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+def itens_da_tela(conn, com_versao: bool = False):
+    """Primeira página de itens das telas de baixa/reposição (cacheada por versão).
+    com_versao=True -> (versão, linhas)."""
+    versao, rows = cache_inventario.listar_com_versao(conn, "tela", lambda c: buscar_itens(c, ""))
+    return (versao, rows) if com_versao else rows
 
-def init_db():
-    with get_db_connection() as conn:
-        cur = conn.cursor()
+# ----------------- Eventos ao vivo (SSE) -----------------
+EVENTOS_FILA = int(os.environ.get("EPI_EVENTOS_FILA", "256"))               # eventos por cliente
+EVENTOS_HEARTBEAT = float(os.environ.get("EPI_EVENTOS_HEARTBEAT", "15"))    # segundos
+EVENTOS_CLIENTES_MAX = int(os.environ.get("EPI_EVENTOS_CLIENTES", "64"))     # streams abertos por worker
+EVENTOS_DURACAO_MAX = float(os.environ.get("EPI_EVENTOS_DURACAO", "600"))   # s; depois o stream fecha e o navegador reconecta
+# Com vários workers o barramento não cruza processos: cada stream confere a
+# versão do inventário a cada EVENTOS_VERIFICA s ociosos e avisa se outro worker mudou algo.
+EVENTOS_VERIFICA = float(os.environ.get("EPI_EVENTOS_VERIFICA", "2"))
 
-        # Itens de EPI
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS itens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT NOT NULL,
-                codigo TEXT UNIQUE NOT NULL,
-                saldo INTEGER NOT NULL
-            )
-        ''')
-
-        # Histórico de saídas
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS movimentacoes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                item_id INTEGER NOT NULL,
-                quantidade INTEGER NOT NULL,
-                destinatario TEXT NOT NULL,
-                data TEXT NOT NULL,
-                FOREIGN KEY (item_id) REFERENCES itens (id)
-            )
-        ''')
-
-        # Fila de etiquetas a imprimir depois
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS etiquetas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                item_id INTEGER NOT NULL,
-                codigo TEXT NOT NULL,
-                nome TEXT NOT NULL,
-                numero_etiqueta INTEGER NOT NULL,
-                status TEXT NOT NULL DEFAULT 'pendente',  -- 'pendente' | 'impresso'
-                criado_em TEXT DEFAULT (datetime('now','localtime')),
-                impresso_em TEXT,
-                FOREIGN KEY (item_id) REFERENCES itens (id) ON DELETE CASCADE
-            )
-        ''')
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_etq_status ON etiquetas(status)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_etq_item   ON etiquetas(item_id)")
+class _Assinante:
+    __slots__ = ("fila", "atrasado")
 
-        conn.commit()
-def ensure_ca_column(db_path='epi.db'):
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
-    try:
-        # roda uma única vez; nas próximas dará OperationalError e ignoramos
-        cur.execute("ALTER TABLE itens ADD COLUMN CA TEXT;")
-        con.commit()
-    except sqlite3.OperationalError:
-        pass
-    finally:
-        con.close()
+    def __init__(self):
+        self.fila = queue.Queue(maxsize=EVENTOS_FILA)
+        self.atrasado = False
 
-def proximo_numero_etiqueta(conn) -> int:
-    cur = conn.cursor()
-    cur.execute("SELECT COALESCE(MAX(numero_etiqueta), 0) + 1 FROM etiquetas")
-    return cur.fetchone()[0]
+class BarramentoEventos:
+    """
+    Pub/sub em memória (por processo) para /api/stream.
+    Cada cliente tem uma fila limitada: quem não consome a tempo não segura
+    ninguém — é marcado como atrasado, perde os eventos e recebe um 'resync'
+    (o terminal então busca /api/itens?since=<versão que tinha>).
+    """
 
-def gerar_codigo_se_vazio(conn, codigo_informado: str) -> str:
-    """Se vazio, cria código interno sequencial EPI000001, EPI000002..."""
-    cod = (codigo_informado or "").strip()
-    if cod:
-        return cod
-    cur = conn.cursor()
-    cur.execute("SELECT IFNULL(MAX(id), 0) + 1 AS prox FROM itens")
-    prox = cur.fetchone()["prox"]
-    return f"EPI{prox:06d}"
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assinantes = set()
+        self._seq = 0
+        self._stats = {"publicados": 0, "descartados": 0, "recusados": 0}
 
-def salvar_barcode_png(
-    codigo: str,
-    *,
-    module_width: float = 0.15,
-    module_height: float = 8.0,
-    font_size: int = 6,
-    text_distance: float = 0.8,
-    quiet_zone: float = 1.0,
-    write_text: bool = False,   # <<< DESLIGA texto na imagem
-    force: bool = False
-) -> str:
-    filename_sem_ext = os.path.join(BARCODE_DIR, codigo)
-    path_png = f"{filename_sem_ext}.png"
-
-    if not force and os.path.exists(path_png):
-        return path_png
+    def assinar(self):
+        """Novo assinante, ou None se já há EVENTOS_CLIENTES_MAX neste processo."""
+        a = _Assinante()
+        with self._lock:
+            if len(self._assinantes) >= EVENTOS_CLIENTES_MAX:
+                self._stats["recusados"] += 1
+                return None
+            self._assinantes.add(a)
+        return a
 
-    try:
-        if os.path.exists(path_png):
-            os.remove(path_png)
-    except Exception:
-        pass
+    def cancelar(self, a: _Assinante):
+        with self._lock:
+            self._assinantes.discard(a)
 
-    writer = ImageWriter()
-    options = {
-        "module_width": module_width,
-        "module_height": module_height,
-        "font_size": font_size,
-        "text_distance": text_distance,
-        "quiet_zone": quiet_zone,
-        "write_text": write_text,   # <<< aqui
-    }
+    def publicar(self, tipo: str, dados: dict):
+        with self._lock:
+            self._seq += 1
+            evento = (self._seq, tipo, dados)
+            assinantes = list(self._assinantes)
+            self._stats["publicados"] += 1
+        for a in assinantes:
+            if a.atrasado:
+                continue
+            try:
+                a.fila.put_nowait(evento)
+            except queue.Full:
+                a.atrasado = True
+                with self._lock:
+                    self._stats["descartados"] += 1
 
-    b = Code39(codigo, writer=writer, add_checksum=False)
-    b.save(filename_sem_ext, options=options)
-    return path_png
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, clientes=len(self._assinantes))
 
+eventos = BarramentoEventos()
 
-def buscar_movimentacoes(destinatario=None, data_ini=None, data_fim=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def publicar_inventario(conn):
+    """Mudança de catálogo ou em massa: avisa a versão nova (o cliente busca o delta).
+    Chamar antes de conn.close()."""
+    eventos.publicar("inventario", {"versao": versao_inventario(conn)})
 
-    sql = """
-      SELECT m.id, i.nome AS item_nome, i.codigo AS item_codigo,
-             m.quantidade, m.destinatario, m.data
-      FROM movimentacoes m
-      JOIN itens i ON i.id = m.item_id
-      WHERE 1=1
+def formatar_sse(tipo: str, dados: dict, seq=None) -> str:
+    linhas = [f"event: {tipo}"]
+    if seq is not None:
+        linhas.append(f"id: {seq}")
+    linhas.append("data: " + json.dumps(dados, ensure_ascii=False, separators=(",", ":")))
+    return "\n".join(linhas) + "\n\n"
+
+# ----------------- Cache de códigos de barras -----------------
+BARCODE_CACHE_MEMORIA = int(os.environ.get("EPI_BARCODE_CACHE", "512"))  # imagens na LRU
+BARCODE_CODIGO_MAX = 64   # /barcode é público: código maior que isso nem é renderizado
+
+# Opções padrão das etiquetas
+BARCODE_OPCOES = {
+    "module_width": 0.15,
+    "module_height": 8.0,
+    "font_size": 6,
+    "text_distance": 0.8,
+    "quiet_zone": 1.0,
+    "write_text": False,   # <<< DESLIGA texto na imagem
+}
+
+def renderizar_barcode(codigo: str, formato: str = "png", **opcoes) -> bytes:
+    """Renderiza Code39 em memória (png via Pillow, svg sem Pillow)."""
+    t0 = time.perf_counter()
+    writer = ImageWriter() if formato == "png" else SVGWriter()
+    bio = BytesIO()
+    Code39(codigo, writer=writer, add_checksum=False).write(bio, options=opcoes)
+    metricas.observar("epi_barcode_render_seconds", time.perf_counter() - t0, formato=formato)
+    return bio.getvalue()
+
+
+class CacheBarcodes:
+    """
+    Cache de códigos de barras endereçado pelo conteúdo:
+    chave = sha1(formato, código, opções do writer) — mudou alguma opção, muda a chave.
+    Guarda numa LRU em memória os bytes das últimas N imagens e só renderiza
+    (python-barcode/Pillow) quando a chave não está lá.
     """
+
+    def __init__(self, max_memoria=BARCODE_CACHE_MEMORIA):
+        self.max_memoria = max_memoria
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits_memoria": 0, "renders": 0, "tempo_render_s": 0.0}
+
+    @staticmethod
+    def chave(codigo: str, formato: str, opcoes: dict) -> str:
+        base = json.dumps([formato, codigo, sorted(opcoes.items())], ensure_ascii=False)
+        return hashlib.sha1(base.encode("utf-8")).hexdigest()
+
+    def _contar(self, campo, valor=1):
+        with self._lock:
+            self._stats[campo] += valor
+
+    def _guardar_memoria(self, chave, dados):
+        with self._lock:
+            self._lru[chave] = dados
+            self._lru.move_to_end(chave)
+            while len(self._lru) > self.max_memoria:
+                self._lru.popitem(last=False)
+
+    def obter(self, codigo: str, formato: str = "png", **opcoes):
+        """Retorna (chave, bytes) da imagem, renderizando só se necessário."""
+        opcoes = {**BARCODE_OPCOES, **opcoes}
+        chave = self.chave(codigo, formato, opcoes)
+
+        with self._lock:
+            dados = self._lru.get(chave)
+            if dados is not None:
+                self._lru.move_to_end(chave)
+                self._stats["hits_memoria"] += 1
+                return chave, dados
+
+        t0 = time.perf_counter()
+        dados = renderizar_barcode(codigo, formato, **opcoes)
+        self._contar("renders")
+        self._contar("tempo_render_s", time.perf_counter() - t0)
+
+        self._guardar_memoria(chave, dados)
+        return chave, dados
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+            dados["memoria_itens"] = len(self._lru)
+            dados["memoria_bytes"] = sum(len(v) for v in self._lru.values())
+        dados["tempo_render_s"] = round(dados["tempo_render_s"], 4)
+        return dados
+
+
+cache_barcodes = CacheBarcodes()
+
+
+def filtro_movimentacoes(conn, destinatario=None, data_ini=None, data_fim=None):
+    """Monta o WHERE (sobre `movimentacoes m`) e os parâmetros dos filtros de relatório."""
+    sql = "1=1"
     params = []
 
+    # Predicados "sargable": comparam a coluna pura, então usam os índices
+    # idx_mov_destid_data / idx_mov_data. O destinatário digitado vira id
+    # pelo índice em memória (sem acento/caixa); desconhecido -> nada.
     if destinatario:
-        sql += " AND LOWER(m.destinatario) = LOWER(?)"
-        params.append(destinatario.strip())
+        achado = indice_destinatarios.buscar(conn, destinatario)
+        sql += " AND m.destinatario_id = ?"
+        params.append(achado[0] if achado else -1)
 
+    # m.data é 'AAAA-MM-DD HH:MM:SS': faixa de texto equivale a comparar o dia
     if data_ini:
-        sql += " AND substr(m.data,1,10) >= ?"
+        sql += " AND m.data >= ?"
         params.append(data_ini.strip())
 
     if data_fim:
-        sql += " AND substr(m.data,1,10) <= ?"
+        sql += " AND m.data <= ?"
+        params.append(data_fim.strip() + " 23:59:59")
+
+    return sql, params
+
+
+def iterar_movimentacoes(destinatario=None, data_ini=None, data_fim=None, limite=None, antes=None, depois=None):
+    """
+    Gera as movimentações filtradas direto do cursor, em lotes (memória constante,
+    serve para exportar qualquer volume). Ordem: data DESC, id DESC — exceto com
+    `depois`, que vem em ordem crescente (ver buscar_movimentacoes).
+
+    Inclui o arquivo morto: percorre o período em segmentos (segmentos_movimentacoes)
+    e só anexa o arquivo de um ano quando a leitura chega nele — a 1ª página de
+    um relatório sem filtro nunca sai do banco principal.
+    """
+    conn = conexao_relatorio()
+    try:
+        where, params = filtro_movimentacoes(conn, destinatario, data_ini, data_fim)
+        ordem = "DESC"
+        if antes:
+            where += " AND (m.data, m.id) < (?, ?)"
+            params += list(antes)
+        elif depois:
+            where += " AND (m.data, m.id) > (?, ?)"
+            params += list(depois)
+            ordem = "ASC"
+
+        segmentos = segmentos_movimentacoes(conn, data_ini, data_fim)
+        if ordem == "ASC":
+            segmentos.reverse()
+        restante = int(limite) if limite else None
+        for ini, fim, ano in segmentos:
+            # segmento inteiro do outro lado do cursor: nem consulta (nem anexa)
+            if antes and ini and antes[0] < ini:
+                continue
+            if depois and fim and depois[0] >= fim:
+                continue
+            w, p = where, list(params)
+            if ini:
+                w += " AND m.data >= ?"
+                p.append(ini)
+            if fim:
+                w += " AND m.data < ?"
+                p.append(fim)
+            if ano is None:
+                sql = _SQL_MOVIMENTACOES.format(origem="main.movimentacoes", where=w)
+                sql += f" ORDER BY m.data {ordem}, m.id {ordem}"
+            else:
+                # UNION ALL ordenado: o SQLite intercala os dois lados já em ordem de índice
+                # (linha já copiada para o arquivo e ainda no principal — arquivamento em
+                # andamento, ou cópia de relatórios anterior a ele — sai só uma vez)
+                sql = (_SQL_MOVIMENTACOES.format(origem="main.movimentacoes", where=w) + " UNION ALL "
+                       + _SQL_MOVIMENTACOES.format(origem="arq.movimentacoes", where=w + _SQL_FORA_DO_PRINCIPAL))
+                sql += f" ORDER BY 6 {ordem}, 1 {ordem}"   # data, id
+                p = p + p
+            if restante is not None:
+                sql += " LIMIT ?"
+                p.append(restante)
+
+            if ano is None:
+                lidas = yield from _ler_em_lotes(conn.execute(sql, tuple(p)))
+            else:
+                with anexar_arquivo(conn, ano) as ok:
+                    if not ok:
+                        continue
+                    lidas = yield from _ler_em_lotes(conn.execute(sql, tuple(p)))
+            if restante is not None:
+                restante -= lidas
+                if restante <= 0:
+                    break
+    finally:
+        conn.close()
+
+
+_SQL_MOVIMENTACOES = """
+      SELECT m.id, i.nome AS item_nome, i.codigo AS item_codigo,
+             m.quantidade, m.destinatario, m.data
+      FROM {origem} m
+      JOIN main.itens i ON i.id = m.item_id
+      WHERE {where}
+"""
+
+_SQL_FORA_DO_PRINCIPAL = " AND NOT EXISTS (SELECT 1 FROM main.movimentacoes x WHERE x.id = m.id)"
+
+def _ler_em_lotes(cur, tamanho=500):
+    """Repassa as linhas do cursor em lotes; devolve quantas leu. Fecha o cursor ao sair."""
+    lidas = 0
+    try:
+        while True:
+            lote = cur.fetchmany(tamanho)
+            if not lote:
+                return lidas
+            lidas += len(lote)
+            yield from lote
+    finally:
+        cur.close()
+
+
+def buscar_movimentacoes(destinatario=None, data_ini=None, data_fim=None, limite=None, antes=None, depois=None):
+    """
+    Movimentações filtradas, mais novas primeiro (ORDER BY data DESC, id DESC).
+    Paginação por chave (keyset) em (data, id) — a página N custa o mesmo que a 1ª:
+      antes=(data, id)  -> próximas `limite` linhas MAIS ANTIGAS que o cursor
+      depois=(data, id) -> `limite` linhas MAIS NOVAS que o cursor (volta de página)
+    Para exportar tudo, use iterar_movimentacoes (não carrega a lista inteira).
+    """
+    rows = list(iterar_movimentacoes(destinatario, data_ini, data_fim, limite, antes, depois))
+    if depois:
+        rows.reverse()  # devolve sempre mais novos primeiro
+    return rows
+
+
+def resumir_movimentacoes(destinatario=None, data_ini=None, data_fim=None):
+    """
+    Totais do filtro, lidos do rollup consumo_diario (custa dias x itens,
+    não o número de movimentações). Os filtros de relatório são por dia e
+    destinatário, que é exatamente a granularidade do rollup.
+    """
+    conn = conexao_relatorio()
+    where, params = filtro_consumo(conn, destinatario, data_ini, data_fim)
+    row = conn.execute(f"""
+        SELECT COALESCE(SUM(c.movimentos), 0)  AS registros,
+               COALESCE(SUM(c.quantidade), 0)  AS quantidade,
+               COUNT(DISTINCT c.destinatario)  AS destinatarios,
+               COUNT(DISTINCT c.item_id)       AS itens
+        FROM consumo_diario c
+        WHERE {where}
+    """, tuple(params)).fetchone()
+    conn.close()
+    return dict(row)
+
+
+# ----------------- Consumo diário (rollup) -----------------
+def reconstruir_consumo(cur):
+    """Refaz consumo_diario a partir de movimentacoes (histórico existente / conferência)."""
+    cur.execute("DELETE FROM consumo_diario")
+    somar_consumo(cur, "main.movimentacoes")
+
+def somar_consumo(cur, origem):
+    """Soma em consumo_diario as movimentações de `origem` (tabela do principal ou de um arquivo)."""
+    # destinatário pelo nome do cadastro (a migração 5 roda antes de a tabela existir)
+    if cur.execute("SELECT 1 FROM main.sqlite_master WHERE name = 'destinatarios'").fetchone():
+        nome, junta = "COALESCE(d.nome, m.destinatario)", "LEFT JOIN main.destinatarios d ON d.id = m.destinatario_id"
+    else:
+        nome, junta = "m.destinatario", ""
+    # itens já excluídos ficam de fora (FK); WHERE obrigatório antes do ON CONFLICT
+    cur.execute(f"""
+        INSERT INTO consumo_diario (item_id, destinatario, dia, quantidade, movimentos)
+        SELECT m.item_id, {nome}, substr(m.data, 1, 10), SUM(m.quantidade), COUNT(*)
+        FROM {origem} m {junta}
+        WHERE m.item_id IN (SELECT id FROM main.itens)
+        GROUP BY m.item_id, 2 COLLATE NOCASE, 3
+        ON CONFLICT (item_id, destinatario, dia) DO UPDATE
+           SET quantidade = quantidade + excluded.quantidade,
+               movimentos = movimentos + excluded.movimentos
+    """)
+
+def filtro_consumo(conn, destinatario=None, data_ini=None, data_fim=None, item_id=None):
+    """WHERE (sobre `consumo_diario c`) com os mesmos filtros dos relatórios."""
+    sql, params = "1=1", []
+    if destinatario:
+        # o rollup guarda o nome do cadastro (ver vincular_destinatarios)
+        achado = indice_destinatarios.buscar(conn, destinatario)
+        sql += " AND c.destinatario = ?" if achado else " AND 0"
+        params += [achado[1]] if achado else []
+    if data_ini:
+        sql += " AND c.dia >= ?"
+        params.append(data_ini.strip())
+    if data_fim:
+        sql += " AND c.dia <= ?"
         params.append(data_fim.strip())
+    if item_id:
+        sql += " AND c.item_id = ?"
+        params.append(int(item_id))
+    return sql, params
 
-    # 👉 agora mais novos primeiro
-    sql += " ORDER BY m.data DESC, m.id DESC"
+CONSUMO_PERIODOS = {"dia": "c.dia", "mes": "substr(c.dia, 1, 7)", "ano": "substr(c.dia, 1, 4)"}
+CONSUMO_AGRUPAMENTOS = {
+    "total":        ([], []),
+    "item":         (["c.item_id", "i.nome AS item_nome", "i.codigo AS item_codigo"], ["c.item_id"]),
+    "destinatario": (["c.destinatario"], ["c.destinatario"]),
+    "item_destinatario": (["c.item_id", "i.nome AS item_nome", "i.codigo AS item_codigo", "c.destinatario"],
+                          ["c.item_id", "c.destinatario"]),
+}
 
-    cur.execute(sql, tuple(params))
-    rows = cur.fetchall()
+def consumo_por_periodo(periodo="dia", agrupar="total", destinatario=None, data_ini=None, data_fim=None, item_id=None):
+    """
+    Consumo somado por período (dia/mes/ano) e, opcionalmente, por item e/ou destinatário.
+    Ex.: quantas luvas por pessoa por mês -> periodo="mes", agrupar="item_destinatario".
+    """
+    expr_periodo = CONSUMO_PERIODOS[periodo]
+    colunas, grupo = CONSUMO_AGRUPAMENTOS[agrupar]
+    conn = conexao_relatorio()
+    where, params = filtro_consumo(conn, destinatario, data_ini, data_fim, item_id)
+
+    sql = f"""
+        SELECT {expr_periodo} AS periodo, {"".join(c + ", " for c in colunas)}
+               SUM(c.quantidade) AS quantidade, SUM(c.movimentos) AS movimentos
+        FROM consumo_diario c
+        JOIN itens i ON i.id = c.item_id
+        WHERE {where}
+        GROUP BY {", ".join(["periodo"] + grupo)}
+        ORDER BY periodo, quantidade DESC
+    """
+    rows = [dict(r) for r in conn.execute(sql, tuple(params))]
     conn.close()
     return rows
 
+@app.cli.command("reconstruir-consumo")
+def cli_reconstruir_consumo():
+    """Recalcula o rollup consumo_diario a partir de todas as movimentações."""
+    init_db()
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        reconstruir_consumo(cur)
+        conn.commit()
+        # movimentações já arquivadas somam por cima, um ano por vez
+        for (ano,) in conn.execute("SELECT ano FROM arquivo_movimentacoes ORDER BY ano").fetchall():
+            with anexar_arquivo(conn, ano) as ok:
+                if ok:
+                    cur = conn.cursor()
+                    cur.execute("BEGIN IMMEDIATE")
+                    somar_consumo(cur, "arq.movimentacoes")
+                    conn.commit()
+                    cur.close()
+        total = conn.execute("SELECT COUNT(*) FROM consumo_diario").fetchone()[0]
+    finally:
+        conn.close()
+    print(f"consumo_diario reconstruído: {total} linha(s).")
+
+
+# ----------------- Arquivo morto (movimentações antigas, um banco por ano) -----------------
+ARQUIVO_DIR = os.environ.get("EPI_ARQUIVO_DIR", "")              # padrão: pasta 'arquivo' ao lado do banco
+ARQUIVO_DIAS = int(os.environ.get("EPI_ARQUIVO_DIAS", "365"))    # o que for mais velho que isto é arquivado
+ARQUIVO_LOTE = 5000                                              # linhas movidas por transação
+
+def pasta_arquivo() -> str:
+    return ARQUIVO_DIR or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "arquivo")
+
+def caminho_arquivo(ano: int) -> str:
+    return os.path.join(pasta_arquivo(), f"movimentacoes_{ano:04d}.db")
+
+@contextmanager
+def anexar_arquivo(conn, ano, criar=False):
+    """
+    ATTACH do arquivo do ano como `arq` na conexão (um ano por vez: o SQLite
+    limita os bancos anexados). Devolve False se o arquivo não existe e
+    criar=False. O DETACH no fim exige que os cursores sobre `arq` estejam fechados.
+    """
+    caminho = caminho_arquivo(ano)
+    if not criar and not os.path.exists(caminho):
+        app.logger.warning("Arquivo de movimentações %s não encontrado: ano ignorado.", caminho)
+        yield False
+        return
+    if any(r[1] == "arq" for r in conn.execute("PRAGMA database_list")):
+        conn.execute("DETACH DATABASE arq")   # sobra de um DETACH que falhou
+    if criar:
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS arq", (caminho,))
+    try:
+        _atualizar_arquivo(conn)
+        yield True
+    finally:
+        try:
+            conn.execute("DETACH DATABASE arq")
+        except sqlite3.Error:
+            pass   # fica anexado; o próximo anexar_arquivo desanexa
+
+def segmentos_movimentacoes(conn, data_ini=None, data_fim=None) -> list:
+    """
+    Divide o período em segmentos (ini, fim, ano), mais novos primeiro, com
+    ini inclusivo / fim exclusivo ('AAAA-MM-DD'; None = sem limite).
+    ano=None: só o banco principal; ano=N: banco principal + arquivo de N
+    (o principal pode ter linhas antigas que chegaram depois do arquivamento).
+    Só entram os anos do catálogo cuja faixa cruza [data_ini, data_fim].
+    """
+    sql, params = "SELECT ano FROM arquivo_movimentacoes WHERE registros > 0", []
+    if data_ini:
+        sql += " AND data_max >= ?"
+        params.append(data_ini.strip())
+    if data_fim:
+        sql += " AND data_min <= ?"
+        params.append(data_fim.strip() + " 23:59:59")
+    anos = [r[0] for r in conn.execute(sql + " ORDER BY ano DESC", tuple(params))]
+
+    segmentos, topo = [], None
+    for ano in anos:
+        ini, fim = f"{ano:04d}-01-01", f"{ano + 1:04d}-01-01"
+        if topo is None or topo > fim:
+            segmentos.append((fim, topo, None))
+        segmentos.append((ini, fim, ano))
+        topo = ini
+    segmentos.append((None, topo, None))
+    return segmentos
+
+def _criar_tabela_arquivo(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS arq.movimentacoes (
+            id           INTEGER PRIMARY KEY,   -- mesmo id do banco principal
+            item_id      INTEGER NOT NULL,
+            quantidade   INTEGER NOT NULL,
+            destinatario TEXT    NOT NULL,
+            data         TEXT    NOT NULL,
+            destinatario_id INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS arq.idx_mov_data ON movimentacoes(data, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS arq.idx_mov_destid_data ON movimentacoes(destinatario_id, data, id)")
+    conn.commit()
+
+def _atualizar_arquivo(conn):
+    """Arquivo de antes da tabela destinatarios: ganha destinatario_id (uma vez só)."""
+    cols = [r[1] for r in conn.execute("PRAGMA arq.table_info(movimentacoes)")]
+    if not cols or "destinatario_id" in cols:
+        return
+    conn.execute("ALTER TABLE arq.movimentacoes ADD COLUMN destinatario_id INTEGER")
+    conn.execute("DROP INDEX IF EXISTS arq.idx_mov_dest_data")
+    conn.execute("CREATE INDEX IF NOT EXISTS arq.idx_mov_destid_data ON movimentacoes(destinatario_id, data, id)")
+    cur = conn.cursor()
+    vincular_destinatarios(cur, "arq.movimentacoes")
+    conn.commit()
+
+def arquivar_movimentacoes(conn, ate: str, lote=ARQUIVO_LOTE) -> dict:
+    """
+    Move as movimentações com data < `ate` ('AAAA-MM-DD') para os arquivos
+    por ano. Devolve {ano: linhas movidas}.
+
+    Em lotes curtos, para não segurar o lock de escrita contra as baixas:
+      1. copia o lote para o arquivo do ano (INSERT OR IGNORE pelo id) e commita;
+      2. numa transação só do banco principal, atualiza o catálogo e apaga o lote.
+    Transações com bancos anexados em WAL não são atômicas entre arquivos, daí
+    a ordem: se cair entre 1 e 2, as linhas continuam no principal e o arquivo
+    não as anuncia no catálogo; rodar de novo termina o serviço.
+    O rollup consumo_diario não muda (não há trigger de DELETE).
+    """
+    movidas = {}
+    while True:
+        row = conn.execute("SELECT MIN(data) FROM movimentacoes WHERE data < ?", (ate,)).fetchone()
+        if row[0] is None:
+            break
+        ano = int(row[0][:4])
+        ini, fim = f"{ano:04d}-01-01", min(ate, f"{ano + 1:04d}-01-01")
+        with anexar_arquivo(conn, ano, criar=True):
+            _criar_tabela_arquivo(conn)
+            while True:
+                chaves = conn.execute("""
+                    SELECT id, data FROM main.movimentacoes
+                    WHERE data >= ? AND data < ? ORDER BY data, id LIMIT ?
+                """, (ini, fim, lote)).fetchall()
+                if not chaves:
+                    break
+                ids = [r[0] for r in chaves]
+                marcas = ",".join("?" * len(ids))
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO arq.movimentacoes (id, item_id, quantidade, destinatario, data, destinatario_id)
+                    SELECT id, item_id, quantidade, destinatario, data, destinatario_id FROM main.movimentacoes
+                    WHERE id IN ({marcas})
+                """, ids)
+                conn.commit()
+
+                conn.execute("""
+                    INSERT INTO arquivo_movimentacoes (ano, data_min, data_max, registros)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (ano) DO UPDATE
+                       SET data_min = min(data_min, excluded.data_min),
+                           data_max = max(data_max, excluded.data_max),
+                           registros = registros + excluded.registros,
+                           arquivado_em = datetime('now','localtime')
+                """, (ano, chaves[0][1], chaves[-1][1], len(ids)))
+                conn.execute(f"DELETE FROM main.movimentacoes WHERE id IN ({marcas})", ids)
+                conn.commit()
+                movidas[ano] = movidas.get(ano, 0) + len(ids)
+    return movidas
+
+@app.cli.command("arquivar")
+@click.option("--dias", type=int, default=None,
+              help=f"Arquiva o que for mais velho que N dias (padrão: EPI_ARQUIVO_DIAS={ARQUIVO_DIAS}).")
+@click.option("--ate", default=None, help="Arquiva o que for anterior a esta data (AAAA-MM-DD).")
+@click.option("--vacuum", is_flag=True, help="Compacta o banco principal no fim.")
+def cli_arquivar(dias, ate, vacuum):
+    """Move movimentações antigas para arquivo/movimentacoes_<ano>.db."""
+    if not ate:
+        ate = (datetime.now() - timedelta(days=ARQUIVO_DIAS if dias is None else dias)).strftime("%Y-%m-%d")
+    init_db()
+    conn = get_db_connection()
+    try:
+        movidas = arquivar_movimentacoes(conn, ate)
+        limpar_bips_recebidos(conn)
+        if vacuum and movidas:
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+    for ano, n in sorted(movidas.items()):
+        print(f"{ano}: {n} movimentação(ões) -> {caminho_arquivo(ano)}")
+    print(f"Arquivadas {sum(movidas.values())} movimentação(ões) anteriores a {ate}.")
+
+
+def cursor_para_texto(mv) -> str:
+    return f"{mv['data']}|{mv['id']}"
+
+def texto_para_cursor(txt):
+    """'AAAA-MM-DD HH:MM:SS|123' -> ('AAAA-MM-DD HH:MM:SS', 123); inválido -> None."""
+    data, _, mid = (txt or "").rpartition("|")
+    if not data or not mid.isdigit():
+        return None
+    return data, int(mid)
+
 
 # --- util: converte 'DD/MM/AAAA' -> 'AAAA-MM-DD' (ou retorna '' se vazio/invalid) ---
 def br_to_iso(d: str) -> str:
@@ -209,28 +2172,260 @@ def br_to_iso(d: str) -> str:
         pass
     return ""  # se inválida, não aplica filtro
 
+MAX_SCANS_LOTE = 500  # limite de bips por chamada em /api/baixa
+BIP_ID_MAX = 64       # tamanho máximo do id de bip gerado pelo celular
+BIPS_RECEBIDOS_DIAS = int(os.environ.get("EPI_BIPS_RECEBIDOS_DIAS", "30"))  # quanto tempo lembrar dos ids
+
+def limpar_bips_recebidos(conn, dias=BIPS_RECEBIDOS_DIAS) -> int:
+    """Esquece ids de bips mais velhos que `dias` (a fila do celular não fica parada tanto tempo)."""
+    limite = (datetime.now() - timedelta(days=dias)).strftime("%Y-%m-%d %H:%M:%S")
+    cur = conn.execute("DELETE FROM bips_recebidos WHERE recebido_em < ?", (limite,))
+    conn.commit()
+    return cur.rowcount
+
+def registrar_baixas(conn, scans):
+    """
+    Aplica várias baixas em UMA transação de escrita (BEGIN IMMEDIATE).
+    - Resolve os códigos pelo índice em memória (IndiceItens), sem SELECT por bip.
+    - Decremento condicional feito no próprio SQL (sem ler-calcular-gravar no Python);
+      o saldo nunca fica negativo (para em 0, como antes). Só quando não há
+      saldo suficiente o item é lido, para lançar o que saiu de fato.
+    - Insere todas as movimentações com executemany e faz UM commit.
+    - Bip com "id" já visto (bips_recebidos) não baixa de novo: volta ok com
+      "duplicado": True e o saldo atual.
+
+    scans: lista de dicts {"codigo", "destinatario", "data" (opcional), "quantidade" (opcional),
+    "id" (opcional)}.
+    Retorna uma lista na mesma ordem:
+      {"ok": True, "id", "nome", "codigo", "saldo"}  ou  {"ok": False, "codigo", "erro"}.
+    """
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    codigos = sorted({s["codigo"] for s in scans if s.get("codigo")})
+    indice_destinatarios.sincronizar(conn)
+
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        # códigos resolvidos pelo índice em memória (já dentro do lock de escrita)
+        itens = {c: indice_itens.por_codigo(conn, c) for c in codigos}
+        # destinatários: id + nome do cadastro (cadastra os novos nesta transação)
+        destinos = {}
+        for s in scans:
+            nome = s.get("destinatario") or ""
+            if nome not in destinos:
+                destinos[nome] = indice_destinatarios.garantir(conn, nome)
+
+        resultados, movimentos, lancamentos = [], [], []
+        for s in scans:
+            codigo = s.get("codigo") or ""
+            item = itens.get(codigo)
+            linha = None
+            if item is not None and s.get("id"):
+                cur.execute("INSERT OR IGNORE INTO bips_recebidos (id) VALUES (?)", (s["id"],))
+                if cur.rowcount == 0:
+                    atual = cur.execute("SELECT saldo FROM itens WHERE id = ?", (item["id"],)).fetchone()
+                    resultados.append({"ok": True, "id": item["id"], "nome": item["nome"], "codigo": codigo,
+                                       "saldo": atual[0] if atual else 0, "duplicado": True})
+                    continue
+            if item is not None:
+                qtd = saiu = s.get("quantidade") or 1
+                linha = cur.execute(
+                    "UPDATE itens SET saldo = saldo - ? WHERE id = ? AND saldo >= ? RETURNING saldo",
+                    (qtd, item["id"], qtd)).fetchone()
+                if linha is None:
+                    # não tinha o bastante (ou o item sumiu): para em 0 e lança só o que havia
+                    atual = cur.execute("SELECT saldo FROM itens WHERE id = ?", (item["id"],)).fetchone()
+                    if atual is not None:
+                        saiu = atual[0] or 0
+                        linha = cur.execute("UPDATE itens SET saldo = 0 WHERE id = ? RETURNING saldo",
+                                            (item["id"],)).fetchone()
+            if linha is None:
+                erro = f"Código {codigo} não encontrado." if codigo else "Código vazio"
+                resultados.append({"ok": False, "codigo": codigo, "erro": erro})
+                continue
+            saldo = linha["saldo"]
+            lancamentos.append((item["id"], "saida", -saiu, "baixa"))
+
+            dest_id, dest_nome = destinos[s.get("destinatario") or ""]
+            movimentos.append((item["id"], qtd, dest_nome, s.get("data") or agora, dest_id))
+            resultados.append({"ok": True, "id": item["id"], "nome": item["nome"], "codigo": codigo, "saldo": saldo})
+
+        if movimentos:
+            cur.executemany(
+                "INSERT INTO movimentacoes (item_id, quantidade, destinatario, data, destinatario_id) VALUES (?, ?, ?, ?, ?)",
+                movimentos
+            )
+            lancar_estoque(conn, lancamentos)
+            versao = versao_inventario(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if movimentos:
+        ok = [r for r in resultados if r["ok"] and not r.get("duplicado")]
+        # saldo final de cada item (o último bip do lote vale)
+        saldos = {r["id"]: r["saldo"] for r in ok}
+        eventos.publicar("saldo", {"versao": versao,
+                                   "itens": [{"id": i, "saldo": sd} for i, sd in saldos.items()]})
+        eventos.publicar("movimentos", {"movimentos": [
+            {"item_id": r["id"], "nome": r["nome"], "codigo": r["codigo"],
+             "quantidade": m[1], "destinatario": m[2], "data": m[3]}
+            for r, m in zip(ok, movimentos)
+        ]})
+    return resultados
+
+# ----------------- Group commit das baixas (opcional) -----------------
+GRUPO_COMMIT = os.environ.get("EPI_GROUP_COMMIT", "0") == "1"
+GRUPO_JANELA_MS = float(os.environ.get("EPI_GRUPO_JANELA_MS", "2"))  # quanto o escritor espera juntando bips
+GRUPO_MAX = int(os.environ.get("EPI_GRUPO_MAX", "200"))             # bips por transação (um lote da API nunca é dividido)
+GRUPO_ESPERA = 30                                                    # segundos que o request espera o resultado
+
+class EscritorBaixas:
+    """
+    Thread única que grava as baixas em grupo: junta os envios que chegam em
+    GRUPO_JANELA_MS (ou até GRUPO_MAX bips) e aplica tudo num só
+    registrar_baixas — uma transação e um commit (um fsync) para o grupo.
+    Cada request espera o Future do seu envio e recebe só os seus resultados,
+    na mesma ordem e no mesmo formato do modo direto.
+
+    Conexão própria, fora do pool: os requests parados esperando já seguram
+    conexões do pool, e o escritor não pode disputar com eles.
+    """
+
+    def __init__(self, janela_ms=GRUPO_JANELA_MS, maximo=GRUPO_MAX):
+        self.janela = janela_ms / 1000
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._fila = None
+        self._pid = None
+        self._conn = None
+        self._pool = None
+        self._stats = {"envios": 0, "bips": 0, "transacoes": 0, "maior_grupo": 0, "reaplicados": 0}
+
+    def enviar(self, scans) -> Future:
+        """Enfileira uma lista de bips; o Future devolve a lista de resultados de registrar_baixas."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():   # 1º envio neste processo (workers nascem por fork)
+                    self._fila = queue.Queue()
+                    threading.Thread(target=self._rodar, name="escritor-baixas", daemon=True).start()
+                    self._pid = os.getpid()
+        futuro = Future()
+        self._fila.put((scans, futuro))
+        return futuro
+
+    def _rodar(self):
+        while True:
+            grupo = [self._fila.get()]
+            bips = len(grupo[0][0])
+            limite = time.monotonic() + self.janela
+            while bips < self.maximo:
+                resta = limite - time.monotonic()
+                try:
+                    envio = self._fila.get(timeout=resta) if resta > 0 else self._fila.get_nowait()
+                except queue.Empty:
+                    break
+                grupo.append(envio)
+                bips += len(envio[0])
+            try:
+                self._aplicar(grupo)
+            except Exception:   # a thread não pode morrer: os requests ficariam esperando
+                app.logger.exception("Escritor de baixas: falha inesperada")
+                for _, futuro in grupo:
+                    if not futuro.done():
+                        futuro.set_exception(RuntimeError("falha no escritor de baixas"))
+
+    def _conexao(self):
+        pool = get_pool()
+        if self._conn is None or self._pool is not pool:   # reiniciar_pool trocou o banco
+            if self._conn is not None:
+                sqlite3.Connection.close(self._conn)
+            self._conn = pool._nova()
+            self._conn._pool = None   # close() de verdade, não volta para o pool
+            self._pool = pool
+        return self._conn
+
+    def _aplicar(self, grupo):
+        todos = [s for scans, _ in grupo for s in scans]
+        try:
+            resultados = registrar_baixas(self._conexao(), todos)
+        except Exception as e:
+            if len(grupo) > 1:
+                # o grupo foi desfeito inteiro: reaplica envio por envio,
+                # para um problema não derrubar os bips dos outros
+                with self._lock:
+                    self._stats["reaplicados"] += len(grupo)
+                for envio in grupo:
+                    self._aplicar([envio])
+                return
+            grupo[0][1].set_exception(e)
+            return
+
+        with self._lock:
+            self._stats["envios"] += len(grupo)
+            self._stats["bips"] += len(todos)
+            self._stats["transacoes"] += 1
+            self._stats["maior_grupo"] = max(self._stats["maior_grupo"], len(todos))
+        metricas.observar("epi_baixas_grupo_bips", len(todos))
+        pos = 0
+        for scans, futuro in grupo:
+            futuro.set_result(resultados[pos:pos + len(scans)])
+            pos += len(scans)
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+        dados["ativo"] = GRUPO_COMMIT
+        dados["na_fila"] = self._fila.qsize() if self._fila is not None else 0
+        dados["bips_por_transacao"] = round(dados["bips"] / dados["transacoes"], 2) if dados["transacoes"] else 0
+        return dados
+
+escritor_baixas = EscritorBaixas()
+
+def aplicar_baixas(scans):
+    """
+    registrar_baixas pelo caminho configurado: com EPI_GROUP_COMMIT=1 vai pelo
+    escritor em grupo (e espera o resultado); senão, transação própria na
+    conexão do request.
+    """
+    if GRUPO_COMMIT:
+        return escritor_baixas.enviar(scans).result(timeout=GRUPO_ESPERA)
+    conn = get_db_connection()
+    try:
+        return registrar_baixas(conn, scans)
+    finally:
+        conn.close()
+
+def normalizar_data_scan(ts) -> str:
+    """
+    Converte o horário enviado pelo leitor para 'AAAA-MM-DD HH:MM:SS' (hora local).
+    Aceita epoch (segundos ou milissegundos, como Date.now()) ou ISO 8601.
+    Vazio -> None (usa a hora do servidor). Inválido -> ValueError.
+    """
+    if ts in (None, ""):
+        return None
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        segundos = ts / 1000 if ts > 1e11 else ts
+        dt = datetime.fromtimestamp(segundos)
+    else:
+        dt = datetime.fromisoformat(str(ts).strip().replace("Z", "+00:00"))
+        if dt.tzinfo is not None:
+            dt = dt.astimezone().replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
 # -----------------Tela de BAIXA automática -----------------
 @app.route("/", methods=["GET", "POST"])
 @login_required_for(methods=("POST",))
 def baixa_automatica():
-    # helper para listar itens
-    def listar_itens():
+    # helper para listar itens (primeiros LISTA_ITENS_MAX; o resto vem pela busca /api/itens/search)
+    # + versão do inventário da lista, para o terminal se atualizar por /api/stream
+    def dados_tela():
         conn = get_db_connection()
-        cur = conn.cursor()
-        # Garante que sempre venha CA e SALDO "seguros" ('' e 0 quando nulos)
-        cur.execute("""
-            SELECT 
-                id,
-                nome,
-                codigo,
-                COALESCE(ca, '')     AS ca,
-                COALESCE(saldo, 0)    AS saldo
-            FROM itens
-            ORDER BY nome COLLATE NOCASE
-        """)
-        itens = cur.fetchall()
+        # CA e SALDO "seguros" ('' e 0 quando nulos)
+        versao, itens = itens_da_tela(conn, com_versao=True)
         conn.close()
-        return itens
+        return {"itens": itens, "versao": versao}
 
     # Detecta AJAX (para devolver JSON)
     wants_json = (
@@ -245,39 +2440,89 @@ def baixa_automatica():
         if not codigo:
             if wants_json:
                 return jsonify({"ok": False, "erro": "Código vazio"}), 400
-            return render_template("baixa.html", erro="Código vazio", itens=listar_itens())
+            return render_template("baixa.html", erro="Código vazio", **dados_tela())
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM itens WHERE codigo = ?", (codigo,))
-        item = cur.fetchone()
-        if not item:
-            conn.close()
+        item = aplicar_baixas([{"codigo": codigo, "destinatario": destinatario}])[0]
+        if not item["ok"]:
             if wants_json:
                 return jsonify({"ok": False, "erro": f"Código {codigo} não encontrado."}), 404
-            return render_template("baixa.html", erro=f"Código {codigo} não encontrado.", itens=listar_itens())
-
-        # 🔒 Blindagem: se saldo vier NULL, trata como 0
-        saldo_atual = item["saldo"] if item["saldo"] is not None else 0
-        novo = max(0, saldo_atual - 1)
-
-        cur.execute("UPDATE itens SET saldo = ? WHERE id = ?", (novo, item["id"]))
-        cur.execute(
-            "INSERT INTO movimentacoes (item_id, quantidade, destinatario, data) VALUES (?, ?, ?, ?)",
-            (item["id"], 1, destinatario, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        )
-        conn.commit()
-        conn.close()
+            return render_template("baixa.html", erro=f"Código {codigo} não encontrado.", **dados_tela())
 
+        novo = item["saldo"]
         msg_ok = f"{item['nome']} (-1) para {destinatario or 'Sem nome'}. Saldo: {novo}"
 
         if wants_json:
             return jsonify({"ok": True, "restante": novo, "msg": msg_ok})
 
-        return render_template("baixa.html", ok=True, msg=msg_ok, itens=listar_itens())
+        return render_template("baixa.html", ok=True, msg=msg_ok, **dados_tela())
 
     # GET normal
-    return render_template("baixa.html", itens=listar_itens())
+    return render_template("baixa.html", **dados_tela())
+
+
+# ----------------- API de baixa (celular / leitores em lote) -----------------
+@app.route("/api/baixa", methods=["POST"])
+@api_login_required
+def api_baixa():
+    """
+    Body JSON:
+      { "codigo": "...", "destinatario": "...", "timestamp": ... }            -> 1 bip
+      [ {codigo, destinatario, timestamp}, ... ]                             -> lote
+      { "destinatario": "...", "scans": [ {codigo, timestamp}, ... ] }       -> lote
+    Cada bip pode trazer um "id" (o celular gera um por leitura da fila): bip
+    com id já recebido não baixa de novo, então reenviar o mesmo lote é seguro.
+    O lote inteiro é aplicado em UMA transação; o retorno traz o resultado de cada bip.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        return jsonify({"ok": False, "erro": "JSON inválido."}), 400
+
+    unico = isinstance(data, dict) and "scans" not in data
+    if unico:
+        brutos, dest_padrao = [data], ""
+    elif isinstance(data, dict):
+        brutos, dest_padrao = data.get("scans") or [], (data.get("destinatario") or "")
+    else:
+        brutos, dest_padrao = data, ""
+
+    if not isinstance(brutos, list) or not brutos:
+        return jsonify({"ok": False, "erro": "Nenhum bip enviado."}), 400
+    if len(brutos) > MAX_SCANS_LOTE:
+        return jsonify({"ok": False, "erro": f"Máximo de {MAX_SCANS_LOTE} bips por lote."}), 413
+
+    scans, invalidos = [], {}
+    for pos, b in enumerate(brutos):
+        if not isinstance(b, dict):
+            invalidos[pos] = {"ok": False, "codigo": "", "erro": "Bip inválido."}
+            continue
+        codigo = str(b.get("codigo") or "").strip()
+        bip_id = str(b.get("id") or "").strip()
+        if len(bip_id) > BIP_ID_MAX:
+            invalidos[pos] = {"ok": False, "codigo": codigo, "erro": "id do bip inválido."}
+            continue
+        try:
+            data_scan = normalizar_data_scan(b.get("timestamp"))
+        except (ValueError, TypeError, OverflowError, OSError):
+            invalidos[pos] = {"ok": False, "codigo": codigo, "erro": "timestamp inválido."}
+            continue
+        scans.append({
+            "codigo": codigo,
+            "destinatario": str(b.get("destinatario") or dest_padrao).strip(),
+            "data": data_scan,
+            "id": bip_id or None,
+        })
+
+    aplicados = iter(aplicar_baixas(scans) if scans else [])
+    resultados = [invalidos[pos] if pos in invalidos else next(aplicados) for pos in range(len(brutos))]
+
+    if unico:
+        r = resultados[0]
+        if not r["ok"]:
+            return jsonify(r), (400 if invalidos or not r["codigo"] else 404)
+        return jsonify({"ok": True, "item": r["nome"], "codigo": r["codigo"], "saldo": r["saldo"], "restante": r["saldo"]})
+
+    aplicadas = sum(1 for r in resultados if r["ok"])
+    return jsonify({"ok": True, "aplicadas": aplicadas, "falhas": len(resultados) - aplicadas, "resultados": resultados})
 
 
 #-------------login------------------
@@ -344,11 +2589,13 @@ def novo_item():
 
         # Inserir novo item
         cur.execute("INSERT INTO itens (nome, codigo, saldo) VALUES (?, ?, ?)", (nome, codigo, saldo))
+        lancar_estoque(conn, [(cur.lastrowid, "entrada", saldo, "cadastro")])
         conn.commit()
+        indice_itens.aplicar(conn, {"id": cur.lastrowid, "nome": nome, "codigo": codigo, "ca": ""})
+        publicar_inventario(conn)
         conn.close()
 
-        # Gera etiqueta
-        salvar_barcode_png(codigo, force=True)
+        # A etiqueta (código de barras) é gerada na hora por /barcode/<codigo>
         mensagem = f"Item cadastrado: {nome} (cód. {codigo}), saldo {saldo}."
         etiqueta_codigo = codigo
 
@@ -362,7 +2609,7 @@ def novo_item():
 def repor():
     """
     Reposição por LISTA com BUSCA:
-    - GET: aceita parâmetro q (nome/código) e filtra a tabela.
+    - GET: aceita parâmetro q (nome/código/CA, busca FTS) e filtra a tabela.
     - POST:
         a) Se vier item_id e qtd -> atualiza apenas aquele item (botão por linha)
         b) Caso contrário -> modo antigo em lote (varre todos os campos qtd_<id>)
@@ -385,34 +2632,26 @@ def repor():
         cur.execute("SELECT id, nome, saldo, codigo FROM itens WHERE id = ?", (item_id,))
         it = cur.fetchone()
         if not it:
-            conn.close()
             # volta com erro simples
             q = (request.form.get("q") or "").strip()
-            # recarrega lista
-            conn2 = get_db_connection(); cur2 = conn2.cursor()
-            if q:
-                like = f"%{q}%"
-                cur2.execute("""SELECT * FROM itens WHERE nome LIKE ? OR codigo LIKE ? ORDER BY nome""", (like, like))
-            else:
-                cur2.execute("SELECT * FROM itens ORDER BY nome")
-            itens = cur2.fetchall(); conn2.close()
+            # recarrega lista (mesma conexão do request)
+            itens = buscar_itens(conn, q); conn.close()
             return render_template("repor.html", itens=itens, q=q, resumo="Item não encontrado.")
 
         resumo = "Nenhuma quantidade informada."
         if qtd > 0:
-            novo = it["saldo"] + qtd
-            cur.execute("UPDATE itens SET saldo = ? WHERE id = ?", (novo, it["id"]))
+            # soma no SQL (e não saldo lido + qtd): uma baixa no meio do caminho não se perde
+            novo = cur.execute("UPDATE itens SET saldo = saldo + ? WHERE id = ? RETURNING saldo",
+                               (qtd, it["id"])).fetchone()[0]
+            lancar_estoque(conn, [(it["id"], "entrada", qtd, "reposicao")])
+            versao = versao_inventario(conn)
             conn.commit()
+            eventos.publicar("saldo", {"versao": versao, "itens": [{"id": it["id"], "saldo": novo}]})
             resumo = f"{it['nome']} +{qtd} (→ {novo})"
 
         # Após salvar 1 item, recarrega a lista (com o mesmo filtro q, se houver)
         q = (request.form.get("q") or "").strip()
-        if q:
-            like = f"%{q}%"
-            cur.execute("""SELECT * FROM itens WHERE nome LIKE ? OR codigo LIKE ? ORDER BY nome""", (like, like))
-        else:
-            cur.execute("SELECT * FROM itens ORDER BY nome")
-        itens = cur.fetchall()
+        itens = buscar_itens(conn, q)
         conn.close()
         return render_template("repor.html", itens=itens, q=q, resumo=resumo)
 
@@ -433,32 +2672,214 @@ def repor():
             except ValueError:
                 qtd = 0
             if qtd > 0:
-                novo = it["saldo"] + qtd
-                cur.execute("UPDATE itens SET saldo = ? WHERE id = ?", (novo, it["id"]))
-                alterados.append((it["nome"], qtd, novo))
+                novo = cur.execute("UPDATE itens SET saldo = saldo + ? WHERE id = ? RETURNING saldo",
+                                   (qtd, it["id"])).fetchone()[0]
+                alterados.append((it["nome"], qtd, novo, it["id"]))
 
         if alterados:
+            lancar_estoque(conn, [(iid, "entrada", qtd, "reposicao") for (_, qtd, _, iid) in alterados])
+            versao = versao_inventario(conn)
             conn.commit()
+            eventos.publicar("saldo", {"versao": versao,
+                                       "itens": [{"id": iid, "saldo": novo} for (_, _, novo, iid) in alterados]})
+
+        conn.close()
+        resumo = ", ".join([f"{nome} +{qtd} (→ {novo})" for (nome, qtd, novo, _) in alterados]) or "Nenhuma quantidade informada."
+        return render_template("repor_resultado.html", resumo=resumo)
+
+    # ----- GET → busca e lista -----
+    q = (request.args.get("q") or "").strip()
+    itens = buscar_itens(conn, q) if q else itens_da_tela(conn)
+    conn.close()
+    return render_template("repor.html", itens=itens, q=q)
 
+
+# ----------------- IMPORTAÇÃO DE ESTOQUE (planilha/CSV do fornecedor) -----------------
+IMPORTACAO_LOTE = 1000       # linhas por executemany
+MAX_ERROS_IMPORTACAO = 200   # erros detalhados guardados (o total é sempre contado)
+
+# cabeçalho da planilha (normalizado) -> campo
+COLUNAS_IMPORTACAO = {
+    "codigo": "codigo", "cod": "codigo", "codigo de barras": "codigo",
+    "nome": "nome", "descricao": "nome", "item": "nome",
+    "ca": "ca", "c.a.": "ca", "c.a": "ca",
+    "quantidade": "quantidade", "qtd": "quantidade", "qtde": "quantidade",
+}
+
+# o que ler_planilha levanta quando o problema é o arquivo (cabeçalho, encoding, xlsx corrompido)
+ERROS_PLANILHA = (ValueError, zipfile.BadZipFile, InvalidFileException)
+
+def _normalizar_cabecalho(txt) -> str:
+    txt = unicodedata.normalize("NFD", str(txt or "").strip().lower())
+    return "".join(ch for ch in txt if not unicodedata.combining(ch))
+
+def ler_planilha(arquivo, nome_arquivo: str):
+    """
+    Gera (numero_da_linha, {codigo, nome, ca, quantidade}) lendo o arquivo em fluxo:
+    CSV linha a linha (';' ou ',') ou XLSX em modo read_only. Nada é carregado inteiro.
+    """
+    if nome_arquivo.lower().endswith(".xlsx"):
+        wb = load_workbook(arquivo, read_only=True, data_only=True)
+        try:
+            linhas = wb.worksheets[0].iter_rows(values_only=True)
+            yield from _mapear_linhas(linhas)
+        finally:
+            wb.close()
+    else:
+        texto = io.TextIOWrapper(arquivo, encoding="utf-8-sig", newline="")
+        try:
+            primeira = texto.readline()
+            sep = ";" if primeira.count(";") >= primeira.count(",") else ","
+            yield from _mapear_linhas(csv.reader(_com_primeira(primeira, texto), delimiter=sep))
+        finally:
+            texto.detach()  # não fecha o arquivo de quem chamou
+
+def _com_primeira(primeira, resto):
+    yield primeira
+    yield from resto
+
+def _mapear_linhas(linhas):
+    cabecalho = next(linhas, None) or ()
+    campos = [COLUNAS_IMPORTACAO.get(_normalizar_cabecalho(c)) for c in cabecalho]
+    faltando = [c for c in ("codigo", "quantidade") if c not in campos]
+    if faltando:
+        raise ValueError("A planilha precisa das colunas 'codigo' e 'quantidade' (falta: "
+                         + ", ".join(f"'{c}'" for c in faltando) + ").")
+    for num, valores in enumerate(linhas, start=2):
+        reg = {"codigo": "", "nome": "", "ca": "", "quantidade": None}
+        vazio = True
+        for campo, v in zip(campos, valores):
+            if campo and v is not None and str(v).strip():
+                reg[campo] = v if campo == "quantidade" else str(v).strip()
+                vazio = False
+        if not vazio:
+            yield num, reg
+
+def _quantidade_importada(v):
+    """Inteiro ≥ 0 ou None (aceita 12, '12', 12.0 do Excel)."""
+    try:
+        f = float(str(v).replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+    if f < 0 or not f.is_integer():
+        return None
+    return int(f)
+
+def importar_estoque(conn, linhas, simular: bool = False) -> dict:
+    """
+    Aplica as linhas de ler_planilha numa única transação:
+    - código novo -> cria o item (nome obrigatório) com saldo = quantidade;
+    - código existente -> saldo += quantidade e atualiza o CA se informado
+      (o nome cadastrado é mantido).
+    Linhas inválidas não param a importação: vão para `erros` (número da linha + motivo).
+    Com simular=True tudo é validado e desfeito no fim (rollback).
+    """
+    res = {"linhas": 0, "aplicadas": 0, "unidades": 0, "erros": [], "total_erros": 0}
+
+    def erro(num, codigo, msg):
+        res["total_erros"] += 1
+        if len(res["erros"]) < MAX_ERROS_IMPORTACAO:
+            res["erros"].append({"linha": num, "codigo": codigo, "msg": msg})
+
+    def gravar(lote):
+        # Linhas sem nome só podem atualizar item existente (ou criado antes no mesmo lote)
+        sem_nome = {r[1] for _, r in lote if not r[0]}
+        existentes = set()
+        if sem_nome:
+            marcas = ",".join("?" * len(sem_nome))
+            existentes = {row[0] for row in conn.execute(
+                f"SELECT codigo FROM itens WHERE codigo IN ({marcas})", tuple(sem_nome))}
+        validos = []
+        for num, r in lote:
+            if r[0]:
+                existentes.add(r[1])
+            elif r[1] not in existentes:
+                erro(num, r[1], "Código não cadastrado e sem nome para criar o item.")
+                continue
+            validos.append(r)
+        conn.executemany("""
+            INSERT INTO itens (nome, codigo, saldo, ca) VALUES (?, ?, ?, ?)
+            ON CONFLICT(codigo) DO UPDATE SET
+                saldo = saldo + excluded.saldo,
+                ca = CASE WHEN excluded.ca <> '' THEN excluded.ca ELSE ca END
+        """, validos)
+        if validos:
+            codigos = list({r[1] for r in validos})
+            marcas = ",".join("?" * len(codigos))
+            ids = dict(conn.execute(f"SELECT codigo, id FROM itens WHERE codigo IN ({marcas})", codigos).fetchall())
+            lancar_estoque(conn, [(ids[r[1]], "entrada", r[2], "importacao") for r in validos])
+        res["aplicadas"] += len(validos)
+        res["unidades"] += sum(r[2] for r in validos)
+
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        lote = []
+        for num, reg in linhas:
+            res["linhas"] += 1
+            qtd = _quantidade_importada(reg["quantidade"])
+            if not reg["codigo"]:
+                erro(num, "", "Código vazio.")
+            elif qtd is None:
+                erro(num, reg["codigo"], f"Quantidade inválida: {reg['quantidade']!r}.")
+            else:
+                lote.append((num, (reg["nome"], reg["codigo"], qtd, reg["ca"])))
+                if len(lote) >= IMPORTACAO_LOTE:
+                    gravar(lote); lote = []
+        if lote:
+            gravar(lote)
+    except BaseException:
+        conn.rollback()
+        raise
+    if simular:
+        conn.rollback()
+    else:
+        conn.commit()
+        if res["aplicadas"]:
+            publicar_inventario(conn)
+    res["erros"].sort(key=lambda e: e["linha"])
+    return res
+
+@app.route("/repor/importar", methods=["POST"])
+@login_required
+def repor_importar():
+    """Upload de CSV/XLSX (colunas codigo, nome, CA, quantidade) para entrada em massa."""
+    arq = request.files.get("arquivo")
+    if not arq or not arq.filename:
+        return render_template("repor_resultado.html", resumo="Selecione um arquivo CSV ou XLSX.", erro=True), 400
+    simular = bool(request.form.get("simular"))
+    conn = get_db_connection()
+    try:
+        res = importar_estoque(conn, ler_planilha(arq.stream, arq.filename), simular=simular)
+    except ERROS_PLANILHA as e:   # erro no arquivo; falha do banco vira 500 (e vai para o log)
+        return render_template("repor_resultado.html", resumo=f"Arquivo não importado: {e}", erro=True), 400
+    finally:
         conn.close()
-        resumo = ", ".join([f"{nome} +{qtd} (→ {novo})" for (nome, qtd, novo) in alterados]) or "Nenhuma quantidade informada."
-        return render_template("repor_resultado.html", resumo=resumo)
 
-    # ----- GET → busca e lista -----
-    q = (request.args.get("q") or "").strip()
-    if q:
-        like = f"%{q}%"
-        cur.execute("""
-            SELECT * FROM itens
-            WHERE nome LIKE ? OR codigo LIKE ?
-            ORDER BY nome
-        """, (like, like))
-    else:
-        cur.execute("SELECT * FROM itens ORDER BY nome")
+    resumo = (f"{'Simulação: ' if simular else ''}{res['aplicadas']} de {res['linhas']} linha(s) aplicadas "
+              f"(+{res['unidades']} unidades), {res['total_erros']} com erro.")
+    return render_template("repor_resultado.html", resumo=resumo, importacao=res, erro=bool(res["total_erros"]))
 
-    itens = cur.fetchall()
-    conn.close()
-    return render_template("repor.html", itens=itens, q=q)
+@app.cli.command("importar-estoque")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--simular", is_flag=True, help="Valida e desfaz no fim, sem gravar.")
+def cli_importar_estoque(arquivo, simular):
+    """Dá entrada no estoque a partir de uma planilha CSV/XLSX do fornecedor."""
+    init_db()
+    conn = get_db_connection()
+    try:
+        with open(arquivo, "rb") as f:
+            res = importar_estoque(conn, ler_planilha(f, arquivo), simular=simular)
+    except ERROS_PLANILHA as e:
+        raise click.ClickException(f"{arquivo} não importado: {e}")
+    finally:
+        conn.close()
+    for e in res["erros"]:
+        print(f"linha {e['linha']}: {e['codigo'] or '-'}: {e['msg']}")
+    if res["total_erros"] > len(res["erros"]):
+        print(f"... e mais {res['total_erros'] - len(res['erros'])} erro(s).")
+    print(f"{'[simulação] ' if simular else ''}{res['aplicadas']}/{res['linhas']} linha(s) aplicadas, "
+          f"+{res['unidades']} unidades, {res['total_erros']} erro(s).")
 
 
 # ----------------- LISTA DE ITENS (gerenciar) -----------------
@@ -466,9 +2887,8 @@ def repor():
 @login_required_for(methods=("POST",))
 def itens_lista():
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM itens ORDER BY nome")
-    itens = cur.fetchall()
+    itens = cache_inventario.listar(
+        conn, "itens", lambda c: c.execute("SELECT * FROM itens ORDER BY nome").fetchall())
     conn.close()
     return render_template("itens.html", itens=itens)
 
@@ -479,7 +2899,7 @@ def editar_item(item_id):
     """
     Edita nome, código e saldo manualmente.
     - Garante código único (pode manter o mesmo).
-    - Se o código mudar, atualiza a etiqueta (gera PNG novo e remove PNG antigo).
+    - Se o código mudar, a etiqueta acompanha (vem de /barcode/<codigo>).
     """
     conn = get_db_connection()
     cur = conn.cursor()
@@ -520,24 +2940,24 @@ def editar_item(item_id):
             conn.close()
             return render_template("editar.html", erro=f"Código {codigo} já existe em outro item.", item=item)
 
-        codigo_antigo = item["codigo"]
-
-        # Atualiza
+        # Atualiza; a diferença de saldo vira um ajuste no livro-razão
+        # (saldo relido sob o lock de escrita: pode ter havido baixa desde o GET)
+        cur.execute("BEGIN IMMEDIATE")
+        anterior = cur.execute("SELECT saldo FROM itens WHERE id = ?", (item_id,)).fetchone()
+        if anterior is None:   # excluído por outra pessoa desde o GET
+            conn.close()
+            return render_template("editar.html", erro="Item não encontrado.", item=None)
+        anterior = anterior[0]
         cur.execute("UPDATE itens SET nome = ?, codigo = ?, saldo = ? WHERE id = ?",
                     (nome, codigo, saldo, item_id))
+        lancar_estoque(conn, [(item_id, "ajuste", saldo - anterior, "edicao")])
         conn.commit()
+        if nome != item["nome"] or codigo != item["codigo"]:
+            indice_itens.aplicar(conn, {"id": item_id, "nome": nome, "codigo": codigo, "ca": item["ca"]})
+        publicar_inventario(conn)
         conn.close()
 
-        # Se código mudou, atualiza etiqueta: apaga PNG antigo e gera novo
-        if codigo != codigo_antigo:
-            antigo_png = os.path.join(BARCODE_DIR, f"{codigo_antigo}.png")
-            if os.path.exists(antigo_png):
-                try:
-                    os.remove(antigo_png)
-                except Exception:
-                    pass
-            salvar_barcode_png(codigo, force=True)
-
+        # Código novo = URL nova em /barcode/<codigo>: nada para apagar/regerar
         return redirect(url_for("itens_lista"))
 
     # GET
@@ -563,19 +2983,13 @@ def excluir_item(item_id):
         return render_template("excluir.html", item=None, erro="Item não encontrado.")
 
     if request.method == "POST":
-        # Remove PNG da etiqueta (se existir)
-        png_path = os.path.join(BARCODE_DIR, f"{item['codigo']}.png")
-        if os.path.exists(png_path):
-            try:
-                os.remove(png_path)
-            except Exception:
-                pass
-
         # Excluir movimentações vinculadas
         cur.execute("DELETE FROM movimentacoes WHERE item_id = ?", (item_id,))
         # Excluir item
         cur.execute("DELETE FROM itens WHERE id = ?", (item_id,))
         conn.commit()
+        indice_itens.remover(conn, item_id)
+        publicar_inventario(conn)
         conn.close()
         return redirect(url_for("itens_lista"))
 
@@ -583,7 +2997,10 @@ def excluir_item(item_id):
     return render_template("excluir.html", item=item, erro=None)
 
 # ----------------- RELATORIOS-----------------
+RELATORIO_POR_PAGINA = 100
+
 @app.route("/relatorios", methods=["GET"])
+@usa_copia_relatorio
 def relatorios():
     # leitura do formulário
     destinatario = (request.args.get("destinatario") or "").strip()
@@ -594,19 +3011,41 @@ def relatorios():
     data_ini_iso = br_to_iso(data_ini_br)
     data_fim_iso = br_to_iso(data_fim_br)
 
-    # 👉 sempre busca: se vier tudo vazio, retorna TODAS as movimentações
-    movimentos = buscar_movimentacoes(
+    filtros = (
         destinatario if destinatario else None,
         data_ini_iso if data_ini_iso else None,
         data_fim_iso if data_fim_iso else None
     )
 
-    # sugestões de destinatários
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT destinatario FROM movimentacoes ORDER BY destinatario")
-    destinatarios_unicos = [r["destinatario"] for r in cur.fetchall()]
-    conn.close()
+    # paginação por cursor: ?antes=<data|id> (mais antigas) / ?depois=<data|id> (mais novas)
+    try:
+        por_pagina = min(max(int(request.args.get("por_pagina") or RELATORIO_POR_PAGINA), 1), 500)
+    except ValueError:
+        por_pagina = RELATORIO_POR_PAGINA
+    antes = texto_para_cursor(request.args.get("antes"))
+    depois = None if antes else texto_para_cursor(request.args.get("depois"))
+
+    # busca 1 linha a mais só para saber se existe outra página
+    movimentos = buscar_movimentacoes(*filtros, limite=por_pagina + 1, antes=antes, depois=depois)
+    tem_mais = len(movimentos) > por_pagina
+    if depois:
+        movimentos = movimentos[-por_pagina:] if tem_mais else movimentos
+        tem_anteriores, tem_proximas = tem_mais, True
+    else:
+        movimentos = movimentos[:por_pagina]
+        tem_anteriores, tem_proximas = antes is not None, tem_mais
+
+    params_filtro = {"destinatario": destinatario, "data_ini": data_ini_br, "data_fim": data_fim_br}
+    if request.args.get("por_pagina"):
+        params_filtro["por_pagina"] = por_pagina
+    url_anteriores = url_proximas = None
+    if movimentos and tem_anteriores:
+        url_anteriores = url_for("relatorios", depois=cursor_para_texto(movimentos[0]), **params_filtro)
+    if movimentos and tem_proximas:
+        url_proximas = url_for("relatorios", antes=cursor_para_texto(movimentos[-1]), **params_filtro)
+
+    # sugestões de destinatários: sob demanda, por /api/destinatarios
+    totais = resumir_movimentacoes(*filtros)
 
     return render_template(
         "relatorios.html",
@@ -614,45 +3053,337 @@ def relatorios():
         destinatario=destinatario,
         data_ini=data_ini_br,
         data_fim=data_fim_br,
-        destinatarios_unicos=destinatarios_unicos
+        totais=totais,
+        url_anteriores=url_anteriores,
+        url_proximas=url_proximas,
+        url_inicio=url_for("relatorios", **params_filtro) if (antes or depois) else None,
+        dados_em=datetime.fromtimestamp(g._dados_em).strftime("%d/%m/%Y %H:%M") if g.get("_dados_em") else None
     )
 
-# ----------------- RELATORIOS/EXPORT-----------------
-@app.route("/relatorios/export", methods=["GET"])
-def relatorios_export():
-    destinatario = (request.args.get("destinatario") or "").strip()
-    data_ini_iso = br_to_iso(request.args.get("data_ini"))
-    data_fim_iso = br_to_iso(request.args.get("data_fim"))
+# ----------------- Exportação em streaming (XLSX / CSV) -----------------
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_CHUNK = 64 * 1024
 
-    movimentos = buscar_movimentacoes(destinatario, data_ini_iso, data_fim_iso)
+def gerar_csv(cabecalho, linhas):
+    """CSV em pedaços de ~64 KB, produzidos à medida que as linhas chegam do cursor."""
+    buf = StringIO()
+    w = csv.writer(buf, delimiter=";")  # ';' = separador que o Excel pt-BR espera
+    buf.write("\ufeff")                 # BOM: Excel abre os acentos certo
+    w.writerow(cabecalho)
+    for linha in linhas:
+        w.writerow(linha)
+        if buf.tell() >= EXPORT_CHUNK:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Envios EPI"
-    ws.append(["Destinatário", "Item", "Código", "Quantidade", "Data/Hora"])
+def gerar_xlsx(titulo, cabecalho, linhas):
+    """
+    XLSX com openpyxl em modo write_only: cada linha vai direto para o XML
+    temporário em disco, então a memória não cresce com o número de linhas.
+    Limitação: o zip só existe depois de wb.save(), então o primeiro byte
+    sai só com a planilha inteira montada (todas as linhas lidas) — não há
+    streaming de verdade como no CSV. Depois disso o arquivo é enviado em
+    pedaços e apagado. O cache de exportações (CacheExportacoes) evita pagar
+    essa espera a cada download.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(titulo)
+    ws.append(cabecalho)
+    for linha in linhas:
+        ws.append(linha)
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(EXPORT_CHUNK)
+            if not chunk:
+                break
+            yield chunk
 
-    for mv in movimentos:
-        # mv["data"] é 'AAAA-MM-DD HH:MM:SS' -> exibir BR no Excel
-        data_br = f"{mv['data'][8:10]}/{mv['data'][5:7]}/{mv['data'][0:4]} {mv['data'][11:]}"
-        ws.append([mv["destinatario"], mv["item_nome"], mv["item_codigo"], mv["quantidade"], data_br])
+def formato_exportacao():
+    """Lê ?format=xlsx|csv (padrão xlsx). Formato desconhecido -> 400."""
+    formato = (request.args.get("format") or "xlsx").strip().lower()
+    if formato not in ("xlsx", "csv"):
+        abort(400, "format deve ser xlsx ou csv")
+    return formato
 
-    bio = BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return send_file(
-        bio,
-        as_attachment=True,
-        download_name="relatorio_envios.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+def _medir_exportacao(corpo, formato, endpoint):
+    enviados, t0 = 0, time.perf_counter()
+    try:
+        for chunk in corpo:
+            enviados += len(chunk)
+            yield chunk
+    finally:
+        metricas.somar("epi_export_bytes_total", enviados, formato=formato, endpoint=endpoint)
+        metricas.observar("epi_export_seconds", time.perf_counter() - t0, formato=formato, endpoint=endpoint)
+
+def resposta_exportacao(nome_base, formato, titulo, cabecalho, linhas):
+    """
+    Resposta chunked. CSV: o download começa enquanto o cursor ainda está
+    sendo lido. XLSX: só depois de a planilha inteira ser montada (ver gerar_xlsx).
+    """
+    if formato == "csv":
+        corpo, mimetype = gerar_csv(cabecalho, linhas), "text/csv"
+    else:
+        corpo, mimetype = gerar_xlsx(titulo, cabecalho, linhas), MIME_XLSX
+    resp = Response(stream_with_context(_medir_exportacao(corpo, formato, request.endpoint)), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{nome_base}.{formato}"'
+    return resp
+
+# ----------------- Cache de exportações (arquivos prontos por versão dos dados) -----------------
+EXPORT_CACHE_DIR = os.environ.get("EPI_EXPORT_CACHE_DIR", "")           # padrão: pasta 'cache_exportacoes' ao lado do banco
+EXPORT_CACHE_MB = float(os.environ.get("EPI_EXPORT_CACHE_MB", "256"))   # tamanho máximo em disco (0 = sem cache)
+EXPORT_SOSSEGO = float(os.environ.get("EPI_EXPORT_SOSSEGO", "30"))      # s sem escrita antes de regerar em 2º plano
+EXPORT_POPULARES = int(os.environ.get("EPI_EXPORT_POPULARES", "5"))     # exportações mais pedidas que são regeradas
+EXPORT_VERIFICA = 5.0                                                   # s entre conferências da thread
+EXPORT_PEDIDOS_MAX = 200                                                # combinações de parâmetros contadas
+
+# nome -> função(params) que devolve (nome_base, titulo, cabecalho, linhas); ver @exportacao
+EXPORTACOES = {}
+
+def exportacao(nome):
+    """Registra uma exportação cacheável (a thread de regeneração precisa montá-la fora do request)."""
+    def registrar(montar):
+        EXPORTACOES[nome] = montar
+        return montar
+    return registrar
+
+class CacheExportacoes:
+    """
+    Exportações prontas em disco, uma por (exportação, parâmetros, versão dos
+    dados): <nome>-<hash dos parâmetros>-<versao_dados>.<formato>. Enquanto
+    nada é gravado, o clique seguinte é um send_file do arquivo, com ETag (o
+    próprio nome) e Last-Modified — ou 304, se o navegador já tem essa versão.
+    No miss a resposta continua em streaming e o arquivo é gravado junto.
+
+    Tamanho limitado a EXPORT_CACHE_MB, apagando o menos usado: o uso fica no
+    atime, gravado à mão a cada hit (vale entre workers e com noatime). Uma
+    thread regera as EXPORT_POPULARES mais pedidas quando os dados mudaram e
+    ficaram EXPORT_SOSSEGO segundos parados, para o próximo clique já achar
+    o arquivo pronto.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pedidos = OrderedDict()   # (nome, params) -> vezes pedido, mais recente no fim
+        self._versao = (None, 0.0)      # (versão vista, quando mudou) pela thread
+        self._regerada = None           # versão em que a thread já regerou as populares
+        self._stats = {"hits": 0, "misses": 0, "nao_modificados": 0, "regeradas": 0, "removidos": 0}
+
+    def pasta(self) -> str:
+        if EXPORT_CACHE_DIR:
+            return os.path.abspath(EXPORT_CACHE_DIR)   # send_file resolveria relativo à pasta do app
+        return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "cache_exportacoes")
+
+    @staticmethod
+    def chave(nome, params, titulo, cabecalho) -> str:
+        # título e cabeçalho entram no hash: mudou o layout no código, muda a chave
+        base = json.dumps([nome, sorted(params.items()), titulo, cabecalho], ensure_ascii=False)
+        return f"{nome}-{hashlib.sha1(base.encode('utf-8')).hexdigest()[:16]}"
+
+    def _contar(self, campo, valor=1):
+        with self._lock:
+            self._stats[campo] += valor
+
+    def _anotar_pedido(self, nome, params):
+        chave = (nome, tuple(sorted(params.items())))
+        with self._lock:
+            self._pedidos[chave] = self._pedidos.pop(chave, 0) + 1
+            while len(self._pedidos) > EXPORT_PEDIDOS_MAX:
+                self._pedidos.popitem(last=False)
+
+    def responder(self, nome, params):
+        """Resposta da exportação `nome` (request atual; params inclui 'format')."""
+        formato = params["format"]
+        nome_base, titulo, cabecalho, linhas = EXPORTACOES[nome](params)
+        if EXPORT_CACHE_MB <= 0:
+            return resposta_exportacao(nome_base, formato, titulo, cabecalho, linhas)
+        self.iniciar()
+        self._anotar_pedido(nome, params)
+        # versão lida ANTES das linhas: o arquivo nunca é mais velho que o nome diz
+        etag = f"{self.chave(nome, params, titulo, cabecalho)}-{versao_dados(conexao_relatorio())}"
+        caminho = os.path.join(self.pasta(), f"{etag}.{formato}")
+        download = f"{nome_base}.{formato}"
+        mimetype = "text/csv" if formato == "csv" else MIME_XLSX
+
+        if request.if_none_match.contains(etag):
+            self._contar("nao_modificados")
+            resp = make_response("", 304)
+        else:
+            try:
+                # send_file já abre o arquivo: a LRU pode apagá-lo depois sem atrapalhar o envio
+                st = os.stat(caminho)
+                os.utime(caminho, (time.time(), st.st_mtime))
+                resp = send_file(caminho, mimetype=mimetype, as_attachment=True, download_name=download,
+                                 conditional=True, etag=False, last_modified=st.st_mtime)
+                self._contar("hits")
+            except FileNotFoundError:
+                resp = None
+            if resp is None:
+                self._contar("misses")
+                corpo = gerar_csv(cabecalho, linhas) if formato == "csv" else gerar_xlsx(titulo, cabecalho, linhas)
+                corpo = self._gravar(_medir_exportacao(corpo, formato, request.endpoint), caminho)
+                resp = Response(stream_with_context(corpo), mimetype=mimetype)
+                resp.headers["Content-Disposition"] = f'attachment; filename="{download}"'
+                resp.last_modified = datetime.now()
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"   # sempre revalida: a versão muda a cada escrita
+        return resp
+
+    def _gravar(self, corpo, caminho):
+        """Repassa os pedaços e grava a cópia; o arquivo só aparece (os.replace) se a exportação terminar."""
+        pasta = os.path.dirname(caminho)
+        os.makedirs(pasta, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=pasta, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in corpo:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, caminho)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        self._limpar(caminho)
+
+    def _limpar(self, novo):
+        """Apaga as versões anteriores do mesmo arquivo e, passando do limite, os menos usados."""
+        prefixo = os.path.basename(novo).rsplit("-", 1)[0] + "-"
+        arquivos = []
+        with os.scandir(os.path.dirname(novo)) as it:
+            for e in it:
+                if e.name.startswith(".tmp_") or not e.is_file():
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                if e.path != novo and e.name.startswith(prefixo):
+                    self._remover(e.path)
+                    continue
+                arquivos.append((st.st_atime, st.st_size, e.path))
+        total, limite = sum(a[1] for a in arquivos), EXPORT_CACHE_MB * 1e6
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= limite:
+                break
+            if caminho != novo:
+                self._remover(caminho)
+                total -= tamanho
+
+    def _remover(self, caminho):
+        try:
+            os.remove(caminho)
+            self._contar("removidos")
+        except FileNotFoundError:
+            pass
+
+    def iniciar(self):
+        """Sobe a thread de regeneração neste processo (uma vez; workers nascem por fork)."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._rodar, name="cache-exportacoes", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _rodar(self):
+        while True:
+            time.sleep(EXPORT_VERIFICA)
+            try:
+                self.regerar_populares()
+            except Exception:
+                app.logger.exception("Cache de exportações: falha ao regerar")
+
+    def regerar_populares(self, forcar=False) -> int:
+        """
+        Regera as exportações mais pedidas que ainda não têm arquivo na versão
+        atual, se os dados pararam de mudar há EXPORT_SOSSEGO s. Devolve quantas gerou.
+        """
+        with app.app_context():
+            prender_copia_relatorio()
+            versao = versao_dados(conexao_relatorio())
+        agora = time.time()
+        with self._lock:
+            if versao != self._versao[0]:
+                self._versao = (versao, agora)
+            if not forcar and (versao == self._regerada or agora - self._versao[1] < EXPORT_SOSSEGO):
+                return 0
+            populares = sorted(self._pedidos.items(), key=lambda p: p[1], reverse=True)[:EXPORT_POPULARES]
+        feitas = 0
+        for (nome, params), _ in populares:
+            if self.gerar(nome, dict(params)):
+                feitas += 1
+        with self._lock:
+            self._regerada = versao
+        return feitas
+
+    def gerar(self, nome, params) -> bool:
+        """Gera o arquivo da exportação fora de request, se ainda não existe na versão atual."""
+        with app.app_context():
+            prender_copia_relatorio()
+            nome_base, titulo, cabecalho, linhas = EXPORTACOES[nome](params)
+            etag = f"{self.chave(nome, params, titulo, cabecalho)}-{versao_dados(conexao_relatorio())}"
+            caminho = os.path.join(self.pasta(), f"{etag}.{params['format']}")
+            if os.path.exists(caminho):   # outro worker já gerou
+                return False
+            if params["format"] == "csv":
+                corpo = gerar_csv(cabecalho, linhas)
+            else:
+                corpo = gerar_xlsx(titulo, cabecalho, linhas)
+            for _ in self._gravar(corpo, caminho):
+                pass
+        self._contar("regeradas")
+        return True
+
+    def stats(self):
+        with self._lock:
+            dados = dict(self._stats)
+            dados["pedidos"] = len(self._pedidos)
+            dados["versao_regerada"] = self._regerada
+        arquivos = []
+        if os.path.isdir(self.pasta()):
+            with os.scandir(self.pasta()) as it:
+                arquivos = [e.stat().st_size for e in it if e.is_file() and not e.name.startswith(".tmp_")]
+        dados["arquivos"] = len(arquivos)
+        dados["bytes"] = sum(arquivos)
+        dados["limite_bytes"] = int(EXPORT_CACHE_MB * 1e6)
+        return dados
+
+cache_exportacoes = CacheExportacoes()
+
+# ----------------- RELATORIOS/EXPORT-----------------
+@exportacao("relatorio")
+def exportacao_relatorio(params):
+    def linhas():
+        for mv in iterar_movimentacoes(params["destinatario"], params["data_ini"], params["data_fim"]):
+            # mv["data"] é 'AAAA-MM-DD HH:MM:SS' -> exibir BR no Excel
+            data_br = f"{mv['data'][8:10]}/{mv['data'][5:7]}/{mv['data'][0:4]} {mv['data'][11:]}"
+            yield [mv["destinatario"], mv["item_nome"], mv["item_codigo"], mv["quantidade"], data_br]
+
+    return ("relatorio_envios", "Envios EPI",
+            ["Destinatário", "Item", "Código", "Quantidade", "Data/Hora"],
+            linhas())
+
+@app.route("/relatorios/export", methods=["GET"])
+@usa_copia_relatorio
+def relatorios_export():
+    return cache_exportacoes.responder("relatorio", {
+        "destinatario": (request.args.get("destinatario") or "").strip(),
+        "data_ini": br_to_iso(request.args.get("data_ini")),
+        "data_fim": br_to_iso(request.args.get("data_fim")),
+        "format": formato_exportacao(),
+    })
 
 # ----------------- Etiqueta para impressão -----------------
 @app.route("/etiqueta/<codigo>")
 def etiqueta(codigo):
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT nome FROM itens WHERE codigo = ?", (codigo,))
-    item = cur.fetchone()
+    item = indice_itens.por_codigo(conn, codigo)
     conn.close()
 
     if not item:
@@ -660,7 +3391,6 @@ def etiqueta(codigo):
     else:
         nome = item["nome"]
 
-    salvar_barcode_png(codigo)  # garante que o PNG exista
     return render_template("etiqueta.html", codigo=codigo, nome=nome)
 
 # --- Escolher/guardar destinatário no cookie (uma vez) ---
@@ -683,12 +3413,271 @@ def escolher_destinatario():
     ok = request.args.get("ok") == "1"
     return render_template("set_destinatario.html", atual=atual, ok=ok, erro=None)
 
+@app.route("/api/consumo")
+@usa_copia_relatorio
+def api_consumo():
+    """
+    Resumo de consumo servido pelo rollup consumo_diario.
+    ?periodo=dia|mes|ano  &agrupar=total|item|destinatario|item_destinatario
+    &data_ini=DD/MM/AAAA  &data_fim=DD/MM/AAAA  &destinatario=  &item_id=
+    """
+    periodo = (request.args.get("periodo") or "dia").strip()
+    agrupar = (request.args.get("agrupar") or "total").strip()
+    if periodo not in CONSUMO_PERIODOS or agrupar not in CONSUMO_AGRUPAMENTOS:
+        return jsonify({"ok": False, "erro": "periodo ou agrupar inválido."}), 400
+    item_id = request.args.get("item_id") or None
+    if item_id and not item_id.isdigit():
+        return jsonify({"ok": False, "erro": "item_id inválido."}), 400
+
+    linhas = consumo_por_periodo(
+        periodo, agrupar,
+        destinatario=(request.args.get("destinatario") or "").strip() or None,
+        data_ini=br_to_iso(request.args.get("data_ini")) or None,
+        data_fim=br_to_iso(request.args.get("data_fim")) or None,
+        item_id=item_id,
+    )
+    return jsonify({"ok": True, "periodo": periodo, "agrupar": agrupar, "linhas": linhas})
+
+@app.route("/api/itens/search")
+def api_itens_search():
+    """
+    Typeahead das telas de baixa/reposição.
+    ?q=texto (prefixo, sem acento, nome/código/CA)  &limit=20 (máx. BUSCA_LIMITE_MAX)
+    """
+    q = (request.args.get("q") or "").strip()
+    try:
+        limite = min(max(int(request.args.get("limit", 20)), 1), BUSCA_LIMITE_MAX)
+    except ValueError:
+        return jsonify({"ok": False, "erro": "limit inválido."}), 400
+    conn = get_db_connection()
+    itens = [dict(r) for r in buscar_itens(conn, q, limite)]
+    conn.close()
+    return jsonify({"ok": True, "q": q, "itens": itens})
+
+@app.route("/api/destinatarios")
+def api_destinatarios():
+    """
+    Autocomplete de destinatários (índice em memória, ver IndiceDestinatarios).
+    ?prefix=texto (sem acento/caixa)  &limit=20 (máx. DESTINATARIOS_LIMITE_MAX)
+    """
+    prefixo = (request.args.get("prefix") or "").strip()
+    try:
+        limite = min(max(int(request.args.get("limit", 20)), 1), DESTINATARIOS_LIMITE_MAX)
+    except ValueError:
+        return jsonify({"ok": False, "erro": "limit inválido."}), 400
+    conn = get_db_connection()
+    destinatarios = indice_destinatarios.prefixo(conn, prefixo, limite)
+    conn.close()
+    return jsonify({"ok": True, "prefix": prefixo, "destinatarios": destinatarios})
+
+@app.route("/api/itens/<int:item_id>/saldo")
+def api_item_saldo_em(item_id):
+    """
+    Saldo do item num instante passado, pelo livro-razão (ver saldo_em).
+    ?em=DD/MM/AAAA | AAAA-MM-DD (fim do dia) | AAAA-MM-DD HH:MM:SS   (vazio = agora)
+    """
+    em = (request.args.get("em") or "").strip()
+    if "/" in em:
+        em = br_to_iso(em)
+        if not em:
+            return jsonify({"ok": False, "erro": "em inválido (use DD/MM/AAAA)."}), 400
+    elif em:
+        try:
+            em = datetime.fromisoformat(em).strftime("%Y-%m-%d %H:%M:%S") if len(em) > 10 else \
+                datetime.strptime(em, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            return jsonify({"ok": False, "erro": "em inválido (use AAAA-MM-DD[ HH:MM:SS])."}), 400
+    else:
+        em = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = get_db_connection()
+    item = indice_itens.por_id(conn, item_id)
+    saldo = saldo_em(conn, item_id, em) if item else None
+    conn.close()
+    if item is None:
+        return jsonify({"ok": False, "erro": "Item não encontrado."}), 404
+    return jsonify({"ok": True, "item_id": item_id, "codigo": item["codigo"], "em": em, "saldo": saldo})
+
+@app.route("/api/itens")
+def api_itens():
+    """
+    Snapshot do inventário para terminais.
+    - ETag = versão do inventário; If-None-Match igual -> 304 sem tocar em itens.
+    - ?since=<versao>: só itens alterados depois dela + ids removidos (delta).
+      since maior que a versão atual (banco trocado/restaurado) -> snapshot completo.
+    """
+    since = request.args.get("since")
+    if since is not None and not since.isdigit():
+        return jsonify({"ok": False, "erro": "since inválido."}), 400
+
+    conn = get_db_connection()
+    try:
+        versao = versao_inventario(conn)
+        etag = f"inv-{versao}"
+        if request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+        else:
+            conn.execute("BEGIN")  # versão e linhas do mesmo snapshot
+            versao = versao_inventario(conn)
+            etag = f"inv-{versao}"
+            completo = since is None or int(since) > versao
+            desde = -1 if completo else int(since)
+            itens = [dict(r) for r in conn.execute("""
+                SELECT id, nome, codigo, COALESCE(ca, '') AS ca, COALESCE(saldo, 0) AS saldo, versao
+                FROM itens WHERE versao > ? ORDER BY id
+            """, (desde,))]
+            removidos = [] if completo else [r[0] for r in conn.execute(
+                "SELECT item_id FROM itens_removidos WHERE versao > ? ORDER BY item_id", (desde,))]
+            conn.commit()
+            resp = jsonify({"ok": True, "versao": versao, "completo": completo,
+                            "itens": itens, "removidos": removidos})
+    finally:
+        conn.close()
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"  # sempre revalida (barato: 304)
+    return resp
+
+@app.route("/api/stream")
+def api_stream():
+    """
+    Server-Sent Events com as mudanças confirmadas (commit):
+      saldo       {versao, itens: [{id, saldo}]}
+      movimentos  {movimentos: [{item_id, nome, codigo, quantidade, destinatario, data}]}
+      inventario  {versao}        catálogo/carga em massa: buscar /api/itens?since=
+      etiquetas   {acao, ...}     fila de etiquetas mudou
+      resync      {versao}        cliente ficou para trás e perdeu eventos
+    Ao conectar vem 'ola' {versao}; sem eventos, um comentário a cada EVENTOS_HEARTBEAT s.
+    O stream termina sozinho depois de EVENTOS_DURACAO_MAX s ou quando o servidor
+    está encerrando (o navegador reconecta pelo retry:). Com EVENTOS_CLIENTES_MAX
+    streams abertos no worker, responde 503 (a página tenta de novo mais tarde).
+    """
+    def versao_atual():
+        c = get_db_connection()
+        try:
+            return versao_inventario(c)
+        finally:
+            c.close()
+
+    assinante = eventos.assinar()
+    if assinante is None:
+        resp = make_response("Limite de conexões ao vivo atingido.", 503)
+        resp.headers["Retry-After"] = "30"
+        return resp
+    try:
+        versao = versao_atual()
+    except Exception:
+        eventos.cancelar(assinante)
+        raise
+
+    def gerar():
+        vista = versao                  # última versão que este cliente recebeu
+        ultimo_envio = time.monotonic()
+        fim = ultimo_envio + EVENTOS_DURACAO_MAX
+        try:
+            yield "retry: 3000\n" + formatar_sse("ola", {"versao": versao})
+            while not servidor_encerrando.is_set() and time.monotonic() < fim:
+                if assinante.atrasado:
+                    # descarta o que sobrou e manda o cliente se atualizar pelo delta
+                    while not assinante.fila.empty():
+                        assinante.fila.get_nowait()
+                    assinante.atrasado = False
+                    vista = versao_atual()
+                    yield formatar_sse("resync", {"versao": vista})
+                try:
+                    seq, tipo, dados = assinante.fila.get(timeout=EVENTOS_VERIFICA)
+                except queue.Empty:
+                    atual = versao_atual()
+                    if atual > vista:  # escrita em outro worker
+                        vista = atual
+                        yield formatar_sse("inventario", {"versao": atual})
+                    elif time.monotonic() - ultimo_envio >= EVENTOS_HEARTBEAT:
+                        yield ": hb\n\n"
+                    else:
+                        continue
+                    ultimo_envio = time.monotonic()
+                    continue
+                vista = max(vista, dados.get("versao", vista))
+                ultimo_envio = time.monotonic()
+                yield formatar_sse(tipo, dados, seq)
+        finally:
+            eventos.cancelar(assinante)
+
+    resp = Response(gerar(), mimetype="text/event-stream")
+    resp.call_on_close(lambda: eventos.cancelar(assinante))   # também se o stream nem chegou a começar
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # proxy (nginx) não segura o stream
+    return resp
+
 @app.route("/ping")
 def ping():
     return "pong", 200
 
+@app.route("/metrics")
+def metrics():
+    """Métricas no formato texto do Prometheus (histogramas de latência, SQL, templates, barcodes, exportações)."""
+    pool = get_pool().stats()
+    ev = eventos.stats()
+    bc = cache_barcodes.stats()
+    idx = indice_itens.stats()
+    medidores = [
+        ("epi_db_pool_conexoes", "Conexões SQLite do pool.",
+         [({"estado": e}, pool[e]) for e in ("abertas", "em_uso", "ociosas")]),
+        ("epi_sse_clientes", "Clientes conectados em /api/stream.", [({}, ev["clientes"])]),
+        ("epi_sse_descartados", "Clientes SSE que ficaram para trás (resync).", [({}, ev["descartados"])]),
+        ("epi_cache_barcodes", "Cache de códigos de barras.",
+         [({"resultado": k}, bc[k]) for k in ("hits_memoria", "renders")]),
+        ("epi_indice_itens", "Índice do catálogo em memória.",
+         [({"resultado": k}, idx[k]) for k in ("hits", "misses", "recargas")]),
+    ]
+    return Response(metricas.texto(medidores), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/stats")
+def api_stats():
+    """Estatísticas internas (pool de conexões etc.) para diagnóstico."""
+    return jsonify({
+        "pool": get_pool().stats(),
+        "indice_itens": indice_itens.stats(),
+        "barcodes": cache_barcodes.stats(),
+        "inventario": cache_inventario.stats(),
+        "eventos": eventos.stats(),
+        "grupo_commit": escritor_baixas.stats(),
+        "fotos_estoque": fotografo_estoque.stats(),
+        "destinatarios": indice_destinatarios.stats(),
+        "copia_relatorios": copia_relatorios.stats(),
+        "exportacoes": cache_exportacoes.stats(),
+    })
+
+# -------- Código de barras gerado na hora (SVG/PNG) ----------
+@app.route("/barcode/<codigo>")
+def barcode_imagem(codigo):
+    """
+    Code39 renderizado em memória, sem gravar nada em static/.
+    ?format=svg (padrão, leve e sem Pillow) | png
+    A imagem só depende do código e das opções, então vai com ETag forte
+    (= chave do cache) e cache de 1 ano: navegador/proxy seguram o resto.
+    """
+    formato = (request.args.get("format") or "svg").strip().lower()
+    if formato not in ("svg", "png"):
+        abort(400, "format deve ser svg ou png")
+    if len(codigo) > BARCODE_CODIGO_MAX:
+        abort(400, f"Código com mais de {BARCODE_CODIGO_MAX} caracteres.")
+
+    chave = cache_barcodes.chave(codigo, formato, BARCODE_OPCOES)
+    if request.if_none_match.contains(chave):
+        resp = make_response("", 304)
+    else:
+        try:
+            chave, dados = cache_barcodes.obter(codigo, formato)
+        except barcode.errors.BarcodeError:
+            abort(400, "Código inválido para Code39.")
+        resp = make_response(dados)
+        resp.mimetype = "image/svg+xml" if formato == "svg" else "image/png"
+    resp.set_etag(chave)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
 # -------- Enfileirar etiqueta (para imprimir depois) ----------
 @app.route("/etiquetas/enfileirar", methods=["POST"])
+@api_login_required
 def etiquetas_enfileirar():
     """
     Body JSON: { "item_id": <int> } OU { "codigo": "<str>" }.
@@ -701,10 +3690,9 @@ def etiquetas_enfileirar():
     conn = get_db_connection(); cur = conn.cursor()
     try:
         if item_id:
-            cur.execute("SELECT id, nome, codigo FROM itens WHERE id = ?", (int(item_id),))
+            row = indice_itens.por_id(conn, int(item_id))
         else:
-            cur.execute("SELECT id, nome, codigo FROM itens WHERE codigo = ?", (codigo_in,))
-        row = cur.fetchone()
+            row = indice_itens.por_codigo(conn, codigo_in)
         if not row:
             conn.close()
             return {"ok": False, "msg": "Item não encontrado."}, 404
@@ -719,9 +3707,7 @@ def etiquetas_enfileirar():
             VALUES (?, ?, ?, ?, 'pendente')
         """, (iid, codigo, nome, numero))
         conn.commit()
-
-        # Garante que o PNG existe
-        salvar_barcode_png(codigo, force=True)
+        eventos.publicar("etiquetas", {"acao": "enfileiradas", "quantidade": 1})
 
         return {"ok": True, "id": cur.lastrowid, "numero_etiqueta": numero, "codigo": codigo, "nome": nome}
     except Exception as e:
@@ -730,6 +3716,85 @@ def etiquetas_enfileirar():
     finally:
         conn.close()
 
+# -------- Enfileirar etiquetas em lote (recebimento de caixas) ----------
+MAX_ETIQUETAS_LOTE = 5000
+
+@app.route("/etiquetas/enfileirar_lote", methods=["POST"])
+@api_login_required
+def etiquetas_enfileirar_lote():
+    """
+    Body JSON: [ {"item_id": <int> | "codigo": "<str>", "quantidade": <int>}, ... ]
+               (ou {"itens": [...]}).
+    Cria todas as etiquetas numa transação: uma faixa de números reservada de
+    uma vez no contador e um executemany. Tudo ou nada: se alguma linha for
+    inválida, nada é criado e a resposta lista os erros.
+    """
+    data = request.get_json(silent=True)
+    pedidos = data.get("itens") if isinstance(data, dict) else data
+    if not isinstance(pedidos, list) or not pedidos:
+        return {"ok": False, "msg": "Envie uma lista de itens."}, 400
+
+    conn = get_db_connection(); cur = conn.cursor()
+    linhas, erros = [], []
+    for pos, p in enumerate(pedidos):
+        if not isinstance(p, dict):
+            erros.append({"posicao": pos, "msg": "Linha inválida."})
+            continue
+        try:
+            qtd = int(p.get("quantidade", 1))
+        except (TypeError, ValueError):
+            qtd = 0
+        if qtd < 1:
+            erros.append({"posicao": pos, "msg": "quantidade deve ser inteiro ≥ 1."})
+            continue
+        if p.get("item_id"):
+            try:
+                row = indice_itens.por_id(conn, int(p["item_id"]))
+            except (TypeError, ValueError):
+                row = None
+        else:
+            row = indice_itens.por_codigo(conn, str(p.get("codigo") or "").strip())
+        if not row:
+            erros.append({"posicao": pos, "msg": "Item não encontrado."})
+            continue
+        linhas.append((row, qtd))
+
+    total = sum(q for _, q in linhas)
+    if not erros and total > MAX_ETIQUETAS_LOTE:
+        erros.append({"posicao": None, "msg": f"Máximo de {MAX_ETIQUETAS_LOTE} etiquetas por lote."})
+    if erros:
+        conn.close()
+        return {"ok": False, "msg": "Nenhuma etiqueta criada.", "erros": erros}, 400
+
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        numeros = iter(alocar_numeros(conn, "etiqueta", total))
+        resumo, registros = [], []
+        for row, qtd in linhas:
+            faixa = [next(numeros) for _ in range(qtd)]
+            # Snapshot (nome e codigo gravados na etiqueta)
+            registros += [(row["id"], row["codigo"], row["nome"], n) for n in faixa]
+            resumo.append({"item_id": row["id"], "codigo": row["codigo"], "nome": row["nome"],
+                           "quantidade": qtd, "numero_inicial": faixa[0], "numero_final": faixa[-1]})
+        cur.executemany("""
+            INSERT INTO etiquetas (item_id, codigo, nome, numero_etiqueta, status)
+            VALUES (?, ?, ?, ?, 'pendente')
+        """, registros)
+        conn.commit()
+        eventos.publicar("etiquetas", {"acao": "enfileiradas", "quantidade": total})
+    except Exception as e:
+        conn.rollback()
+        return {"ok": False, "msg": f"Erro: {e}"}, 500
+    finally:
+        conn.close()
+
+    # Código de barras renderizado uma vez por código distinto (tela e folha PDF)
+    for codigo in {r["codigo"] for r in resumo}:
+        cache_barcodes.obter(codigo, "svg")
+        cache_barcodes.obter(codigo, "png", dpi=FOLHA_DPI)
+
+    return {"ok": True, "criadas": total, "itens": resumo}
+
 # -------- Lista de etiquetas pendentes ----------
 @app.route("/etiquetas/pendentes")
 def etiquetas_pendentes():
@@ -748,6 +3813,128 @@ def etiquetas_pendentes():
 @app.route("/etiquetas/print")
 def etiquetas_print():
     ids_raw = (request.args.get("ids") or "").strip()   # ex: "5,6,7"
+    etiquetas = buscar_etiquetas_para_impressao(ids_raw)
+    return render_template("etiquetas_print.html", etiquetas=etiquetas)
+
+# -------- Folha de etiquetas montada no servidor (PDF/PNG) ----------
+# Mesma grade da página /etiquetas/print (50x30 mm, 3 mm de espaço, margem 6 mm),
+# desenhada com Pillow em A4 a 300 dpi, 1 bit por pixel (leve e nítido na impressora).
+FOLHA_DPI = 300
+FOLHA_MM = {"papel_w": 210, "papel_h": 297, "margem": 6, "etq_w": 50, "etq_h": 30, "gap": 3, "padding": 2}
+FOLHA_MIN_PARALELO = 4   # a partir de quantas páginas usa o pool de processos
+FOLHA_PROCESSOS = int(os.environ.get("EPI_FOLHA_PROCESSOS", "0")) or (os.cpu_count() or 1)
+
+def _mm(v: float, dpi: int = FOLHA_DPI) -> int:
+    return int(round(v * dpi / 25.4))
+
+def layout_folha(dpi: int = FOLHA_DPI) -> dict:
+    m = FOLHA_MM
+    cols = int((m["papel_w"] - 2 * m["margem"] + m["gap"]) // (m["etq_w"] + m["gap"]))
+    linhas = int((m["papel_h"] - 2 * m["margem"] + m["gap"]) // (m["etq_h"] + m["gap"]))
+    return {
+        "dpi": dpi, "cols": cols, "linhas": linhas, "por_pagina": cols * linhas,
+        "papel": (_mm(m["papel_w"], dpi), _mm(m["papel_h"], dpi)),
+        "margem": _mm(m["margem"], dpi), "gap": _mm(m["gap"], dpi), "padding": _mm(m["padding"], dpi),
+        "etq": (_mm(m["etq_w"], dpi), _mm(m["etq_h"], dpi)),
+        "fonte_nome": int(10 / 72 * dpi), "fonte_linha2": int(9 / 72 * dpi),   # 10pt / 9pt
+    }
+
+@lru_cache(maxsize=8)
+def _fonte(tamanho: int, negrito: bool = False):
+    nomes = ("DejaVuSans-Bold.ttf", "arialbd.ttf") if negrito else ("DejaVuSans.ttf", "arial.ttf")
+    for nome in nomes:
+        try:
+            return ImageFont.truetype(nome, tamanho)
+        except OSError:
+            pass
+    return ImageFont.load_default(tamanho)
+
+def _cortar_texto(draw, texto: str, fonte, largura: int) -> str:
+    """Corta com reticências para caber na largura (como o text-overflow do HTML)."""
+    if draw.textlength(texto, font=fonte) <= largura:
+        return texto
+    while texto and draw.textlength(texto + "…", font=fonte) > largura:
+        texto = texto[:-1]
+    return texto + "…"
+
+def _desenhar_etiqueta(pagina, draw, x: int, y: int, etq, lay: dict):
+    nome, numero, codigo = etq
+    w, h = lay["etq"]
+    pad = lay["padding"]
+    f_nome = _fonte(lay["fonte_nome"], negrito=True)
+    f_linha2 = _fonte(lay["fonte_linha2"])
+    largura = w - 2 * pad
+
+    # nome (topo)
+    draw.text((x + pad, y + pad), _cortar_texto(draw, nome, f_nome, largura), font=f_nome, fill=0)
+    topo_bc = y + pad + lay["fonte_nome"] + pad // 2
+
+    # linha 2 (base): #número à esquerda, código à direita
+    base = y + h - pad - lay["fonte_linha2"]
+    draw.text((x + pad, base), f"#{numero}", font=f_linha2, fill=0)
+    draw.text((x + w - pad - draw.textlength(codigo, font=f_linha2), base), codigo, font=f_linha2, fill=0)
+
+    # código de barras no meio, sem reamostrar se couber (barras nítidas)
+    _, png = cache_barcodes.obter(codigo, "png", dpi=lay["dpi"])
+    bc = Image.open(BytesIO(png)).convert("1")
+    caixa = (largura, base - topo_bc - pad // 2)
+    if bc.width > caixa[0] or bc.height > caixa[1]:
+        fator = min(caixa[0] / bc.width, caixa[1] / bc.height)
+        bc = bc.resize((max(1, int(bc.width * fator)), max(1, int(bc.height * fator))), Image.NEAREST)
+    pagina.paste(bc, (x + (w - bc.width) // 2, topo_bc + (caixa[1] - bc.height) // 2))
+
+def renderizar_pagina_etiquetas(etiquetas, lay: dict):
+    """
+    Desenha UMA página (lista de (nome, numero, codigo)) e devolve (modo, tamanho, bytes crus).
+    Função de módulo e retorno simples para poder rodar num ProcessPoolExecutor.
+    """
+    pagina = Image.new("1", lay["papel"], 1)
+    draw = ImageDraw.Draw(pagina)
+    draw.fontmode = "1"
+    etq_w, etq_h = lay["etq"]
+    for pos, etq in enumerate(etiquetas):
+        lin, col = divmod(pos, lay["cols"])
+        x = lay["margem"] + col * (etq_w + lay["gap"])
+        y = lay["margem"] + lin * (etq_h + lay["gap"])
+        _desenhar_etiqueta(pagina, draw, x, y, etq, lay)
+    return pagina.mode, pagina.size, pagina.tobytes()
+
+_pool_folhas = None
+_pool_folhas_lock = threading.Lock()
+
+def _executor_folhas() -> ProcessPoolExecutor:
+    global _pool_folhas
+    with _pool_folhas_lock:
+        if _pool_folhas is None:
+            # spawn: os processos não herdam conexões SQLite nem threads do servidor
+            _pool_folhas = ProcessPoolExecutor(max_workers=FOLHA_PROCESSOS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        return _pool_folhas
+
+def montar_folha_etiquetas(etiquetas, processos=None) -> list:
+    """
+    Divide as etiquetas em páginas e renderiza cada uma. Com muitas páginas,
+    espalha as páginas entre processos (ProcessPoolExecutor). processos=0 força serial.
+    Retorna a lista de páginas (PIL.Image) na ordem.
+    """
+    lay = layout_folha()
+    dados = [(e["nome"], e["numero_etiqueta"], e["codigo"]) for e in etiquetas]
+    paginas = [dados[i:i + lay["por_pagina"]] for i in range(0, len(dados), lay["por_pagina"])]
+
+    paralelo = FOLHA_PROCESSOS if processos is None else processos
+    if paralelo > 1 and len(paginas) >= FOLHA_MIN_PARALELO:
+        crus = list(_executor_folhas().map(renderizar_pagina_etiquetas, paginas, [lay] * len(paginas)))
+    else:
+        crus = [renderizar_pagina_etiquetas(p, lay) for p in paginas]
+    return [Image.frombytes(modo, tamanho, b) for modo, tamanho, b in crus]
+
+def folha_pdf(paginas) -> bytes:
+    bio = BytesIO()
+    paginas[0].save(bio, "PDF", resolution=FOLHA_DPI, save_all=True, append_images=paginas[1:])
+    return bio.getvalue()
+
+def buscar_etiquetas_para_impressao(ids_raw: str):
+    """ids "5,6,7" -> essas etiquetas; vazio -> todas as pendentes."""
     conn = get_db_connection(); cur = conn.cursor()
 
     if ids_raw:
@@ -757,6 +3944,7 @@ def etiquetas_print():
             cur.execute(f"""
                 SELECT id, numero_etiqueta, nome, codigo
                 FROM etiquetas WHERE id IN ({qmarks})
+                ORDER BY numero_etiqueta, id
             """, tuple(idlist))
         else:
             cur.execute("SELECT id, numero_etiqueta, nome, codigo FROM etiquetas WHERE 1=0")
@@ -764,16 +3952,48 @@ def etiquetas_print():
         cur.execute("""
             SELECT id, numero_etiqueta, nome, codigo
             FROM etiquetas WHERE status='pendente'
+            ORDER BY numero_etiqueta, id
         """)
 
     etiquetas = cur.fetchall()
     conn.close()
+    return etiquetas
+
+@app.route("/etiquetas/folha")
+def etiquetas_folha():
+    """
+    Folha pronta para imprimir, montada no servidor (em vez de uma <img> por etiqueta).
+    ?ids=5,6,7 (vazio = todas pendentes)  &format=pdf (padrão) | png  &pagina=N (só png)
+    """
+    formato = (request.args.get("format") or "pdf").strip().lower()
+    if formato not in ("pdf", "png"):
+        abort(400, "format deve ser pdf ou png")
 
-    # Garante PNG de todas antes de renderizar
-    for e in etiquetas:
-        salvar_barcode_png(e["codigo"], force=True)
+    etiquetas = buscar_etiquetas_para_impressao((request.args.get("ids") or "").strip())
+    if not etiquetas:
+        abort(404, "Nenhuma etiqueta para imprimir.")
 
-    return render_template("etiquetas_print.html", etiquetas=etiquetas)
+    if formato == "pdf":
+        dados = folha_pdf(montar_folha_etiquetas(etiquetas))
+        resp = make_response(dados)
+        resp.mimetype = "application/pdf"
+        resp.headers["Content-Disposition"] = 'inline; filename="etiquetas.pdf"'
+        return resp
+
+    # PNG: uma página por vez
+    por_pagina = layout_folha()["por_pagina"]
+    total = (len(etiquetas) + por_pagina - 1) // por_pagina
+    try:
+        pagina = min(max(int(request.args.get("pagina") or 1), 1), total)
+    except ValueError:
+        pagina = 1
+    trecho = etiquetas[(pagina - 1) * por_pagina: pagina * por_pagina]
+    bio = BytesIO()
+    montar_folha_etiquetas(trecho, processos=0)[0].save(bio, "PNG", dpi=(FOLHA_DPI, FOLHA_DPI))
+    resp = make_response(bio.getvalue())
+    resp.mimetype = "image/png"
+    resp.headers["X-Total-Paginas"] = str(total)
+    return resp
 
 # -------- Marcar selecionadas como impressas ----------
 @app.route("/etiquetas/marcar_impresso", methods=["POST"])
@@ -793,6 +4013,7 @@ def etiquetas_marcar_impresso():
            WHERE id IN ({qmarks})
         """, tuple(ids))
         conn.commit()
+        eventos.publicar("etiquetas", {"acao": "impressas", "ids": ids})
         return {"ok": True, "atualizadas": cur.rowcount}
     except Exception as e:
         conn.rollback()
@@ -814,47 +4035,286 @@ def etiquetas_historico():
     return render_template("etiquetas_historico.html", rows=rows)
 
 #-------------EXPORTAR ESTOQUE ATUAL--------------
+@exportacao("estoque")
+def exportacao_estoque(params):
+    def linhas():
+        conn = conexao_relatorio()
+        try:
+            cur = conn.execute("""
+                SELECT 
+                    nome,
+                    COALESCE(ca, '')   AS ca,
+                    codigo,
+                    COALESCE(saldo, 0) AS saldo
+                FROM itens
+                ORDER BY nome COLLATE NOCASE
+            """)
+            for r in cur:
+                yield [r["nome"], r["ca"], r["codigo"], r["saldo"]]
+        finally:
+            conn.close()
+
+    # Cabeçalho na ordem pedida
+    return (f"estoque_{datetime.now().strftime('%Y%m%d')}", "Estoque",
+            ["Item", "CA", "Código", "Saldo"],
+            linhas())
+
 @app.route("/estoque/export", methods=["GET"])
+@usa_copia_relatorio
 def estoque_export():
+    return cache_exportacoes.responder("estoque", {"format": formato_exportacao()})
+
+# ----------------- Servidor de produção -----------------
+SERVIDOR_THREADS = int(os.environ.get("EPI_THREADS", "16"))   # threads por worker
+SERVIDOR_WORKERS = int(os.environ.get("EPI_WORKERS", "1"))    # processos (fork; só POSIX)
+SERVIDOR_DRENAR = float(os.environ.get("EPI_DRENAR", "30"))   # s esperando requests em andamento ao parar
+# Worker que morre antes de SERVIDOR_VIDA_MINIMA s conta como falha de subida: o
+# próximo espera (0,5 s, 1 s, 2 s... até SERVIDOR_ESPERA_MAX) e, depois de
+# SERVIDOR_FALHAS_MAX falhas seguidas, o servidor desiste (banco ilegível,
+# migração quebrada... não se resolvem sozinhos).
+SERVIDOR_VIDA_MINIMA = 10.0
+SERVIDOR_ESPERA_INICIAL = 0.5
+SERVIDOR_ESPERA_MAX = 30.0
+SERVIDOR_FALHAS_MAX = int(os.environ.get("EPI_FALHAS_WORKER", "5"))
+
+# Ligado no SIGTERM/SIGINT: streams SSE terminam e keep-alives são fechados
+servidor_encerrando = threading.Event()
+
+class _Requisicao(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 10  # keep-alive ocioso devolve a thread ao pool
+    _transferida = False
+
+    def handle_one_request(self):
+        super().handle_one_request()
+        if servidor_encerrando.is_set():
+            self.close_connection = True
+
+    def run_wsgi(self):
+        # /api/stream fica aberto enquanto a aba estiver aberta: não pode ocupar
+        # uma thread do pool fixo. Sai do pool e vai para uma thread própria
+        # (ServidorWSGI._atender) — ou 503, se o worker já tem streams demais.
+        srv = self.server
+        if (isinstance(srv, ServidorWSGI) and threading.current_thread().name.startswith("epi-http")
+                and self.path.split("?", 1)[0] == "/api/stream"):
+            if not srv.reservar_stream():
+                self.send_response(503)
+                self.send_header("Retry-After", "30")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self._transferida = True
+            self.close_connection = True   # acabado o stream, a conexão fecha
+            return
+        super().run_wsgi()
+
+    def finish(self):
+        if self._transferida:
+            return   # o socket segue com a thread do stream
+        super().finish()
+
+class ServidorWSGI(BaseWSGIServer):
+    """
+    Servidor WSGI do werkzeug com um pool FIXO de threads (ThreadPoolExecutor)
+    em vez de uma thread nova por conexão. Aceita o socket já aberto (fd), para
+    vários workers dividirem a mesma porta.
+
+    Exceção: /api/stream (SSE) fica aberto enquanto a tela estiver aberta, então
+    roda numa thread própria, fora do pool — no máximo EVENTOS_CLIENTES_MAX
+    (EPI_EVENTOS_CLIENTES) por worker; passando disso, 503 com Retry-After.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads=SERVIDOR_THREADS, fd=None):
+        super().__init__(host, port, app, handler=_Requisicao, fd=fd)
+        self.threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="epi-http")
+        self._streams_lock = threading.Lock()
+        self.streams = 0
+
+    def process_request(self, request, client_address):
+        self.threads.submit(self._atender, request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _atender(self, request, client_address):
+        handler = None
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        if handler is not None and handler._transferida:
+            threading.Thread(target=self._atender_stream, args=(handler,), name="epi-stream", daemon=True).start()
+            return
+        self.shutdown_request(request)
+
+    def reservar_stream(self) -> bool:
+        """Vaga para mais um /api/stream neste worker (até EVENTOS_CLIENTES_MAX)."""
+        with self._streams_lock:
+            if self.streams >= EVENTOS_CLIENTES_MAX:
+                return False
+            self.streams += 1
+            return True
+
+    def _atender_stream(self, handler):
+        """Thread própria de um /api/stream (o pedido já foi lido pela thread do pool)."""
+        try:
+            handler._transferida = False
+            WSGIRequestHandler.run_wsgi(handler)
+            handler.wfile.flush()
+        except (ConnectionError, TimeoutError):
+            pass   # cliente fechou a aba
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            try:
+                handler.finish()
+            except OSError:
+                pass
+            self.shutdown_request(handler.request)
+            with self._streams_lock:
+                self.streams -= 1
+
+    def drenar(self, timeout=SERVIDOR_DRENAR) -> bool:
+        """Espera os requests em andamento (baixas incluídas) terminarem. True se terminaram."""
+        t = threading.Thread(target=self.threads.shutdown, kwargs={"wait": True}, daemon=True)
+        t.start()
+        t.join(timeout)
+        return not t.is_alive()
+
+def aquecer():
+    """
+    Tudo que o primeiro request pagaria: migrações, índice do catálogo, lista da
+    tela de baixa, fontes e writers de código de barras, templates compilados.
+    Roda antes do fork, então os workers já nascem quentes.
+    """
+    init_db()
     conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 
-            nome,
-            COALESCE(ca, '')   AS ca,
-            codigo,
-            COALESCE(saldo, 0) AS saldo
-        FROM itens
-        ORDER BY nome COLLATE NOCASE
-    """)
-    rows = cur.fetchall()
-    conn.close()
+    try:
+        indice_itens.por_codigo(conn, "")
+        itens_da_tela(conn)
+    finally:
+        conn.close()
+    lay = layout_folha()
+    _fonte(lay["fonte_nome"], negrito=True)
+    _fonte(lay["fonte_linha2"])
+    renderizar_barcode("AQUECER", "svg")
+    renderizar_barcode("AQUECER", "png")
+    for nome in app.jinja_env.list_templates():
+        app.jinja_env.get_template(nome)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Estoque"
-    # Cabeçalho na ordem pedida
-    ws.append(["Item", "CA", "Código", "Saldo"])
+def _rodar_worker(sock, threads):
+    global DB_POOL_MAX
+    if not os.environ.get("EPI_DB_POOL"):
+        DB_POOL_MAX = max(DB_POOL_MAX, threads)   # cada thread do pool pode segurar uma conexão
+        reiniciar_pool()
+    srv = ServidorWSGI(*sock.getsockname()[:2], app, threads=threads, fd=sock.fileno())
+    sock.close()  # o servidor usa uma cópia do fd
 
-    for r in rows:
-        ws.append([r["nome"], r["ca"], r["codigo"], r["saldo"]])
+    def parar(signum, frame):
+        if not servidor_encerrando.is_set():
+            servidor_encerrando.set()
+            # shutdown() espera o serve_forever sair: não pode rodar na própria thread dele
+            threading.Thread(target=srv.shutdown, daemon=True).start()
 
-    bio = BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-
-    nome_arquivo = f"estoque_{datetime.now().strftime('%Y%m%d')}.xlsx"
-    return send_file(
-        bio,
-        as_attachment=True,
-        download_name=nome_arquivo,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    signal.signal(signal.SIGTERM, parar)
+    signal.signal(signal.SIGINT, parar)
+    if RELATORIO_COPIA:
+        copia_relatorios.iniciar()
+    srv.serve_forever()
+    if not srv.drenar():
+        print(f"[epi {os.getpid()}] requests ainda em andamento após {SERVIDOR_DRENAR:.0f}s; saindo assim mesmo",
+              file=sys.stderr)
+    get_pool().fechar()
+    if _pool_folhas is not None:
+        _pool_folhas.shutdown(wait=False, cancel_futures=True)
+
+def servir(host="0.0.0.0", port=5000, threads=SERVIDOR_THREADS, workers=SERVIDOR_WORKERS):
+    """
+    Sobe o servidor de produção: aquece, abre a porta e roda `workers` processos
+    (fork) com `threads` threads cada, todos no mesmo socket. SQLite entre
+    workers: WAL + busy_timeout do pool; as conexões abertas no aquecimento são
+    fechadas antes do fork e cada worker abre as suas. SIGTERM/SIGINT param de
+    aceitar conexões, terminam os requests em andamento e fecham o banco.
+    Worker que morre é substituído; se morrem logo ao subir, com espera
+    crescente e, depois de SERVIDOR_FALHAS_MAX seguidas, sai com código 1.
+    """
+    aquecer()
+    reiniciar_pool()  # conexão SQLite não atravessa fork
+    sock = socket.create_server((host, port), backlog=1024)
+    if workers > 1 and not hasattr(os, "fork"):
+        print("fork indisponível neste sistema: usando 1 worker", file=sys.stderr)
+        workers = 1
+    print(f"EPI em http://{host}:{port} — {workers} worker(s) × {threads} thread(s)", file=sys.stderr)
+    if workers <= 1:
+        _rodar_worker(sock, threads)
+        return
+
+    filhos = {}   # pid -> hora (monotonic) em que subiu
+
+    def novo_worker():
+        pid = os.fork()
+        if pid == 0:
+            codigo = 0
+            try:
+                _rodar_worker(sock, threads)
+            except BaseException:
+                traceback.print_exc()
+                codigo = 1
+            finally:
+                os._exit(codigo)
+        filhos[pid] = time.monotonic()
+
+    def parar(signum, frame):
+        servidor_encerrando.set()
+        for pid in list(filhos):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        novo_worker()
+    signal.signal(signal.SIGTERM, parar)
+    signal.signal(signal.SIGINT, parar)
+    falhas = 0   # mortes seguidas logo depois de subir
+    desistiu = False
+    while filhos:
+        pid, status = os.wait()
+        viveu = time.monotonic() - filhos.pop(pid, time.monotonic())
+        if servidor_encerrando.is_set():
+            continue
+        falhas = falhas + 1 if viveu < SERVIDOR_VIDA_MINIMA else 0
+        if falhas >= SERVIDOR_FALHAS_MAX:
+            print(f"worker {pid} saiu (status {status}): {falhas} falhas seguidas ao subir; desistindo",
+                  file=sys.stderr)
+            desistiu = True
+            parar(None, None)
+            continue
+        espera = min(SERVIDOR_ESPERA_MAX, SERVIDOR_ESPERA_INICIAL * 2 ** (falhas - 1)) if falhas else 0
+        print(f"worker {pid} saiu (status {status}); subindo outro"
+              + (f" em {espera:.1f}s" if espera else ""), file=sys.stderr)
+        if espera and servidor_encerrando.wait(espera):
+            continue   # SIGTERM durante a espera
+        novo_worker()
+    sock.close()
+    if desistiu:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    init_db()
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    import argparse
+    ap = argparse.ArgumentParser(description="Controle de EPI")
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=5000)
+    ap.add_argument("--threads", type=int, default=SERVIDOR_THREADS, help="threads por worker")
+    ap.add_argument("--workers", type=int, default=SERVIDOR_WORKERS, help="processos (POSIX)")
+    ap.add_argument("--dev", action="store_true", help="servidor de desenvolvimento do Flask (app.run)")
+    args = ap.parse_args()
+    if args.dev:
+        init_db()
+        app.run(host=args.host, port=args.port, debug=False)
+    else:
+        servir(args.host, args.port, args.threads, args.workers)
 
 
 
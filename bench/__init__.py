@@ -0,0 +1,10 @@
+"""
+Scripts de carga/benchmark do controle de EPI (rodar com `python -m bench.<script>`).
+
+    dados            gera um banco sintético em escala (itens, movimentações, etiquetas)
+    rodar            suíte dos endpoints quentes: p50/p95/p99 em JSON, compara com uma base
+    stress_baixa     baixas concorrentes no mesmo item (nenhuma pode se perder)
+    folha_etiquetas  folha de etiquetas em PDF: serial x pool de processos
+    servidor         vazão do servidor de desenvolvimento x servidor de produção
+    group_commit     baixas/s com commit por request x group commit (EPI_GROUP_COMMIT)
+"""
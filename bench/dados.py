@@ -0,0 +1,147 @@
+"""
+Gerador de banco sintético para benchmarks.
+
+Cria um estoque.db com o schema atual (migrações do app) e volume configurável:
+itens com nomes/CA realistas, movimentações espalhadas pelos últimos N dias
+(mais bipes em dia útil e horário de turno, itens e pessoas com popularidade
+desigual) e etiquetas (a maioria já impressa). Mesma semente -> mesmos dados
+(datas relativas ao dia em que o banco é gerado).
+
+Uso:
+    python -m bench.dados --saida /tmp/bench.db --itens 10000 --movimentacoes 5000000 --etiquetas 200000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+TIPOS = ["LUVA NITRÍLICA", "LUVA PVC", "LUVA VAQUETA", "BOTA MANOBREIRO", "BOTA PVC", "CAPACETE",
+         "ÓCULOS AMPLA VISÃO", "ÓCULOS ESCURO", "PROTETOR AURICULAR", "MÁSCARA PFF2", "AVENTAL PVC",
+         "CREME PROTETOR", "MANGOTE", "PERNEIRA", "CINTO PARAQUEDISTA", "TALABARTE", "JAQUETA TÉRMICA",
+         "CAMISA UV", "PROTETOR FACIAL", "RESPIRADOR SEMIFACIAL"]
+DETALHES = ["Nº{}", "TAM {}", "COR {}", "LOTE {}"]
+NOMES = ["Ana", "Bruno", "Carla", "Diego", "Elaine", "Fábio", "Gisele", "Hugo", "Irene", "João",
+         "Kátia", "Lucas", "Marta", "Nélson", "Otávio", "Paula", "Quitéria", "Rafael", "Sônia", "Tiago"]
+SOBRENOMES = ["Silva", "Souza", "Oliveira", "Santos", "Pereira", "Lima", "Carvalho", "Gomes", "Ribeiro",
+              "Almeida", "Araújo", "Barbosa", "Caolaço", "Dias", "Ferreira"]
+LOTE = 50_000
+
+
+def gerar(caminho, itens, movimentacoes, etiquetas, destinatarios=400, dias=730, pendentes=500, semente=42):
+    if os.path.exists(caminho):
+        os.remove(caminho)
+    os.environ["EPI_DB"] = caminho
+    import app_epi
+    app_epi.reiniciar_pool(caminho)
+    app_epi.init_db()
+    app_epi.reiniciar_pool()
+
+    import sqlite3
+    rnd = random.Random(semente)
+    conn = sqlite3.connect(caminho)
+    conn.execute("PRAGMA synchronous = OFF")
+    cur = conn.cursor()
+    t0 = time.perf_counter()
+
+    # ---- itens
+    linhas = []
+    for i in range(itens):
+        tipo = TIPOS[i % len(TIPOS)]
+        detalhe = rnd.choice(DETALHES).format(rnd.randint(1, 60))
+        linhas.append((f"{tipo} {detalhe} #{i}", f"EPI{i + 1:06d}", rnd.randint(0, 500), str(rnd.randint(10000, 49999))))
+    cur.execute("BEGIN")
+    cur.executemany("INSERT INTO itens (nome, codigo, saldo, ca) VALUES (?, ?, ?, ?)", linhas)
+    app_epi.abrir_lancamentos(cur)   # saldo inicial no livro-razão
+    conn.commit()
+    ids = [r[0] for r in cur.execute("SELECT id FROM itens ORDER BY id")]
+
+    # popularidade desigual (poucos itens/pessoas concentram a maior parte das saídas)
+    pesos_itens = [1 / (k + 1) ** 0.8 for k in range(len(ids))]
+    pessoas = [f"{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {k}" for k in range(destinatarios)]
+    pesos_pessoas = [1 / (k + 1) ** 0.5 for k in range(len(pessoas))]
+
+    # ---- movimentações, em ordem de data (como chegam de verdade)
+    # O rollup é reconstruído uma vez no fim, sem o trigger por linha (idem o contador de versão).
+    cur.execute("DROP TRIGGER IF EXISTS trg_mov_consumo_ins")
+    cur.execute("DROP TRIGGER IF EXISTS trg_mov_versao_insert")
+    agora = datetime.now().replace(microsecond=0)
+    inicio = agora - timedelta(days=dias)
+    passo = dias * 86400 / max(movimentacoes, 1)
+    t = 0.0
+    feitos = 0
+    while feitos < movimentacoes:
+        n = min(LOTE, movimentacoes - feitos)
+        itens_lote = rnd.choices(ids, weights=pesos_itens, k=n)
+        pessoas_lote = rnd.choices(pessoas, weights=pesos_pessoas, k=n)
+        lote = []
+        for k in range(n):
+            t += rnd.expovariate(1 / passo)
+            quando = inicio + timedelta(seconds=t)
+            if quando.weekday() >= 5 and rnd.random() < 0.8:   # fim de semana: bem menos
+                quando += timedelta(days=7 - quando.weekday())
+            quando = min(quando.replace(hour=6 + int(quando.hour * 14 / 24)), agora)  # turno 06h-20h
+            qtd = 1 if rnd.random() < 0.9 else rnd.randint(2, 10)
+            lote.append((itens_lote[k], qtd, pessoas_lote[k], quando.strftime("%Y-%m-%d %H:%M:%S")))
+        lote.sort(key=lambda m: m[3])
+        cur.execute("BEGIN")
+        cur.executemany("INSERT INTO movimentacoes (item_id, quantidade, destinatario, data) VALUES (?, ?, ?, ?)", lote)
+        conn.commit()
+        feitos += n
+        print(f"\rmovimentações: {feitos}/{movimentacoes}", end="", file=sys.stderr)
+    print(file=sys.stderr)
+    cur.execute("BEGIN")
+    app_epi.vincular_destinatarios(cur)    # destinatario_id + cadastro de destinatários
+    app_epi._mig_005_consumo_diario(cur)   # recria o trigger e reconstrói o rollup
+    app_epi._mig_012_versao_movimentacoes(cur)
+    conn.commit()
+
+    # ---- etiquetas: as últimas `pendentes` ficam na fila, o resto já foi impresso
+    cur.execute("BEGIN")
+    feitos = 0
+    nomes = dict(cur.execute("SELECT id, nome FROM itens").fetchall())
+    while feitos < etiquetas:
+        n = min(LOTE, etiquetas - feitos)
+        lote = []
+        for k in range(feitos, feitos + n):
+            iid = rnd.choice(ids)
+            impresso = k < etiquetas - pendentes
+            lote.append((iid, f"EPI{iid:06d}", nomes[iid], k + 1, "impresso" if impresso else "pendente",
+                         "2024-01-01 08:00:00" if impresso else None))
+        cur.executemany("""
+            INSERT INTO etiquetas (item_id, codigo, nome, numero_etiqueta, status, impresso_em)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, lote)
+        feitos += n
+    cur.execute("UPDATE contadores SET valor = ? WHERE nome = 'etiqueta'", (etiquetas,))
+    conn.commit()
+    cur.execute("ANALYZE")
+    conn.close()
+
+    return {
+        "banco": caminho, "itens": itens, "movimentacoes": movimentacoes, "etiquetas": etiquetas,
+        "pendentes": min(pendentes, etiquetas), "destinatarios": destinatarios, "dias": dias, "semente": semente,
+        "tamanho_mb": round(os.path.getsize(caminho) / 1e6, 1), "segundos": round(time.perf_counter() - t0, 1),
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--saida", required=True, help="arquivo .db a criar (sobrescreve)")
+    ap.add_argument("--itens", type=int, default=10_000)
+    ap.add_argument("--movimentacoes", type=int, default=5_000_000)
+    ap.add_argument("--etiquetas", type=int, default=200_000)
+    ap.add_argument("--pendentes", type=int, default=500, help="etiquetas ainda na fila")
+    ap.add_argument("--destinatarios", type=int, default=400)
+    ap.add_argument("--dias", type=int, default=730, help="período coberto pelas movimentações")
+    ap.add_argument("--semente", type=int, default=42)
+    args = ap.parse_args(argv)
+    resumo = gerar(args.saida, args.itens, args.movimentacoes, args.etiquetas,
+                   args.destinatarios, args.dias, args.pendentes, args.semente)
+    print(json.dumps(resumo, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
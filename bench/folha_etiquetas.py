@@ -0,0 +1,46 @@
+"""
+Benchmark da folha de etiquetas montada no servidor (/etiquetas/folha).
+
+Monta N etiquetas sintéticas em PDF de duas formas — serial (1 processo) e
+com o pool de processos — e mostra páginas, tempo, etiquetas/s e tamanho do PDF.
+
+Uso:
+    python -m bench.folha_etiquetas --etiquetas 1000
+"""
+import argparse
+import sys
+import time
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--etiquetas", type=int, default=1000)
+    ap.add_argument("--processos", type=int, default=None, help="tamanho do pool (padrão: nº de CPUs)")
+    args = ap.parse_args(argv)
+
+    import app_epi
+    if args.processos:
+        app_epi.FOLHA_PROCESSOS = args.processos
+
+    etiquetas = [
+        {"nome": f"LUVA NITRÍLICA TAM {i % 4 + 7} — LOTE {i // 50}", "numero_etiqueta": i + 1,
+         "codigo": f"EPI{i % 300 + 1:06d}"}
+        for i in range(args.etiquetas)
+    ]
+
+    # aquece o pool (spawn dos processos) para medir só a renderização
+    app_epi.montar_folha_etiquetas(etiquetas[:app_epi.layout_folha()["por_pagina"] * app_epi.FOLHA_MIN_PARALELO])
+
+    for nome, processos in (("serial", 0), (f"pool ({app_epi.FOLHA_PROCESSOS} proc.)", None)):
+        t0 = time.perf_counter()
+        paginas = app_epi.montar_folha_etiquetas(etiquetas, processos=processos)
+        t_render = time.perf_counter() - t0
+        pdf = app_epi.folha_pdf(paginas)
+        total = time.perf_counter() - t0
+        print(f"{nome:>18}: {len(paginas)} páginas | render {t_render:.2f}s | com PDF {total:.2f}s "
+              f"| {args.etiquetas / total:.0f} etiquetas/s | PDF {len(pdf) / 1024:.0f} KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Baixas por segundo: commit por request x group commit (EPI_GROUP_COMMIT).
+
+Vários leitores (threads) bipam ao mesmo tempo por POST /api/baixa (um bip por
+request, como o celular), cada modo sobre um banco novo. No fim confere que
+nenhuma baixa se perdeu e mostra bips/s, latência e bips por transação.
+Com --synchronous FULL cada commit paga um fsync, como num cartão SD/NAS lento.
+
+Uso:
+    python -m bench.group_commit --threads 16 --bips 200 --synchronous FULL
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ITENS = 50
+
+
+def medir(app_epi, modo, args, pasta):
+    banco = os.path.join(pasta, f"{modo}.db")
+    app_epi.reiniciar_pool(banco)
+    app_epi.GRUPO_COMMIT = modo == "grupo"
+    app_epi.init_db()
+    total = args.threads * args.bips
+    conn = app_epi.get_db_connection()
+    conn.executemany("INSERT INTO itens (nome, codigo, saldo) VALUES (?, ?, ?)",
+                     [(f"LUVA TESTE {i}", f"GC{i:04d}", total) for i in range(ITENS)])
+    conn.commit()
+    conn.close()
+
+    latencias, erros = [], []
+    lock = threading.Lock()
+    largada = threading.Barrier(args.threads + 1)
+
+    def leitor(n):
+        client = app_epi.app.test_client()
+        with client.session_transaction() as s:
+            s["user"] = "admin"
+        minhas = []
+        largada.wait()
+        for k in range(args.bips):
+            corpo = {"codigo": f"GC{(n * 7 + k) % ITENS:04d}", "destinatario": f"leitor {n}"}
+            t0 = time.perf_counter()
+            r = client.post("/api/baixa", data=json.dumps(corpo), content_type="application/json")
+            minhas.append(time.perf_counter() - t0)
+            if r.status_code != 200 or not r.get_json().get("ok") or "restante" not in r.get_json():
+                with lock:
+                    erros.append(r.get_data(as_text=True)[:200])
+        with lock:
+            latencias.extend(minhas)
+
+    threads = [threading.Thread(target=leitor, args=(n,)) for n in range(args.threads)]
+    for t in threads:
+        t.start()
+    largada.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    duracao = time.perf_counter() - t0
+
+    conn = app_epi.get_db_connection()
+    movs = conn.execute("SELECT COUNT(*) FROM movimentacoes").fetchone()[0]
+    baixado = conn.execute("SELECT ? - SUM(saldo) FROM itens", (total * ITENS,)).fetchone()[0]
+    conn.close()
+    grupo = app_epi.escritor_baixas.stats()
+    latencias.sort()
+    pct = lambda p: round(latencias[min(len(latencias) - 1, int(p * len(latencias)))] * 1000, 2)
+    return {
+        "modo": modo, "bips": total, "bips_s": round(total / duracao, 1),
+        "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+        "media_ms": round(statistics.fmean(latencias) * 1000, 2),
+        "erros": len(erros), "movimentacoes": movs, "baixado": baixado,
+        "bips_por_transacao": grupo["bips_por_transacao"] if modo == "grupo" else 1.0,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--threads", type=int, default=16, help="leitores simultâneos")
+    ap.add_argument("--bips", type=int, default=200, help="bips por leitor")
+    ap.add_argument("--synchronous", choices=("NORMAL", "FULL"), default="NORMAL",
+                    help="PRAGMA synchronous das conexões (FULL = fsync a cada commit)")
+    ap.add_argument("--janela-ms", type=float, default=None, help="EPI_GRUPO_JANELA_MS do modo grupo")
+    args = ap.parse_args(argv)
+
+    pasta = tempfile.mkdtemp(prefix="epi_group_commit_")
+    os.environ["EPI_DB"] = os.path.join(pasta, "direto.db")
+    sys.path.insert(0, RAIZ)
+    import app_epi
+    app_epi.PRAGMAS_CONEXAO = tuple(
+        f"PRAGMA synchronous = {args.synchronous}" if "synchronous" in p else p for p in app_epi.PRAGMAS_CONEXAO)
+    if args.janela_ms is not None:
+        app_epi.escritor_baixas.janela = args.janela_ms / 1000
+
+    resultados = [medir(app_epi, "direto", args, pasta), medir(app_epi, "grupo", args, pasta)]
+
+    print(f"{args.threads} leitores x {args.bips} bips, synchronous={args.synchronous}, CPUs: {os.cpu_count()}")
+    print(f"{'modo':<8}{'bips/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'bips/tx':>9}{'erros':>7}{'gravadas':>10}")
+    for r in resultados:
+        print(f"{r['modo']:<8}{r['bips_s']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+              f"{r['bips_por_transacao']:>9}{r['erros']:>7}{r['movimentacoes']:>10}")
+    direto, grupo = resultados
+    print(f"group commit: {grupo['bips_s'] / direto['bips_s']:.2f}x a vazão do commit por request")
+
+    perdidas = [r["modo"] for r in resultados if r["erros"] or r["movimentacoes"] != r["bips"] or r["baixado"] != r["bips"]]
+    if perdidas:
+        print("ERRO: baixas perdidas ou com erro em:", ", ".join(perdidas))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Suíte de benchmark dos endpoints quentes, com saída JSON comparável entre execuções.
+
+Roda cada cenário N vezes (depois de um aquecimento) e mede p50/p95/p99, média
+e vazão. Por padrão usa o test client do Flask sobre uma CÓPIA do banco (as
+baixas/reposições alteram dados); com --url mede um servidor já rodando por HTTP
+(keep-alive). O banco (--banco, gerado por bench.dados) também fornece os
+códigos e destinatários sorteados nos requests.
+
+Com --base compara com um JSON anterior e sai com código 1 se algum cenário
+piorou além da tolerância (p95 ou vazão), ou se passou a dar erro.
+
+Uso:
+    python -m bench.dados --saida /tmp/bench.db
+    python -m bench.rodar --banco /tmp/bench.db --saida base.json
+    python -m bench.rodar --banco /tmp/bench.db --saida atual.json --base base.json --tolerancia 0.25
+    python -m bench.rodar --comparar base.json atual.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode, urlsplit
+
+SENHA = "Geo@#2025"
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def br(d: date) -> str:
+    return d.strftime("%d/%m/%Y")
+
+
+def amostras(banco):
+    """Códigos e destinatários reais do banco, para os requests parecerem os de produção."""
+    conn = sqlite3.connect(f"file:{banco}?mode=ro", uri=True)
+    try:
+        codigos = [r[0] for r in conn.execute("SELECT codigo FROM itens ORDER BY id LIMIT 500")]
+        ids = [r[0] for r in conn.execute("SELECT id FROM itens ORDER BY id LIMIT 500")]
+        destinatarios = [r[0] for r in conn.execute("""
+            SELECT destinatario FROM consumo_diario GROUP BY destinatario
+            ORDER BY SUM(movimentos) DESC LIMIT 50
+        """)]
+        volume = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                  for t in ("itens", "movimentacoes", "etiquetas")}
+    finally:
+        conn.close()
+    return {"codigos": codigos, "ids": ids, "destinatarios": destinatarios or ["Fulano"], "volume": volume}
+
+
+def cenarios(a, rnd):
+    """nome -> (repetições padrão, função que devolve (método, caminho, form))."""
+    hoje = date.today()
+    return {
+        "baixa": (300, lambda: ("POST", "/", {"codigo": rnd.choice(a["codigos"]),
+                                              "destinatario": rnd.choice(a["destinatarios"])})),
+        "relatorios": (100, lambda: ("GET", "/relatorios", None)),
+        "relatorios_filtro": (100, lambda: ("GET", "/relatorios?" + urlencode({
+            "destinatario": rnd.choice(a["destinatarios"]), "data_ini": br(hoje - timedelta(days=30))}), None)),
+        "relatorios_export": (10, lambda: ("GET", "/relatorios/export?" + urlencode({
+            "format": "csv", "data_ini": br(hoje - timedelta(days=7))}), None)),
+        "estoque_export": (10, lambda: ("GET", "/estoque/export?format=xlsx", None)),
+        "etiquetas_print": (20, lambda: ("GET", "/etiquetas/print", None)),
+        "repor": (100, lambda: ("GET", "/repor", None)),
+        "repor_busca": (100, lambda: ("GET", "/repor?q=luva", None)),
+        "repor_post": (100, lambda: ("POST", "/repor", {"item_id": rnd.choice(a["ids"]), "qtd": 1})),
+    }
+
+
+class ClienteFlask:
+    def __init__(self, banco):
+        os.environ["EPI_DB"] = banco
+        sys.path.insert(0, RAIZ)
+        import app_epi
+        app_epi.reiniciar_pool(banco)
+        app_epi.init_db()
+        self.client = app_epi.app.test_client()
+        with self.client.session_transaction() as s:
+            s["user"] = "admin"
+
+    def fazer(self, metodo, caminho, form):
+        r = self.client.open(caminho, method=metodo, data=form, headers={"Accept": "application/json"})
+        r.get_data()  # consome o corpo (exportações são stream)
+        return r.status_code, r
+
+
+class ClienteHTTP:
+    def __init__(self, url):
+        u = urlsplit(url)
+        self.host, self.porta = u.hostname, u.port or 80
+        self.conn = http.client.HTTPConnection(self.host, self.porta, timeout=120)
+        status, resp = self.fazer("POST", "/login", {"senha": SENHA})
+        self.cookie = (resp.getheader("Set-Cookie") or "").split(";")[0]
+
+    def fazer(self, metodo, caminho, form):
+        headers = {"Accept": "application/json"}
+        if getattr(self, "cookie", None):
+            headers["Cookie"] = self.cookie
+        corpo = None
+        if form is not None:
+            corpo = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            self.conn.request(metodo, caminho, body=corpo, headers=headers)
+            r = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.porta, timeout=120)
+            self.conn.request(metodo, caminho, body=corpo, headers=headers)
+            r = self.conn.getresponse()
+        r.read()
+        return r.status, r
+
+
+def medir(cliente, gerar, n):
+    aquecimento = min(5, max(1, n // 10))
+    for _ in range(aquecimento):
+        cliente.fazer(*gerar())
+    tempos, erros = [], 0
+    t_total = time.perf_counter()
+    for _ in range(n):
+        req = gerar()
+        t0 = time.perf_counter()
+        status, _ = cliente.fazer(*req)
+        tempos.append(time.perf_counter() - t0)
+        if status >= 400:
+            erros += 1
+    t_total = time.perf_counter() - t_total
+    tempos.sort()
+    pct = lambda p: round(tempos[min(len(tempos) - 1, int(p * len(tempos)))] * 1000, 3)
+    return {
+        "n": n, "erros": erros,
+        "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+        "media_ms": round(statistics.fmean(tempos) * 1000, 3),
+        "req_s": round(n / t_total, 2),
+    }
+
+
+def meta(a, modo):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ,
+                                capture_output=True, text=True, timeout=5).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "quando": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": commit, "modo": modo,
+        "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+        "plataforma": platform.platform(), "cpus": os.cpu_count(), "volume": a["volume"],
+    }
+
+
+def comparar(base, atual, tolerancia, piso_ms=1.0):
+    """
+    Lista de (cenário, métrica, antes, depois, variação, regrediu).
+    Regressão: p95 subiu mais que `tolerancia` (e mais que piso_ms, para não
+    acusar ruído em cenários de décimos de ms), vazão caiu mais que `tolerancia`,
+    ou apareceram erros.
+    """
+    linhas = []
+    for nome, depois in atual["cenarios"].items():
+        antes = base.get("cenarios", {}).get(nome)
+        if not antes:
+            continue
+        for metrica in ("p50_ms", "p95_ms", "p99_ms", "req_s", "erros"):
+            a, d = antes[metrica], depois[metrica]
+            var = (d - a) / a if a else 0.0
+            if metrica == "p95_ms":
+                ruim = d > a * (1 + tolerancia) and d - a > piso_ms
+            elif metrica == "req_s":
+                ruim = d < a * (1 - tolerancia)
+            elif metrica == "erros":
+                ruim = d > a
+            else:
+                ruim = False   # p50/p99 só informativos
+            linhas.append((nome, metrica, a, d, var, ruim))
+    return linhas
+
+
+def imprimir_comparacao(linhas):
+    print(f"{'cenário':<20}{'métrica':<9}{'antes':>12}{'depois':>12}{'var':>9}")
+    for nome, metrica, a, d, var, ruim in linhas:
+        print(f"{nome:<20}{metrica:<9}{a:>12}{d:>12}{var:>+8.0%}{'  <-- REGRESSÃO' if ruim else ''}")
+    return any(l[5] for l in linhas)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--banco", help="banco gerado por bench.dados")
+    ap.add_argument("--url", help="mede um servidor já rodando (ex.: http://127.0.0.1:5000) em vez do test client")
+    ap.add_argument("--cenarios", help="lista separada por vírgula (padrão: todos)")
+    ap.add_argument("--fator", type=float, default=1.0, help="multiplica as repetições de cada cenário")
+    ap.add_argument("--semente", type=int, default=1)
+    ap.add_argument("--saida", help="grava o resultado JSON neste arquivo")
+    ap.add_argument("--base", help="JSON de uma execução anterior para comparar")
+    ap.add_argument("--tolerancia", type=float, default=0.25, help="piora aceita (0.25 = 25%%)")
+    ap.add_argument("--comparar", nargs=2, metavar=("BASE", "ATUAL"), help="só compara dois JSONs")
+    args = ap.parse_args(argv)
+
+    if args.comparar:
+        with open(args.comparar[0], encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.comparar[1], encoding="utf-8") as f:
+            atual = json.load(f)
+        return 1 if imprimir_comparacao(comparar(base, atual, args.tolerancia)) else 0
+
+    if not args.banco:
+        ap.error("--banco é obrigatório (gere com python -m bench.dados)")
+    a = amostras(args.banco)
+    rnd = random.Random(args.semente)
+    todos = cenarios(a, rnd)
+    escolhidos = args.cenarios.split(",") if args.cenarios else list(todos)
+    desconhecidos = [c for c in escolhidos if c not in todos]
+    if desconhecidos:
+        ap.error(f"cenário(s) desconhecido(s): {', '.join(desconhecidos)}")
+
+    if args.url:
+        cliente, modo = ClienteHTTP(args.url), "http"
+    else:
+        copia = os.path.join(tempfile.mkdtemp(prefix="epi_bench_"), "estoque.db")
+        shutil.copyfile(args.banco, copia)
+        cliente, modo = ClienteFlask(copia), "test_client"
+
+    resultado = {"versao": 1, "meta": meta(a, modo), "cenarios": {}}
+    for nome in escolhidos:
+        repeticoes, gerar = todos[nome]
+        n = max(1, int(repeticoes * args.fator))
+        r = medir(cliente, gerar, n)
+        resultado["cenarios"][nome] = r
+        print(f"{nome:<20} n={r['n']:<5} p50={r['p50_ms']:>9.2f} ms  p95={r['p95_ms']:>9.2f} ms  "
+              f"p99={r['p99_ms']:>9.2f} ms  {r['req_s']:>9.1f} req/s  erros={r['erros']}", file=sys.stderr)
+
+    texto = json.dumps(resultado, ensure_ascii=False, indent=2)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+    else:
+        print(texto)
+
+    if args.base:
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+        if imprimir_comparacao(comparar(base, resultado, args.tolerancia)):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Comparativo de vazão: servidor de desenvolvimento (app.run) x servidor de produção (servir).
+
+Sobe cada modo como um processo de verdade (python app_epi.py ...) sobre uma
+cópia sintética do banco e dispara clientes HTTP keep-alive simultâneos com a
+mistura de um posto de baixa:
+  40% GET /api/itens (If-None-Match -> 304)   20% GET /api/itens/search?q=luva
+  20% GET /                                   20% POST /api/baixa
+No fim manda SIGTERM e confere que toda baixa confirmada (200/ok) foi gravada.
+
+Uso:
+    python -m bench.servidor --clientes 32 --segundos 10 --workers 4 --threads 16
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SENHA = "senha=Geo%40%232025"
+
+
+def preparar_banco(caminho, itens=500):
+    os.environ["EPI_DB"] = caminho
+    import app_epi
+    app_epi.reiniciar_pool(caminho)
+    app_epi.init_db()
+    conn = app_epi.get_db_connection()
+    conn.executemany("INSERT INTO itens (nome, codigo, saldo) VALUES (?, ?, ?)",
+                     [(f"LUVA TESTE {i}", f"BENCH{i:05d}", 1_000_000) for i in range(itens)])
+    conn.commit()
+    conn.close()
+    app_epi.reiniciar_pool()
+
+
+def esperar_porta(porta, limite=20):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        try:
+            h = http.client.HTTPConnection("127.0.0.1", porta, timeout=1)
+            h.request("GET", "/ping")
+            if h.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"servidor não respondeu na porta {porta}")
+
+
+def login(porta) -> str:
+    h = http.client.HTTPConnection("127.0.0.1", porta)
+    h.request("POST", "/login", body=SENHA, headers={"Content-Type": "application/x-www-form-urlencoded"})
+    r = h.getresponse()
+    r.read()
+    return r.getheader("Set-Cookie").split(";")[0]
+
+
+def carga(porta, clientes, segundos, itens):
+    cookie = login(porta)
+    h = http.client.HTTPConnection("127.0.0.1", porta)
+    h.request("GET", "/api/itens")
+    r = h.getresponse()
+    r.read()
+    etag = r.getheader("ETag")
+
+    latencias, erros, baixas_ok = [], [0], [0]
+    lock = threading.Lock()
+    largada = threading.Barrier(clientes + 1)
+    fim = [0.0]
+
+    def cliente(n):
+        rnd = random.Random(n)
+        conn = http.client.HTTPConnection("127.0.0.1", porta, timeout=30)
+        minhas, ok = [], 0
+        largada.wait()
+        while time.monotonic() < fim[0]:
+            sorteio = rnd.random()
+            t0 = time.perf_counter()
+            try:
+                if sorteio < 0.4:
+                    conn.request("GET", "/api/itens", headers={"If-None-Match": etag})
+                elif sorteio < 0.6:
+                    conn.request("GET", "/api/itens/search?q=luva&limit=20")
+                elif sorteio < 0.8:
+                    conn.request("GET", "/")
+                else:
+                    corpo = json.dumps({"codigo": f"BENCH{rnd.randrange(itens):05d}", "destinatario": f"bench {n}"})
+                    conn.request("POST", "/api/baixa", body=corpo,
+                                 headers={"Content-Type": "application/json", "Cookie": cookie})
+                r = conn.getresponse()
+                dados = r.read()
+                if r.status >= 400:
+                    raise RuntimeError(r.status)
+                if sorteio >= 0.8 and json.loads(dados).get("ok"):
+                    ok += 1
+                minhas.append(time.perf_counter() - t0)
+            except Exception:
+                with lock:
+                    erros[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", porta, timeout=30)
+        with lock:
+            latencias.extend(minhas)
+            baixas_ok[0] += ok
+
+    threads = [threading.Thread(target=cliente, args=(n,)) for n in range(clientes)]
+    for t in threads:
+        t.start()
+    fim[0] = time.monotonic() + segundos
+    largada.wait()
+    for t in threads:
+        t.join()
+    return latencias, erros[0], baixas_ok[0]
+
+
+def medir(nome, args_servidor, args, pasta):
+    banco = os.path.join(pasta, f"{nome}.db")
+    preparar_banco(banco, args.itens)
+    env = dict(os.environ, EPI_DB=banco)
+    proc = subprocess.Popen([sys.executable, os.path.join(RAIZ, "app_epi.py"), "--port", str(args.porta)] + args_servidor,
+                            env=env, cwd=RAIZ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        esperar_porta(args.porta)
+        latencias, erros, baixas_ok = carga(args.porta, args.clientes, args.segundos, args.itens)
+    finally:
+        t0 = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        parada = time.perf_counter() - t0
+
+    conn = sqlite3.connect(banco)
+    gravadas = conn.execute("SELECT COUNT(*) FROM movimentacoes").fetchone()[0]
+    conn.close()
+    latencias.sort()
+    pct = lambda p: latencias[min(len(latencias) - 1, int(p * len(latencias)))] * 1000 if latencias else 0.0
+    return {
+        "modo": nome, "requests": len(latencias), "req_s": round(len(latencias) / args.segundos, 1),
+        "p50_ms": round(pct(0.50), 2), "p95_ms": round(pct(0.95), 2), "p99_ms": round(pct(0.99), 2),
+        "media_ms": round(statistics.fmean(latencias) * 1000, 2) if latencias else 0.0,
+        "erros": erros, "baixas_ok": baixas_ok, "baixas_gravadas": gravadas, "parada_s": round(parada, 2),
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--clientes", type=int, default=32, help="conexões keep-alive simultâneas")
+    ap.add_argument("--segundos", type=float, default=10)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--itens", type=int, default=500)
+    ap.add_argument("--porta", type=int, default=5077)
+    args = ap.parse_args(argv)
+
+    pasta = tempfile.mkdtemp(prefix="epi_servidor_")
+    resultados = [
+        medir("dev", ["--dev"], args, pasta),
+        medir("producao", ["--workers", str(args.workers), "--threads", str(args.threads)], args, pasta),
+    ]
+
+    print(f"{args.clientes} clientes, {args.segundos:.0f}s, CPUs: {os.cpu_count()}")
+    print(f"{'modo':<10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'erros':>7}{'baixas ok/gravadas':>21}{'parada s':>10}")
+    for r in resultados:
+        print(f"{r['modo']:<10}{r['req_s']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['erros']:>7}"
+              f"{r['baixas_ok']:>12}/{r['baixas_gravadas']:<8}{r['parada_s']:>10}")
+    perdidas = [r["modo"] for r in resultados if r["baixas_gravadas"] < r["baixas_ok"]]
+    if perdidas:
+        print("ERRO: baixa confirmada e não gravada em:", ", ".join(perdidas))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Teste de estresse da baixa concorrente.
+
+Vários "leitores" (threads) bipam o MESMO item ao mesmo tempo pela rota `/`.
+No fim confere que nenhuma baixa se perdeu:
+  saldo_final == saldo_inicial - total_de_bips   e
+  movimentacoes == total_de_bips
+e mostra quantos bips por segundo o servidor aguentou.
+
+Uso:
+    python -m bench.stress_baixa --threads 8 --bips 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--threads", type=int, default=8, help="leitores simultâneos")
+    ap.add_argument("--bips", type=int, default=200, help="bips por leitor")
+    args = ap.parse_args(argv)
+
+    pasta = tempfile.mkdtemp(prefix="epi_stress_")
+    os.environ["EPI_DB"] = os.path.join(pasta, "estoque.db")
+    import app_epi
+
+    app_epi.init_db()
+    total = args.threads * args.bips
+    saldo_inicial = total + 10
+
+    conn = app_epi.get_db_connection()
+    conn.execute("INSERT INTO itens (nome, codigo, saldo) VALUES (?, ?, ?)", ("LUVA TESTE", "STRESS01", saldo_inicial))
+    conn.commit()
+    conn.close()
+
+    erros = []
+    largada = threading.Barrier(args.threads)
+
+    def leitor(n):
+        client = app_epi.app.test_client()
+        with client.session_transaction() as s:
+            s["user"] = "admin"
+        largada.wait()
+        for _ in range(args.bips):
+            r = client.post("/", data={"codigo": "STRESS01", "destinatario": f"leitor {n}"},
+                            headers={"Accept": "application/json"})
+            if r.status_code != 200 or not r.get_json().get("ok"):
+                erros.append(r.get_data(as_text=True))
+
+    threads = [threading.Thread(target=leitor, args=(n,)) for n in range(args.threads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracao = time.perf_counter() - t0
+
+    conn = app_epi.get_db_connection()
+    saldo_final = conn.execute("SELECT saldo FROM itens WHERE codigo = 'STRESS01'").fetchone()[0]
+    movs = conn.execute("SELECT COUNT(*) FROM movimentacoes").fetchone()[0]
+    conn.close()
+
+    print(f"bips: {total} em {duracao:.2f}s  ->  {total / duracao:.0f} bips/s ({args.threads} threads)")
+    print(f"saldo: {saldo_inicial} -> {saldo_final} (esperado {saldo_inicial - total})")
+    print(f"movimentacoes: {movs} (esperado {total}); erros: {len(erros)}")
+
+    ok = not erros and saldo_final == saldo_inicial - total and movs == total
+    print("OK: nenhuma baixa perdida" if ok else "FALHOU: baixas perdidas ou com erro")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
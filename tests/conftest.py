@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import app_epi  # noqa: E402
+
+
+@pytest.fixture
+def epi(tmp_path, monkeypatch):
+    """app_epi sobre um banco novo em tmp_path, com caches e índices zerados."""
+    monkeypatch.setattr(app_epi, "ARQUIVO_DIR", str(tmp_path / "arquivo"))
+    monkeypatch.setattr(app_epi, "EXPORT_CACHE_DIR", str(tmp_path / "cache_exportacoes"))
+    monkeypatch.setattr(app_epi, "RELATORIO_DB", str(tmp_path / "relatorio.db"))
+    for nome, classe in (("indice_itens", app_epi.IndiceItens),
+                         ("indice_destinatarios", app_epi.IndiceDestinatarios),
+                         ("cache_inventario", app_epi.CacheInventario),
+                         ("copia_relatorios", app_epi.CopiaRelatorios),
+                         ("cache_exportacoes", app_epi.CacheExportacoes),
+                         ("cache_barcodes", app_epi.CacheBarcodes),
+                         ("eventos", app_epi.BarramentoEventos)):
+        monkeypatch.setattr(app_epi, nome, classe())
+    app_epi.reiniciar_pool(str(tmp_path / "estoque.db"))
+    app_epi.init_db()
+    yield app_epi
+    app_epi.reiniciar_pool()
+
+
+@pytest.fixture
+def cliente(epi):
+    c = epi.app.test_client()
+    with c.session_transaction() as s:
+        s["user"] = epi.ADMIN_USER
+    return c
+
+
+@pytest.fixture
+def itens(epi):
+    """Cria itens {codigo: saldo} e devolve {codigo: id}."""
+    def criar(saldos):
+        conn = epi.get_db_connection()
+        try:
+            ids = {}
+            for codigo, saldo in saldos.items():
+                ids[codigo] = conn.execute("INSERT INTO itens (nome, codigo, saldo) VALUES (?, ?, ?) RETURNING id",
+                                           (f"ITEM {codigo}", codigo, saldo)).fetchone()[0]
+                epi.lancar_estoque(conn, [(ids[codigo], "entrada", saldo, "cadastro")])
+            conn.commit()
+            return ids
+        finally:
+            conn.close()
+    return criar
+
+
+def bipar(cliente, *codigos, destinatario="Fulano"):
+    for codigo in codigos:
+        r = cliente.post("/api/baixa", json={"codigo": codigo, "destinatario": destinatario})
+        assert r.status_code == 200 and r.get_json()["ok"], r.get_data(as_text=True)
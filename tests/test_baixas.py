@@ -0,0 +1,41 @@
+def _saldo(epi, item_id):
+    conn = epi.get_db_connection()
+    try:
+        return conn.execute("SELECT saldo FROM itens WHERE id = ?", (item_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _movimentacoes(epi):
+    conn = epi.get_db_connection()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM movimentacoes").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_reenvio_do_mesmo_lote_nao_baixa_de_novo(epi, cliente, itens):
+    ids = itens({"A1": 10, "B1": 10})
+    lote = [{"id": "bip-1", "codigo": "A1", "destinatario": "Fulano"},
+            {"id": "bip-2", "codigo": "A1", "destinatario": "Fulano"},
+            {"id": "bip-3", "codigo": "B1", "destinatario": "Fulano"}]
+
+    primeira = cliente.post("/api/baixa", json=lote).get_json()
+    assert primeira["aplicadas"] == 3
+    assert not any(r.get("duplicado") for r in primeira["resultados"])
+
+    segunda = cliente.post("/api/baixa", json=lote).get_json()
+    assert segunda["ok"] and segunda["falhas"] == 0
+    assert all(r["duplicado"] for r in segunda["resultados"])
+    assert [r["saldo"] for r in segunda["resultados"]] == [8, 8, 9]
+
+    assert _saldo(epi, ids["A1"]) == 8 and _saldo(epi, ids["B1"]) == 9
+    assert _movimentacoes(epi) == 3
+
+
+def test_bips_sem_id_continuam_baixando(epi, cliente, itens):
+    ids = itens({"A1": 10})
+    lote = [{"codigo": "A1", "destinatario": "Fulano"}]
+    cliente.post("/api/baixa", json=lote)
+    cliente.post("/api/baixa", json=lote)
+    assert _saldo(epi, ids["A1"]) == 8
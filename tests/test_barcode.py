@@ -0,0 +1,12 @@
+def test_barcode_codigo_longo_e_recusado_sem_renderizar(epi):
+    cliente = epi.app.test_client()
+    r = cliente.get("/barcode/" + "A" * (epi.BARCODE_CODIGO_MAX + 1) + "?format=png")
+    assert r.status_code == 400
+    assert epi.cache_barcodes.stats()["renders"] == 0
+
+
+def test_barcode_etag(epi):
+    cliente = epi.app.test_client()
+    r = cliente.get("/barcode/EPI000001")
+    assert r.status_code == 200 and r.mimetype == "image/svg+xml"
+    assert cliente.get("/barcode/EPI000001", headers={"If-None-Match": r.headers["ETag"]}).status_code == 304
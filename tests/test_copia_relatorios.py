@@ -0,0 +1,26 @@
+from conftest import bipar
+
+
+def test_excluir_item_forca_copia_nova(epi, cliente, itens, monkeypatch):
+    monkeypatch.setattr(epi, "RELATORIO_COPIA", True)
+    monkeypatch.setattr(epi, "RELATORIO_ESCRITAS", 1)
+    ids = itens({"A1": 10, "B1": 10})
+    bipar(cliente, "A1", "A1", "B1")
+    assert epi.copia_relatorios.renovar(forcar=True)
+
+    conn = epi.get_db_connection()
+    antes = epi.versao_dados(conn)
+    conn.close()
+    # apaga o item dono da movimentação mais nova: a versão tem que mudar mesmo assim
+    assert cliente.post(f"/excluir/{ids['B1']}").status_code == 302
+    conn = epi.get_db_connection()
+    assert epi.versao_dados(conn) > antes
+    conn.close()
+
+    # a cópia não pode passar por "conferida" (dados ainda iguais)
+    feita_em = epi.copia_relatorios._ler_meta()[1]
+    assert epi.copia_relatorios.renovar()
+    assert epi.copia_relatorios._ler_meta()[1] > feita_em
+    r = cliente.get("/relatorios/export?format=csv")
+    assert "B1" not in r.get_data(as_text=True)
+    assert "X-Dados-Em" in r.headers
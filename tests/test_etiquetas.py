@@ -0,0 +1,17 @@
+import pytest
+
+
+@pytest.mark.parametrize("rota, corpo", [
+    ("/etiquetas/enfileirar", {"codigo": "A1"}),
+    ("/etiquetas/enfileirar_lote", {"itens": [{"codigo": "A1", "quantidade": 1}]}),
+])
+def test_enfileirar_exige_login(epi, itens, rota, corpo):
+    itens({"A1": 10})
+    r = epi.app.test_client().post(rota, json=corpo)
+    assert r.status_code == 401 and r.get_json()["ok"] is False
+
+
+def test_enfileirar_logado(epi, cliente, itens):
+    itens({"A1": 10})
+    r = cliente.post("/etiquetas/enfileirar", json={"codigo": "A1"})
+    assert r.status_code == 200 and r.get_json()["ok"]
@@ -0,0 +1,21 @@
+def test_limite_de_clientes(epi, cliente, monkeypatch):
+    monkeypatch.setattr(epi, "EVENTOS_CLIENTES_MAX", 1)
+    primeiro = cliente.get("/api/stream", buffered=False)
+    assert primeiro.status_code == 200
+    recusado = cliente.get("/api/stream")
+    assert recusado.status_code == 503 and recusado.headers["Retry-After"]
+    primeiro.close()
+    assert epi.eventos.stats()["clientes"] == 0
+    outro = cliente.get("/api/stream", buffered=False)
+    assert outro.status_code == 200
+    outro.close()
+
+
+def test_stream_fecha_depois_da_duracao_maxima(epi, cliente, monkeypatch):
+    monkeypatch.setattr(epi, "EVENTOS_DURACAO_MAX", 0.3)
+    monkeypatch.setattr(epi, "EVENTOS_VERIFICA", 0.05)
+    r = cliente.get("/api/stream", buffered=False)
+    corpo = b"".join(r.response)   # termina sozinho
+    assert corpo.startswith(b"retry: 3000")
+    r.close()
+    assert epi.eventos.stats()["clientes"] == 0
@@ -0,0 +1,30 @@
+from conftest import bipar
+
+
+def test_exportacao_refeita_depois_de_excluir_item(epi, cliente, itens):
+    ids = itens({"A1": 10, "B1": 10})
+    bipar(cliente, "A1", "A1", "B1")
+
+    r = cliente.get("/relatorios/export?format=csv")
+    etag = r.headers["ETag"]
+    assert "B1" in r.get_data(as_text=True)
+    assert cliente.get("/relatorios/export?format=csv", headers={"If-None-Match": etag}).status_code == 304
+
+    assert cliente.post(f"/excluir/{ids['B1']}").status_code == 302
+
+    r = cliente.get("/relatorios/export?format=csv", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    corpo = r.get_data(as_text=True)
+    assert "B1" not in corpo and corpo.count(";A1;") == 2
+
+
+def test_exportacao_servida_do_cache(epi, cliente, itens):
+    itens({"A1": 10})
+    bipar(cliente, "A1")
+    primeira = cliente.get("/estoque/export?format=csv")
+    dados = primeira.get_data()
+    segunda = cliente.get("/estoque/export?format=csv")
+    assert segunda.get_data() == dados
+    assert segunda.headers["ETag"] == primeira.headers["ETag"]
+    assert epi.cache_exportacoes.stats()["hits"] == 1
@@ -0,0 +1,53 @@
+import io
+import sqlite3
+
+
+def test_cli_importar_sem_coluna_obrigatoria(epi, itens, tmp_path):
+    itens({"A1": 10})
+    planilha = tmp_path / "fornecedor.csv"
+    planilha.write_text("codigo;nome\nA1;ITEM A1\n", encoding="utf-8")
+
+    r = epi.app.test_cli_runner().invoke(args=["importar-estoque", str(planilha)])
+    assert r.exit_code != 0
+    assert "'quantidade'" in r.output and "Traceback" not in r.output
+    assert r.exception is None or isinstance(r.exception, SystemExit)
+
+
+def test_cli_importar(epi, itens, tmp_path):
+    itens({"A1": 10})
+    planilha = tmp_path / "fornecedor.csv"
+    planilha.write_text("codigo;quantidade\nA1;5\n", encoding="utf-8")
+
+    r = epi.app.test_cli_runner().invoke(args=["importar-estoque", str(planilha)])
+    assert r.exit_code == 0, r.output
+    assert "1/1 linha(s) aplicadas" in r.output
+
+
+def test_cli_importar_xlsx_corrompido(epi, tmp_path):
+    planilha = tmp_path / "lixo.xlsx"
+    planilha.write_bytes(b"isto nao e um zip")
+
+    r = epi.app.test_cli_runner().invoke(args=["importar-estoque", str(planilha)])
+    assert r.exit_code == 1
+    assert "não importado" in r.output and "Traceback" not in r.output
+    assert r.exception is None or isinstance(r.exception, SystemExit)
+
+
+def test_upload_arquivo_ruim_e_400(epi, cliente):
+    r = cliente.post("/repor/importar", data={"arquivo": (io.BytesIO(b"isto nao e um zip"), "lixo.xlsx")},
+                     content_type="multipart/form-data")
+    assert r.status_code == 400
+    assert "Arquivo não importado" in r.get_data(as_text=True)
+
+
+def test_upload_erro_do_banco_nao_vira_400(epi, cliente, monkeypatch):
+    def travado(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(epi, "importar_estoque", travado)
+    epi.app.config["PROPAGATE_EXCEPTIONS"] = False
+    try:
+        r = cliente.post("/repor/importar", data={"arquivo": (io.BytesIO(b"codigo;quantidade\n"), "ok.csv")},
+                         content_type="multipart/form-data")
+    finally:
+        epi.app.config["PROPAGATE_EXCEPTIONS"] = None
+    assert r.status_code == 500
@@ -0,0 +1,41 @@
+import time
+
+
+def _com_conexao(epi, funcao, *args):
+    conn = epi.get_db_connection()
+    try:
+        return funcao(conn, *args)
+    finally:
+        conn.close()
+
+
+def _consultar(epi, sql, *params):
+    conn = epi.get_db_connection()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def test_baixa_sem_saldo_lanca_so_o_que_saiu(epi, cliente, itens):
+    ids = itens({"A1": 3})
+    r = cliente.post("/api/baixa", json=[{"codigo": "A1", "destinatario": "Fulano"}] * 5).get_json()
+    assert [x["saldo"] for x in r["resultados"]] == [2, 1, 0, 0, 0]
+
+    saidas = _consultar(epi, "SELECT quantidade FROM estoque_lancamentos WHERE item_id = ? AND origem = 'baixa'",
+                        ids["A1"])
+    assert [q for (q,) in saidas] == [-1, -1, -1]
+    assert _com_conexao(epi, epi.verificar_estoque) == []
+
+
+def test_foto_automatica_a_cada_n_lancamentos(epi, cliente, itens, monkeypatch):
+    ids = itens({"A1": 10})
+    monkeypatch.setattr(epi, "fotografo_estoque", epi.FotografoEstoque(a_cada=3))
+    cliente.post("/api/baixa", json=[{"codigo": "A1", "destinatario": "Fulano"}] * 3)
+
+    limite = time.monotonic() + 5
+    while not (fotos := _consultar(epi, "SELECT saldo FROM estoque_fotos WHERE item_id = ?", ids["A1"])):
+        assert time.monotonic() < limite, "nenhuma foto gravada"
+        time.sleep(0.02)
+    assert fotos[0][0] == 7
+    assert _com_conexao(epi, epi.saldo_em, ids["A1"], "9999-12-31") == 7
@@ -0,0 +1,30 @@
+import os
+import signal
+
+import pytest
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="precisa de fork")
+def test_servir_desiste_de_worker_que_morre_ao_subir(epi, monkeypatch, tmp_path):
+    subidas = tmp_path / "subidas"
+
+    def worker_quebrado(sock, threads):
+        with open(subidas, "a") as f:
+            f.write("x")
+        raise RuntimeError("banco ilegível")
+
+    monkeypatch.setattr(epi, "aquecer", lambda: None)
+    monkeypatch.setattr(epi, "_rodar_worker", worker_quebrado)
+    monkeypatch.setattr(epi, "SERVIDOR_ESPERA_INICIAL", 0.01)
+    monkeypatch.setattr(epi, "SERVIDOR_FALHAS_MAX", 4)
+    sinais = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        with pytest.raises(SystemExit) as saida:
+            epi.servir(host="127.0.0.1", port=0, threads=1, workers=2)
+    finally:
+        for s, tratador in sinais.items():
+            signal.signal(s, tratador)
+        epi.servidor_encerrando.clear()
+    assert saida.value.code == 1
+    # 2 iniciais + 3 substitutos; a 4ª falha seguida encerra sem subir outro
+    assert len(subidas.read_text()) == 5